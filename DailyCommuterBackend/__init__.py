@@ -17,6 +17,22 @@ def create_app(test_config=None):
         # Maybe set via config.py below?
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'DailyCommuter.sqlite'),
+        # Bus realtime tables, kept apart so bus writes don't lock the subway tables
+        BUS_DATABASE=os.path.join(app.instance_path, 'DailyCommuterBus.sqlite'),
+        # Idle connections kept per db pool in each process, see db.py
+        DB_POOL_SIZE=8,
+        # Realtime rows older than this (seconds) are moved to ARCHIVE_FOLDER
+        RETENTION_WINDOW=3 * 60 * 60,
+        ARCHIVE_FOLDER=os.path.join(app.instance_path, 'archive'),
+        # Route creation jobs running at once, and waiting, see jobs.py
+        ROUTE_JOB_WORKERS=4,
+        ROUTE_JOB_QUEUE=64,
+        # Queued or running jobs older than this (seconds) are failed on startup
+        ROUTE_JOB_TIMEOUT=5 * 60,
+        # Where notifications go, a file path or an http(s) url, see notifications.py
+        NOTIFY_SINK=os.path.join(app.instance_path, 'notifications.jsonl'),
+        NOTIFY_WORKERS=4,
+        NOTIFY_BATCH_SIZE=500,
     )
 
     if test_config is None:
@@ -35,6 +51,21 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import retention
+    retention.init_app(app)
+
+    from . import scheduler
+    scheduler.init_app(app)
+
+    from . import gtfs_static
+    gtfs_static.init_app(app)
+
+    from . import matcher
+    matcher.init_app(app)
+
+    from . import jobs
+    jobs.init_app(app)
+
     # Add when implementing users/login
     # from . import auth
     # app.register_blueprint(auth.bp)
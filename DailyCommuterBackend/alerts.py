@@ -0,0 +1,301 @@
+import hashlib
+import json
+import threading
+import time
+import numpy as np
+
+
+'''
+Service alerts
+
+Every service alert feed (service_alert_urls) is stored incrementally: each
+alert is fingerprinted and only alerts that are new or changed since the
+previous version of the same feed are upserted (with their informed entities
+and active periods); alerts that dropped out of the feed are deleted. The
+same alert can be in more than one feed (all-alerts and subway-alerts), rows
+are keyed by (feed, alert_id) so one feed dropping it doesn't remove it for
+the others.
+
+AlertsIndex is the read side, built from the tables: alerts by stop and by
+route, and an IntervalIndex over the active periods, so "what is active now
+at these stops/on these routes" never touches the db. It is rebuilt after
+every ingest in that process and at most INDEX_TTL seconds after one in
+another process.
+'''
+
+
+INDEX_TTL = 30
+FOREVER = 2 ** 62       # end of a period without an end
+
+
+class AlertRow:
+    def __init__(self, alert_id, fingerprint, header, description, effect, cause, entities, periods):
+        self.alert_id = alert_id
+        self.fingerprint = fingerprint
+        self.header = header
+        self.description = description
+        self.effect = effect
+        self.cause = cause
+        self.entities = entities    # [(agency_id, route_id, stop_id), ...]
+        self.periods = periods      # [(start, end), ...]
+
+
+_fingerprints = {}      # feed -> {alert_id: fingerprint} as of the last ingest
+_fingerprints_lock = threading.Lock()
+
+
+# English text of a TranslatedString, the MTA also sends an en-html copy
+def translation(translated):
+    texts = {t.language: t.text for t in translated.translation}
+    for language in ('en', '', None):
+        if language in texts:
+            return texts[language]
+    return next(iter(texts.values()), None)
+
+
+# Stable across processes, and changes with anything in the alert
+def fingerprint(alert):
+    digest = hashlib.blake2b(alert.SerializeToString(deterministic=True), digest_size=8)
+    return int.from_bytes(digest.digest(), 'big', signed=True)
+
+
+# One AlertRow per alert id in a FeedMessage
+def collect_alerts(feed):
+    rows = {}
+    for entity in feed.entity:
+        if not entity.HasField('alert'):
+            continue
+        alert = entity.alert
+        entities = list(dict.fromkeys(
+            (ie.agency_id or None, ie.route_id or None, ie.stop_id or None)
+            for ie in alert.informed_entity
+            if ie.route_id or ie.stop_id
+        ))
+        periods = [
+            (period.start or 0, period.end or None)
+            for period in alert.active_period
+        ]
+        rows[entity.id] = AlertRow(
+            entity.id, fingerprint(alert), translation(alert.header_text),
+            translation(alert.description_text), alert.effect, alert.cause,
+            entities, periods,
+        )
+    return rows
+
+
+# Upsert the alerts that changed and delete the ones that are gone
+# previous is {alert_id: fingerprint} of what the db holds for this feed
+def write_alerts(db, feed, rows, previous):
+    now = int(time.time())
+    changed = [alert_id for alert_id, row in rows.items() if previous.get(alert_id) != row.fingerprint]
+    removed = [alert_id for alert_id in previous if alert_id not in rows]
+
+    db.executemany(
+        """
+        INSERT INTO service_alerts
+        (feed, alert_id, fingerprint, header_text, description_text, effect, cause, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(feed, alert_id) DO UPDATE SET
+            fingerprint = excluded.fingerprint,
+            header_text = excluded.header_text,
+            description_text = excluded.description_text,
+            effect = excluded.effect,
+            cause = excluded.cause,
+            updated_at = excluded.updated_at
+        """,
+        ((feed, alert_id, rows[alert_id].fingerprint, rows[alert_id].header,
+          rows[alert_id].description, rows[alert_id].effect, rows[alert_id].cause, now)
+         for alert_id in changed)
+    )
+
+    # Entities and periods of changed and removed alerts are replaced wholesale
+    row_ids = dict(db.execute(
+        'SELECT alert_id, id FROM service_alerts'
+        ' WHERE feed = ? AND alert_id IN (SELECT value FROM json_each(?))',
+        (feed, json.dumps(changed + removed))
+    ).fetchall())
+    stale = json.dumps(list(row_ids.values()))
+    # What the changed and removed alerts informed before and after, for matcher.py
+    entities = {tuple(row) for row in db.execute(
+        'SELECT agency_id, route_id, stop_id FROM service_alert_entities'
+        ' WHERE alert_row IN (SELECT value FROM json_each(?))',
+        (stale,)
+    )}
+    entities.update(entity for alert_id in changed for entity in rows[alert_id].entities)
+    db.execute('DELETE FROM service_alert_entities WHERE alert_row IN (SELECT value FROM json_each(?))', (stale,))
+    db.execute('DELETE FROM service_alert_periods WHERE alert_row IN (SELECT value FROM json_each(?))', (stale,))
+    db.execute(
+        'DELETE FROM service_alerts WHERE feed = ? AND alert_id IN (SELECT value FROM json_each(?))',
+        (feed, json.dumps(removed))
+    )
+    db.executemany(
+        'INSERT INTO service_alert_entities (alert_row, agency_id, route_id, stop_id) VALUES (?, ?, ?, ?)',
+        ((row_ids[alert_id],) + entity for alert_id in changed for entity in rows[alert_id].entities)
+    )
+    db.executemany(
+        'INSERT INTO service_alert_periods (alert_row, start, end) VALUES (?, ?, ?)',
+        ((row_ids[alert_id],) + period for alert_id in changed for period in rows[alert_id].periods)
+    )
+    return {
+        'changed': len(changed),
+        'removed': len(removed),
+        'unchanged': len(rows) - len(changed),
+        'entities': entities,   # {(agency_id, route_id, stop_id), ...}
+    }
+
+
+# Store one version of an alert feed, returns the counts of what was written
+# and the entities of every alert that changed
+def ingest_alerts(db, feed_url, feed):
+    rows = collect_alerts(feed)
+    with _fingerprints_lock:
+        previous = _fingerprints.get(feed_url)
+    if previous is None:
+        previous = dict(db.execute(
+            'SELECT alert_id, fingerprint FROM service_alerts WHERE feed = ?', (feed_url,)
+        ).fetchall())
+    with db:
+        counts = write_alerts(db, feed_url, rows, previous)
+    with _fingerprints_lock:
+        _fingerprints[feed_url] = {alert_id: row.fingerprint for alert_id, row in rows.items()}
+    print(f"Alerts from {feed_url}: {counts['changed']} new or changed,"
+          f" {counts['removed']} removed, {counts['unchanged']} unchanged")
+    return counts
+
+
+# Subway stop ids in alerts are either the station (A28) or a platform (A28N)
+def stop_keys(stop_id):
+    if len(stop_id) == 4 and stop_id[-1] in 'NS':
+        return (stop_id, stop_id[:-1])
+    return (stop_id,)
+
+
+class IntervalIndex:
+    # Periods sorted by start, a stabbing query is a binary search plus one
+    # vectorized comparison over the periods that already started
+    def __init__(self, starts, ends, ids):
+        order = np.argsort(starts, kind='stable')
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self._cached = (None, frozenset())
+
+    # ids of every interval with start <= t < end
+    def stab(self, t):
+        t = int(t)
+        cached_t, cached = self._cached
+        if cached_t == t:
+            return cached
+        started = int(np.searchsorted(self.starts, t, 'right'))
+        hits = self.ids[:started][self.ends[:started] > t]
+        result = frozenset(hits.tolist())
+        self._cached = (t, result)
+        return result
+
+
+class AlertsIndex:
+    def __init__(self, alerts, entities, periods, built_at=None):
+        # alerts: [{alert_id, header, description, effect, cause}, ...]
+        # entities: [(alert position, agency_id, route_id, stop_id), ...]
+        # periods: [(alert position, start, end), ...], an alert without one is always active
+        self.alerts = alerts
+        self.built_at = built_at
+        self.by_stop = {}
+        self.by_route = {}
+        for alert in alerts:
+            alert.setdefault('stops', [])
+            alert.setdefault('routes', [])
+            alert.setdefault('active_periods', [])
+        for position, agency_id, route_id, stop_id in entities:
+            alert = alerts[position]
+            if stop_id:
+                self.by_stop.setdefault(stop_id, set()).add(position)
+                alert.setdefault('stops', []).append(stop_id)
+            if route_id:
+                self.by_route.setdefault(route_id, set()).add(position)
+                alert.setdefault('routes', []).append(route_id)
+
+        for position, start, end in periods:
+            alerts[position]['active_periods'].append([start, end])
+        timed = {position for position, _, _ in periods}
+        starts = [start or 0 for _, start, _ in periods]
+        ends = [end or FOREVER for _, _, end in periods]
+        ids = [position for position, _, _ in periods]
+        for position in range(len(alerts)):
+            if position not in timed:
+                starts.append(0)
+                ends.append(FOREVER)
+                ids.append(position)
+        self.periods = IntervalIndex(starts, ends, ids)
+
+    # The same alert from several feeds is kept once
+    @classmethod
+    def from_db(cls, db):
+        positions = {}
+        alerts = []
+        row_positions = {}
+        for row_id, alert_id, header, description, effect, cause in db.execute(
+            'SELECT id, alert_id, header_text, description_text, effect, cause'
+            ' FROM service_alerts ORDER BY alert_id, id'
+        ):
+            if alert_id not in positions:
+                positions[alert_id] = len(alerts)
+                alerts.append({'alert_id': alert_id, 'header': header, 'description': description,
+                               'effect': effect, 'cause': cause})
+            row_positions[row_id] = positions[alert_id]
+        # dict.fromkeys drops the copies from other feeds and keeps the order
+        entities = dict.fromkeys(
+            (row_positions[row_id], agency_id, route_id, stop_id)
+            for row_id, agency_id, route_id, stop_id in db.execute(
+                'SELECT alert_row, agency_id, route_id, stop_id FROM service_alert_entities ORDER BY id'
+            )
+            if row_id in row_positions
+        )
+        periods = dict.fromkeys(
+            (row_positions[row_id], start, end)
+            for row_id, start, end in db.execute(
+                'SELECT alert_row, start, end FROM service_alert_periods ORDER BY id'
+            )
+            if row_id in row_positions
+        )
+        return cls(alerts, list(entities), list(periods), time.time())
+
+    def __len__(self):
+        return len(self.alerts)
+
+    # Alerts active at `now` that inform any of the stops or routes,
+    # every active alert when neither is given
+    def active(self, stops=(), routes=(), now=None):
+        active = self.periods.stab(now if now is not None else time.time())
+        if not stops and not routes:
+            candidates = active
+        else:
+            candidates = set()
+            for stop_id in stops:
+                for key in stop_keys(stop_id):
+                    candidates.update(self.by_stop.get(key, ()))
+            for route_id in routes:
+                candidates.update(self.by_route.get(route_id, ()))
+            candidates &= active
+        return [self.alerts[position] for position in sorted(candidates)]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# The alerts index for this process, rebuilt from the db when it's older than INDEX_TTL
+def get_index(db):
+    global _index
+    with _index_lock:
+        if _index is None or time.time() - _index.built_at > INDEX_TTL:
+            _index = AlertsIndex.from_db(db)
+        return _index
+
+
+def rebuild(db):
+    global _index
+    index = AlertsIndex.from_db(db)
+    with _index_lock:
+        _index = index
+    return index
@@ -1,15 +1,28 @@
 import config
 import os
+import random
+import threading
 import time
-from datetime import datetime
+from urllib.parse import urlencode, urlsplit
 import json
 import requests
 import sqlite3
 from dotenv import load_dotenv
-from google.transit import gtfs_realtime_pb2
+from google.protobuf.message import DecodeError
 from flask import jsonify
-from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.db import get_db, get_read_db, get_bus_db
 from DailyCommuterBackend.models import Route
+from DailyCommuterBackend import alerts, arrivals, matcher, notifications, outages, planner, stations
+from DailyCommuterBackend.geometry import save_route_stops
+from DailyCommuterBackend.apiRouting.feeds import FeedPoller, get_source, UPDATED, FAILED
+from DailyCommuterBackend.apiRouting.ingest import ingest_feed, get_diff
+from DailyCommuterBackend.apiRouting.bus import ingest_bus_feed
+from DailyCommuterBackend.apiRouting.geocode import geocode_cache
+from DailyCommuterBackend.apiRouting.http_client import http_client
+from DailyCommuterBackend.apiRouting.plan_cache import plan_cache, snap_coord, bucket_time
+from DailyCommuterBackend.apiRouting.token_cache import token_cache
+from DailyCommuterBackend.apiRouting.saved_routes import list_saved_routes, touch_user_routes
+from DailyCommuterBackend.apiRouting.autocomplete import autocomplete_index, BIAS_LAT, BIAS_LON
 import firebase_admin
 from firebase_admin import credentials, auth
 
@@ -18,18 +31,32 @@ from firebase_admin import credentials, auth
 load_dotenv()
 BUS_FEED_KEY = os.getenv("BUS_FEED_KEY")
 TRANSIT_TOKEN = os.getenv("TRANSIT_TOKEN")
+ROUTER_DUMP_SAMPLE_RATE = float(os.getenv("ROUTER_DUMP_SAMPLE_RATE", "0"))
+# Plan subway journeys in process (planner.py) and only ask Transit when it has no answer
+LOCAL_PLANNER = os.getenv("LOCAL_PLANNER", "true").lower() != "false"
+# Routes replanned per run of the 'recalc' job, the rest wait for the next run
+RECALC_BATCH = int(os.getenv("RECALC_BATCH", "50"))
+# Tell the user when a replanned route got at least this many seconds longer
+NOTIFY_LONGER_BY = int(os.getenv("NOTIFY_LONGER_BY", "300"))
 
 # cred = credentials.Certificate("path/to/serviceAccountKey.json")
 # firebase_admin.initialize_app(cred)
 
 # Verify Firebase ID token
+# A token verified before is answered from token_cache until it expires
 def verify_token(id_token):
+    decoded_token = token_cache.get(id_token)
+    if decoded_token is not None:
+        return decoded_token['uid']
     try:
         decoded_token = auth.verify_id_token(id_token)
-        return decoded_token['uid']
     except Exception as e:
         print("Token verification failed:", e)
         return None
+    if not token_cache.put(id_token, decoded_token):
+        print("Token verification failed: the user's tokens were revoked")
+        return None
+    return decoded_token['uid']
     
 
 # URLs for all api calls
@@ -54,19 +81,34 @@ elev_escal_json_urls = [
     config.ELEV_ESCAL_UPCOMING_OUTAGES_JSON,
     config.ELEV_ESCAL_EQUIPMENTS_OUTAGES_JSON,]
 
+bus_feed_urls = [
+    config.BUS_TRIP_UPDATES_URL,
+    config.BUS_VEHICLE_POSITIONS_URL,]
+
+elev_escal_feeds = {
+    config.ELEV_ESCAL_EQUIPMENTS_OUTAGES_JSON: outages.EQUIPMENT,
+    config.ELEV_ESCAL_CURRENT_OUTAGES_JSON: outages.CURRENT,
+    config.ELEV_ESCAL_UPCOMING_OUTAGES_JSON: outages.UPCOMING,
+}
 
+# Keep the ETag/Last-Modified/header timestamp of every train and alert feed between polls
+subway_poller = FeedPoller(train_update_urls)
+alerts_poller = FeedPoller(service_alert_urls)
+
+
+# Get the newest parsed copy of a feed
+# Goes through the shared FeedSource for the url, so callers reading the same
+# feed share one download and one parse per version of it
 def fetch_data(endpoint, key=None):
-    feed = gtfs_realtime_pb2.FeedMessage()
     if key is None:
-        response = requests.get(endpoint)
-        if not response.status_code == 200:
-            print(f"Failed to fetch data: {response.status_code}")
-            return
-        feed.ParseFromString(response.content)
+        source = get_source(endpoint)
     else:
-        response = requests.get(f"{endpoint}key={key}")
-        feed.ParseFromString(response.content)
-    return feed
+        separator = '&' if urlsplit(endpoint).query else '?'
+        source = get_source(f"{endpoint}{separator}{urlencode({'key': key})}", name=endpoint)
+    result = source.fetch()
+    if result.status == FAILED:
+        return None
+    return result.feed
 
 
 # Train update GTFS structure is as follows:
@@ -128,77 +170,15 @@ vehicle {
 }
 ----------------------------------
 '''
-def update_trains(feed):
+# Only trips whose predictions changed since the previous version of the
+# feed (tracked by diff, see ingest.py) are written
+def update_trains(feed, diff=None):
     try:
-        with get_db() as db:
-            trip_update_id = None
-            for entity in feed.entity:
-                # Check if update_id already exists (prevents duplicates)
-                id_exists = db.execute(
-                    "SELECT id FROM trip_update WHERE update_id = ?", 
-                    (entity.id,)
-                ).fetchone()
-
-                if id_exists:
-                    # print(f"Skipping duplicate update_id: {entity.id}")
-                    continue
-                
-                # Get and store the trip info about the following updates
-                if entity.HasField('trip_update'):
-                    db.execute(
-                        """
-                        INSERT INTO trip_update 
-                        (update_id, trip_id, start_tm, start_dt, route_id)
-                        VALUES (?, ?, ?, ?, ?)
-                        """,
-                        (entity.id,
-                        entity.trip_update.trip.trip_id, 
-                        entity.trip_update.trip.start_time, 
-                        entity.trip_update.trip.start_date, 
-                        entity.trip_update.trip.route_id,)
-                    )
-
-                    # Get id from the main trip_update table as reference 
-                    # for stop_update and vehicle_update tables
-                    trip_update_id = db.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-                    # Get and store the actual updates info
-                    for update in entity.trip_update.stop_time_update:
-                        if trip_update_id is not None:
-                            db.execute(
-                                """
-                                INSERT INTO stop_update 
-                                (trip_update_id, arrival, departure, stop_id, direction)
-                                VALUES (?, ?, ?, ?, ?)
-                                """,
-                                (trip_update_id,
-                                update.arrival.time, 
-                                update.departure.time, 
-                                update.stop_id[:-1],
-                                update.stop_id[-1],)
-                            )
-
-                # Get and store the vehecle info about the above updates
-                if entity.HasField('vehicle'):
-                    if trip_update_id is not None:
-                        db.execute(
-                            """
-                            INSERT INTO vehicle_update
-                            (trip_update_id, timestmp, curr_stop_id)
-                            VALUES (?, ?, ?)
-                            """,
-                            (trip_update_id,
-                            entity.vehicle.timestamp, 
-                            entity.vehicle.stop_id,)
-                        )
-            db.commit()
-
+        return ingest_feed(get_db(), feed, diff)
     except sqlite3.IntegrityError as e:
         print(f"Integrity Error: {e}")
     except Exception as e:
         print(f"Error updating database: {e}")
-    finally:
-        pass
 
 
 ### ALERTING LOGIC ###
@@ -326,46 +306,104 @@ alert {
   }
 }
 '''
-def update_subway_alerts():
-    feed = fetch_data(endpoint = config.SUBWAY_ALERTS_URL_GTFS)
+# Store every new version of a service alert feed, only changed alerts are written
+# and the saved routes at the stations and on the lines of those alerts are queued for replanning
+def ingest_alert_snapshot(snapshot):
     db = get_db()
-    try:
-        db.execute('DELETE FROM my_data;')
-        for entity in feed.entity:
-            db.execute(
-                'INSERT INTO subway_alerts (alert_id)'
-                'VALUES (?)',
-                (entity.id,)
-            )
-            inf_ent = entity.alert.informed_entity
-            for ie in inf_ent:
-                if ie.HasField('stop_id'):
-                    db.execute(
-                        'INSERT INTO subway_alerts (stop_id, alert_text)'
-                        'VALUES (?, ?)',
-                        (ie.stop_id, entity.alert.header_text.translation[0].text,)
-                    )
-                elif ie.HasField('route_id'):
-                    db.execute(
-                        'INSERT INTO subway_alerts (route_id, alert_text)'
-                        'VALUES (?, ?)',
-                        (ie.route_id, entity.alert.header_text.translation[0].text,)
-                    )
-        db.commit()
-
-    except sqlite3.IntegrityError as e:
-        print(f"Integrity Error: {e}")
-    except Exception as e:
-        print(f"Error updating database: {e}")
+    counts = alerts.ingest_alerts(db, snapshot.url, snapshot.feed)
+    queued = matcher.queue_affected_routes(db, counts['entities'])
+    if queued:
+        print(f"Queued {len(queued)} routes affected by alerts from {snapshot.url}")
+
+
+alerts_poller.subscribe(ingest_alert_snapshot)
+
+
+# Stream the bus trip updates and vehicle positions into the bus db,
+# nothing to do without a BUS_FEED_KEY
+def update_bus_feeds():
+    if not BUS_FEED_KEY:
+        return {}
+    db = get_bus_db()
+    results, failed = {}, []
+    for url in bus_feed_urls:
+        try:
+            results[url] = ingest_bus_feed(db, f"{url}{BUS_FEED_KEY}", url)
+        except (requests.exceptions.RequestException, DecodeError) as e:
+            print(f"Could not ingest {url}: {e}")
+            failed.append(url)
+    if len(failed) == len(bus_feed_urls):
+        raise RuntimeError("Could not fetch any bus feed")
+    return results
+
+
+# Fetch the elevator and escalator documents that changed, equipment first
+# so the outages can be matched to its stations, and rebuild the outage index
+def update_elevator_outages():
+    db = get_db()
+    resolver = outages.StopResolver.from_db(db)
+    changed, failed = [], []
+    for url, feed in elev_escal_feeds.items():
+        try:
+            items = outages.fetch_items(url)
+            if items is None:
+                continue
+            if feed == outages.EQUIPMENT:
+                count = outages.ingest_equipment(db, items, resolver)
+                print(f"Elevator and escalator list: {count} units")
+            else:
+                count, unmatched = outages.ingest_outages(db, feed, items, resolver)
+                print(f"Elevator and escalator outages ({feed}): {count}, {unmatched} without a station")
+            changed.append(url)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Could not update {url}: {e}")
+            failed.append(url)
+    if len(failed) == len(elev_escal_feeds):
+        raise RuntimeError("Could not fetch any elevator and escalator feed")
+    if changed:
+        outages.rebuild(db)
+    return changed
+
+
+# Fetch every service alert feed (subway, bus, LIRR, Metro-North) at once
+# and rebuild the alerts index when any of them changed
+def update_service_alerts():
+    results = alerts_poller.poll()
+    # Feeds fetched but not ingested are reported by the caller, see scheduler.py
+    if all(result.status == FAILED and result.error is None for result in results):
+        raise RuntimeError("Could not fetch any service alert feed")
+    if any(result.status == UPDATED for result in results):
+        alerts.rebuild(get_db())
+    return results
+
+
+# Errors reach the poller, so the version is fetched and ingested again next time
+def ingest_trip_snapshot(snapshot):
+    ingest_feed(get_db(), snapshot.feed, get_diff(snapshot.url))
+
+
+subway_poller.subscribe(ingest_trip_snapshot)
 
 
 def update_subway_feeds():
-    # Update all the trains
-    for url in train_update_urls:
-        update_trains(fetch_data(url))
+    # Fetch all the train feeds at once, then only ingest the ones that changed
+    # Subscribers (ingest_trip_snapshot) run inside poll() for every feed that changed
+    results = subway_poller.poll()
+
+    # Rebuild the next-arrivals index from the newest copy of every feed
+    if any(result.status == UPDATED for result in results):
+        arrivals.rebuild([state.feed for state in subway_poller.states.values() if state.feed])
+    return results
 
 
+# Cached, rate limited lookup, see geocode.py
 def geocoder(address):
+    lat, lon = geocode_cache.lookup(address, nominatim_lookup)
+    autocomplete_index.add(address, lat, lon)
+    return lat, lon
+
+
+def nominatim_lookup(address):
     url = "https://nominatim.openstreetmap.org/search"
     params = {
         'q': address,
@@ -375,7 +413,7 @@ def geocoder(address):
     headers = {
         'User-Agent': 'DailyCommuter chz9577@nyu.edu'
     }
-    response = requests.get(url, params=params, headers=headers)
+    response = http_client.get(url, params=params, headers=headers)
     data = response.json()
     if data:
         lat = float(data[0]['lat'])
@@ -386,8 +424,8 @@ def geocoder(address):
 
 
 def createRoute(start_address, end_address, arriveby, userid):
+    # geocoder() only waits on the API rate limit for addresses it hasn't seen
     start_lat, start_lon = geocoder(start_address)
-    time.sleep(1) #prevent going over API limit
     end_lat, end_lon = geocoder(end_address)
 
     try:
@@ -398,6 +436,7 @@ def createRoute(start_address, end_address, arriveby, userid):
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                     ''', (start_address, end_address, start_lat, start_lon, end_lat, end_lon, arriveby, userid)) 
             route_id = c.lastrowid
+            touch_user_routes(conn, userid)
             conn.commit()
             print("after commit")
     except sqlite3.IntegrityError as e:
@@ -426,24 +465,108 @@ def getRoute(route_id):
         return None
 
 
-def Router(route):
+# Save a sample of the raw OTP responses for debugging
+# Off unless ROUTER_DUMP_SAMPLE_RATE is set (0.0 - 1.0), writes on a background thread
+def maybe_dump_response(data):
+    if ROUTER_DUMP_SAMPLE_RATE <= 0 or random.random() >= ROUTER_DUMP_SAMPLE_RATE:
+        return
+
+    def dump():
+        with open('test_route_response.json', 'w') as f:
+            json.dump(data, f, indent=2)
+        print("✅ Saved response to test_route_response.json", flush=True)
+
+    threading.Thread(target=dump, daemon=True).start()
+
+
+# Replan up to limit routes queued by matcher.queue_affected_routes and queue a
+# notification for the owner of every route that got NOTIFY_LONGER_BY longer,
+# returns how many were replanned
+def recalc_queued_routes(limit=RECALC_BATCH):
+    db = get_db()
+    replanned = 0
+    longer = []
+    failed = []
+    # Plans from before this batch don't know about the alerts that queued it
+    started = time.monotonic()
+    for routeid in matcher.pop_queued_routes(db, limit):
+        route = getRoute(routeid)
+        if route is None:
+            continue
+        # Not estimateTime, which every replan overwrites, so a commute that
+        # gets slower a little at a time still adds up to a notification
+        before = db.execute('SELECT baselineTime FROM routes WHERE routeid = ?', (routeid,)).fetchone()[0]
+        try:
+            # Router answers (response, status) when the planning request fails
+            if isinstance(Router(route, fresh_since=started), tuple):
+                failed.append(routeid)
+                continue
+            replanned += 1
+        except Exception as e:
+            print(f"Could not replan route {routeid}: {e}")
+            failed.append(routeid)
+            continue
+        after = route.estimateTime
+        # Routes saved before estimateTime was stored have nothing to compare
+        # with, Router just saved this replan as their baseline
+        if before is None:
+            continue
+        if after - before >= NOTIFY_LONGER_BY:
+            longer.append((route.userid, route.id,
+                           f"{route.start_address} to {route.end_address} now takes {after // 60} min,"
+                           f" {(after - before) // 60} min longer than planned"))
+            # The owner knows about this one, only notify again when it gets longer still
+            with db:
+                db.execute('UPDATE routes SET baselineTime = ? WHERE routeid = ?', (after, routeid))
+    # Tried again by the next run, after the routes queued since
+    if failed:
+        matcher.requeue_routes(db, failed)
+    if longer:
+        notifications.enqueue(db, longer)
+    return replanned
+
+
+# Plan with the local timetable, None when Transit should be asked instead
+def local_plan(start, end, arrival_time):
+    if not LOCAL_PLANNER:
+        return None
+    try:
+        return planner.plan_arrive_by(start, end, arrival_time)
+    except Exception as e:
+        print(f"Local planner failed, asking Transit: {e}", flush=True)
+        return None
+
+
+# fresh_since (a time.monotonic()) asks Transit again unless the plan was
+# cached after it, the local planner is skipped too since it ignores alerts
+def Router(route, fresh_since=None):
     url = "https://external.transitapp.com/v3/otp/plan"
     headers = {
         "apiKey": TRANSIT_TOKEN
     }
+    # Snap the request so users with nearby addresses and times share plans
+    start = snap_coord(route.start_lat, route.start_lon)
+    end = snap_coord(route.end_lat, route.end_lon)
     params = {
-        'fromPlace': f"{route.start_lat},{route.start_lon}",
-        'toPlace': f"{route.end_lat},{route.end_lon}",
+        'fromPlace': f"{start[0]},{start[1]}",
+        'toPlace': f"{end[0]},{end[1]}",
         'arriveBy': 'true',
-        'time': route.arrival_time,
-        'date': datetime.today().strftime("%Y-%m-%d")
+        'time': bucket_time(route.arrival_time),
+        # The service day in New York, like the local planner's, whatever the host's timezone
+        'date': planner.service_date(time.time()).strftime("%Y-%m-%d")
     }
-
+    key = (start, end, params['time'], params['date'])
 
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
+        data = plan_cache.get(key, since=fresh_since)
+        if data is None and fresh_since is None:
+            data = local_plan(start, end, params['time'])
+        if data is None:
+            response = http_client.get(url, headers=headers, params=params)
+            response.raise_for_status()
+            data = response.json()
+            plan_cache.put(key, data)
+            maybe_dump_response(data)
         r1 =  data['plan']['itineraries'][0]
         duration = r1['duration']
         route.estimateTime = duration
@@ -479,19 +602,16 @@ def Router(route):
                 'name': leg['to'].get('name', f'Stop {i}'),
                 'type': 2 if i == len(r1['legs']) - 1 else 1  # Mark as end if it's the last leg
             })
+        route_stops, route_lines, route_access = matcher.plan_entities(r1, stations.get_stations())
         conn = get_db()
-        c = conn.cursor()
-        for stop in stops:
-            c.execute('''
-                INSERT INTO points (routeid, lat, lon, name, type)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (route.id, stop['lat'], stop['lon'], stop.get('name', ''), stop['type']))
-        conn.commit()
-
-        with open('test_route_response.json', 'w') as f:
-            json.dump(data, f, indent=2)
-        print("✅ Saved response to test_route_response.json", flush=True)
-        return jsonify(response.json())
+        with conn:
+            save_route_stops(conn, route.id, stops)
+            # The first plan is the baseline replans are compared with
+            conn.execute('UPDATE routes SET estimateTime = ?, baselineTime = COALESCE(baselineTime, ?)'
+                         ' WHERE routeid = ?', (duration, duration, route.id))
+            matcher.save_route_entities(conn, route.id, route_stops, route_lines, route_access)
+
+        return jsonify(data)
     except requests.exceptions.RequestException as e:
         print("❌ Request Error:", e, flush=True)
         return jsonify({"error": str(e)}), 500
@@ -522,47 +642,18 @@ def get_and_plan_route(userid, route_name):
         return Router(route)
 
 
-# Get ALL the saved routes for a given user
+# Get the saved routes for a given user, one page at a time
 # @param userid: user id of requester
-# @return dictionary: {route_name : {start_address, end_address, arrival_time}, {...}}
-'''
-{“School”:
-  {
-    “start_address” : start_address,
-    “end_address” : end_address,
-    “arrival_time” : arrival_time
-   },
- “Work”:
-    {
-        “start_address” : start_address,
-        “end_address” : end_address,
-        “arrival_time” : arrival_time
-    },
- ...}
-'''
-def get_saved_routes(userid):
+# @param limit: max number of routes to return
+# @param after: routeid to start after (next_after of the previous page)
+# @return dictionary: {"routes": [{routeid, route_name, start_address, end_address, arrival_time}, ...],
+#                      "next_after": routeid or None if this was the last page}
+def get_saved_routes(userid, limit=50, after=0):
     try:
-        with get_db() as db:
-            routes = db.execute('''
-                SELECT routeid, route_name
-                FROM routes
-                WHERE userid = ?
-                ''', 
-                (userid,)).fetchall()
-            saved_routes = []
-            for route in routes:
-                cur_route = getRoute(route["routeid"])
-                details = {"start_address" : f"{cur_route.start_address}",
-                           "end_address" : f"{cur_route.end_address}",
-                           "arrival_time" : f"{cur_route.arrival_time}",}
-                saved_routes.append({f"{route["route_name"]}" : details})
-
-    except sqlite3.IntegrityError as e:
-        print(f"Integrity Error: {e}")
+        return list_saved_routes(get_read_db(), userid, limit, after)
     except Exception as e:
-        print(f"Error updating database: {e}")
-    finally:
-        return saved_routes
+        print(f"Error reading saved routes: {e}")
+        return {"routes": [], "next_after": None}
 
 
 # Gets all the subway stops for NYC using the transitapp api and saves them in the db
@@ -576,7 +667,7 @@ def save_all_subway_stops():
         'network_id': "NYC Subway|NYC"
     }
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = http_client.get(url, headers=headers, params=params)
         response.raise_for_status()
         stoplist = response.json()
     except requests.exceptions.RequestException as e:
@@ -597,6 +688,9 @@ def save_all_subway_stops():
                           stop["stop_lon"], 
                           stop["stop_name"], 
                           stop["wheelchair_boarding"],))
+        # Pick up the new stop names on the next autocomplete
+        autocomplete_index.loaded = False
+        stations.invalidate()
     except sqlite3.IntegrityError as e:
         print(f"Integrity Error: {e}")
     except Exception as e:
@@ -607,6 +701,8 @@ def save_all_subway_stops():
 # We should eventually transition this to our own installation of the api
 #   since we dont want to overload the public api
 # Source is https://photon.komoot.io/, https://github.com/komoot/photon
+# Answers come from the local index in autocomplete.py first, photon is only
+#   called when it has fewer than `limit` matches
 '''
 Returns this kind of data:
 {
@@ -648,33 +744,35 @@ Returns this kind of data:
     ]
 }
 '''
-def address_autocomplete(input_text):
+def address_autocomplete(input_text, limit=5):
+    # Answer from the local index when it has enough matches
+    if not autocomplete_index.loaded:
+        autocomplete_index.load()
+    features = autocomplete_index.search(input_text, limit)
+    if len(features) >= limit:
+        return {"features": features}
+
+    try:
+        locations = photon_lookup(input_text, limit)
+    except requests.exceptions.RequestException as e:
+        print("Request Error:", e, flush=True)
+        return {"features": features}
+
+    # Remember what photon told us so the next keystroke stays local
+    autocomplete_index.add_photon_features(locations["features"])
+    return {"features": autocomplete_index.search(input_text, limit) or locations["features"]}
+
+
+def photon_lookup(input_text, limit=5):
     url = "https://photon.komoot.io/api/?"
     params = {
         'q' : input_text,
-        'lat': "40.741975",     # location bias to Geographic Center of NYC
-        'lon': "-73.907326",
-        'limit': 5,             # limit 5 most relevant results
+        'lat': str(BIAS_LAT),   # location bias to Geographic Center of NYC
+        'lon': str(BIAS_LON),
+        'limit': limit,         # limit 5 most relevant results
         'lang' : "en",
         'layer' : "house"       # filter by building address layer first
     }
-    try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        locations = response.json()
-    except requests.exceptions.RequestException as e:
-        print("Request Error:", e, flush=True)
-        return jsonify({"error": str(e)}), 500
-    except Exception as e:
-        print(f"Error with address_autocomplete: {e}")
-    finally:
-        result = []
-        for i in range(len(locations["features"])):
-            address = locations["features"][i]["properties"]["housenumber"],
-            street = locations["features"][i]["properties"]["street"],
-            city = locations["features"][i]["properties"]["city"],
-            zipcode = locations["features"][i]["properties"]["postcode"]
-            # state = locations["features"][i]["properties"]["state"],
-            # country = locations["features"][i]["properties"]["countrycode"]
-            result.append(f"{address} {street} {zipcode} {city}")
-        return locations
+    response = http_client.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
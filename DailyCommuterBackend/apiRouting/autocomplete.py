@@ -0,0 +1,99 @@
+import bisect
+import threading
+from DailyCommuterBackend.apiRouting.geocode import normalize_address
+from DailyCommuterBackend.db import get_read_db
+
+
+'''
+Local address autocomplete
+
+A sorted array of normalized labels, so every prefix is a binary search plus
+a short scan. It is filled from subway stop names, addresses we've geocoded,
+saved route addresses and every feature photon has returned to us, and
+results are ranked by distance to the NYC bias point address_autocomplete
+already uses. Photon is only asked when the local index runs short.
+'''
+
+
+# Geographic center of NYC, same bias point as address_autocomplete
+BIAS_LAT = 40.741975
+BIAS_LON = -73.907326
+
+
+# Text shown for a photon feature, e.g. "319 East 73rd Street, New York, 10021"
+def feature_label(properties):
+    street = ' '.join(
+        part for part in (properties.get('housenumber'), properties.get('street')) if part
+    )
+    parts = [properties.get('name'), street, properties.get('city'), properties.get('postcode')]
+    return ', '.join(part for part in parts if part)
+
+
+def make_feature(label, lat, lon, source):
+    return {
+        'geometry': {'coordinates': [lon, lat], 'type': 'Point'},
+        'type': 'Feature',
+        'properties': {'name': label, 'source': source},
+    }
+
+
+# Squared equirectangular distance, only used for ordering
+def bias_distance(lat, lon):
+    return (lat - BIAS_LAT) ** 2 + ((lon - BIAS_LON) * 0.76) ** 2  # cos(40.7 deg)
+
+
+class AutocompleteIndex:
+    def __init__(self):
+        self.keys = []          # sorted normalized labels
+        self.features = []      # feature for each key, same order
+        self.distances = []     # distance to the bias point for each key
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def add(self, label, lat, lon, feature=None, source='local'):
+        key = normalize_address(label)
+        if not key or lat is None or lon is None:
+            return
+        with self._lock:
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                return
+            self.keys.insert(i, key)
+            self.features.insert(i, feature or make_feature(label, lat, lon, source))
+            self.distances.insert(i, bias_distance(lat, lon))
+
+    def add_photon_features(self, features):
+        for feature in features:
+            lon, lat = feature['geometry']['coordinates'][:2]
+            self.add(feature_label(feature['properties']), lat, lon, feature)
+
+    # Fill the index from everything already in the db
+    def load(self):
+        db = get_read_db()
+        for row in db.execute('SELECT stop_name, stop_lat, stop_lon FROM subway_stops'):
+            self.add(row['stop_name'], row['stop_lat'], row['stop_lon'], source='subway_stop')
+        for row in db.execute('SELECT address, lat, lon FROM geocode_cache'):
+            self.add(row['address'], row['lat'], row['lon'])
+        for row in db.execute(
+            'SELECT start_address, start_lat, start_lon, end_address, end_lat, end_lon FROM routes'
+        ):
+            self.add(row['start_address'], row['start_lat'], row['start_lon'])
+            self.add(row['end_address'], row['end_lat'], row['end_lon'])
+        self.loaded = True
+
+    # Every feature whose label starts with the text, closest to the bias point first
+    def search(self, text, limit=5, max_scan=500):
+        prefix = normalize_address(text)
+        if not prefix:
+            return []
+        with self._lock:
+            i = bisect.bisect_left(self.keys, prefix)
+            matches = []
+            while i < len(self.keys) and len(matches) < max_scan and self.keys[i].startswith(prefix):
+                matches.append((self.distances[i], self.features[i]))
+                i += 1
+        matches.sort(key=lambda match: match[0])
+        return [feature for _, feature in matches[:limit]]
+
+
+autocomplete_index = AutocompleteIndex()
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import time
+from dataclasses import dataclass, field
+from DailyCommuterBackend.apiRouting.http_client import http_client
+from google.protobuf.message import DecodeError
+from google.transit import gtfs_realtime_pb2
+
+
+'''
+Bus GTFS-RT ingest
+
+The bus trip update and vehicle position feeds cover every bus in the city
+and are much bigger than any subway feed, so they never go through
+FeedSource (which buffers and parses a whole FeedMessage). The body is read
+in chunks and walked at the protobuf wire level (iter_feed): the header
+first, then one FeedEntity at a time, so only the current entity and a
+chunk are in memory no matter how big the feed is. When the header says
+this version was already ingested the rest of the body isn't even read.
+
+Rows go into the bus db (get_bus_db, its own file) in executemany batches
+of BATCH_ROWS inside one transaction per feed version. Like the subway
+delta ingest, a trip is only rewritten when its predictions changed and a
+vehicle only when it reported a newer position; trips and vehicles that
+dropped out of the feed are deleted. The first ingest of a process reads the
+trips and vehicles already in the bus db back into its state, so the rows
+left by a previous run are compared with and deleted like any others.
+'''
+
+
+BATCH_ROWS = 5000
+CHUNK_SIZE = 256 * 1024
+TIMEOUT = (5, 60)       # connect, read (seconds)
+HEADER = 1              # FeedMessage field numbers
+ENTITY = 2
+
+
+@dataclass
+class BusFeedState:
+    version: int = None         # header timestamp of the last version ingested
+    trips: dict = field(default_factory=dict)       # trip_id -> fingerprint
+    vehicles: dict = field(default_factory=dict)    # vehicle_id -> timestamp
+    loaded: bool = False        # trips and vehicles read back from the db
+
+
+_states = {}
+
+
+def get_state(name):
+    return _states.setdefault(name, BusFeedState())
+
+
+# Start from what the db holds, which is what the last run of any process wrote
+def load_state(db, state):
+    state.trips = dict(db.execute('SELECT trip_id, fingerprint FROM bus_trips').fetchall())
+    state.vehicles = dict(db.execute('SELECT vehicle_id, timestamp FROM bus_vehicles').fetchall())
+    state.loaded = True
+
+
+def read_varint(buffer, pos):
+    value, shift = 0, 0
+    while True:
+        if pos >= len(buffer):
+            return None, pos
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+# (FeedHeader, None) once and then (None, FeedEntity) for every entity of a
+# serialized FeedMessage arriving as byte chunks
+def iter_feed(chunks):
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while True:
+            start = pos
+            tag, pos = read_varint(buffer, pos)
+            if tag is None:
+                pos = start
+                break
+            number, wire_type = tag >> 3, tag & 7
+            if wire_type == 0:
+                value, pos = read_varint(buffer, pos)
+                if value is None:
+                    pos = start
+                    break
+                continue
+            if wire_type in (1, 5):
+                size = 8 if wire_type == 1 else 4
+            elif wire_type == 2:
+                size, pos = read_varint(buffer, pos)
+                if size is None:
+                    pos = start
+                    break
+            else:
+                raise DecodeError(f'Unexpected wire type {wire_type}')
+            if pos + size > len(buffer):
+                pos = start     # the rest of this field is in the next chunk
+                break
+            data = bytes(buffer[pos:pos + size])
+            pos += size
+            if number == HEADER and wire_type == 2:
+                header = gtfs_realtime_pb2.FeedHeader()
+                header.ParseFromString(data)
+                yield header, None
+            elif number == ENTITY and wire_type == 2:
+                entity = gtfs_realtime_pb2.FeedEntity()
+                entity.ParseFromString(data)
+                yield None, entity
+        del buffer[:pos]
+    if buffer:
+        raise DecodeError('The feed ended in the middle of a field')
+
+
+# Stable across processes, the trip update's own timestamp is left out
+# since it changes on every version even when the predictions don't
+def fingerprint(trip_update):
+    timestamp = trip_update.timestamp
+    trip_update.ClearField('timestamp')
+    digest = hashlib.blake2b(trip_update.SerializeToString(deterministic=True), digest_size=8)
+    trip_update.timestamp = timestamp
+    return int.from_bytes(digest.digest(), 'big', signed=True)
+
+
+class BatchWriter:
+    # Rows are written every BATCH_ROWS instead of being collected for the whole feed
+    def __init__(self, db, batch_rows=BATCH_ROWS):
+        self.db = db
+        self.batch_rows = batch_rows
+        self.trips, self.stop_times, self.vehicles = [], [], []
+        self.written = {'trips': 0, 'stop_times': 0, 'vehicles': 0}
+
+    def add_trip(self, row, stop_times):
+        self.trips.append(row)
+        self.stop_times.extend(stop_times)
+        if len(self.stop_times) >= self.batch_rows or len(self.trips) >= self.batch_rows:
+            self.flush_trips()
+
+    def add_vehicle(self, row):
+        self.vehicles.append(row)
+        if len(self.vehicles) >= self.batch_rows:
+            self.flush_vehicles()
+
+    def flush_trips(self):
+        if not self.trips:
+            return
+        # A changed trip's vector is replaced, stops that passed drop out of it
+        self.db.execute(
+            'DELETE FROM bus_stop_times WHERE trip_id IN (SELECT value FROM json_each(?))',
+            (json.dumps([row[0] for row in self.trips]),)
+        )
+        self.db.executemany(
+            """
+            INSERT INTO bus_trips
+            (trip_id, route_id, direction_id, start_date, vehicle_id, delay, timestamp, fingerprint, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(trip_id) DO UPDATE SET
+                route_id = excluded.route_id,
+                direction_id = excluded.direction_id,
+                start_date = excluded.start_date,
+                vehicle_id = excluded.vehicle_id,
+                delay = excluded.delay,
+                timestamp = excluded.timestamp,
+                fingerprint = excluded.fingerprint,
+                updated_at = excluded.updated_at
+            """,
+            self.trips
+        )
+        self.db.executemany(
+            'INSERT INTO bus_stop_times (trip_id, position, stop_id, arrival, departure)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            self.stop_times
+        )
+        self.written['trips'] += len(self.trips)
+        self.written['stop_times'] += len(self.stop_times)
+        self.trips, self.stop_times = [], []
+
+    def flush_vehicles(self):
+        if not self.vehicles:
+            return
+        self.db.executemany(
+            """
+            INSERT INTO bus_vehicles
+            (vehicle_id, trip_id, route_id, lat, lon, bearing, stop_id, status, timestamp, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(vehicle_id) DO UPDATE SET
+                trip_id = excluded.trip_id,
+                route_id = excluded.route_id,
+                lat = excluded.lat,
+                lon = excluded.lon,
+                bearing = excluded.bearing,
+                stop_id = excluded.stop_id,
+                status = excluded.status,
+                timestamp = excluded.timestamp,
+                updated_at = excluded.updated_at
+            """,
+            self.vehicles
+        )
+        self.written['vehicles'] += len(self.vehicles)
+        self.vehicles = []
+
+    def flush(self):
+        self.flush_trips()
+        self.flush_vehicles()
+
+
+# Delete the rows of trips or vehicles that are no longer in the feed, in batches
+def delete_missing(db, table, column, ids, batch_rows=BATCH_ROWS):
+    ids = list(ids)
+    for start in range(0, len(ids), batch_rows):
+        batch = json.dumps(ids[start:start + batch_rows])
+        if table == 'bus_trips':
+            db.execute('DELETE FROM bus_stop_times WHERE trip_id IN (SELECT value FROM json_each(?))', (batch,))
+        db.execute(f'DELETE FROM {table} WHERE {column} IN (SELECT value FROM json_each(?))', (batch,))
+
+
+# Ingest one version of a bus feed from its serialized chunks
+# Returns None when the header says it was already ingested
+def ingest_bus_chunks(db, chunks, state, batch_rows=BATCH_ROWS):
+    now = int(time.time())
+    started = time.perf_counter()
+    entities = iter_feed(chunks)
+    trips, vehicles = {}, {}
+    writer = BatchWriter(db, batch_rows)
+    count = 0
+    version = None
+    if not state.loaded:
+        load_state(db, state)
+    with db:
+        for header, entity in entities:
+            if header is not None:
+                if header.timestamp and header.timestamp == state.version:
+                    return None
+                version = header.timestamp
+                continue
+            count += 1
+            if entity.HasField('trip_update'):
+                update = entity.trip_update
+                trip_id = update.trip.trip_id
+                if trip_id in trips:
+                    continue        # the first update of a trip wins
+                trips[trip_id] = fingerprint(update)
+                if state.trips.get(trip_id) != trips[trip_id]:
+                    writer.add_trip(
+                        (trip_id, update.trip.route_id, update.trip.direction_id, update.trip.start_date,
+                         update.vehicle.id or None, update.delay if update.HasField('delay') else None,
+                         update.timestamp or None, trips[trip_id], now),
+                        [(trip_id, position, stop.stop_id,
+                          stop.arrival.time or None, stop.departure.time or None)
+                         for position, stop in enumerate(update.stop_time_update)]
+                    )
+            if entity.HasField('vehicle'):
+                vehicle = entity.vehicle
+                vehicle_id = vehicle.vehicle.id or entity.id
+                vehicles[vehicle_id] = vehicle.timestamp
+                if state.vehicles.get(vehicle_id) != vehicle.timestamp:
+                    position = vehicle.position
+                    writer.add_vehicle((
+                        vehicle_id, vehicle.trip.trip_id or None, vehicle.trip.route_id or None,
+                        position.latitude, position.longitude,
+                        position.bearing if position.HasField('bearing') else None,
+                        vehicle.stop_id or None, vehicle.current_status, vehicle.timestamp or None, now,
+                    ))
+        writer.flush()
+        # A feed of only vehicles says nothing about trips, and the other way around
+        removed_trips = [trip_id for trip_id in state.trips if trip_id not in trips] if trips else []
+        removed_vehicles = [vehicle_id for vehicle_id in state.vehicles if vehicle_id not in vehicles] if vehicles else []
+        delete_missing(db, 'bus_trips', 'trip_id', removed_trips, batch_rows)
+        delete_missing(db, 'bus_vehicles', 'vehicle_id', removed_vehicles, batch_rows)
+    # Only remembered once committed
+    if trips:
+        state.trips = trips
+    if vehicles:
+        state.vehicles = vehicles
+    state.version = version
+    return {
+        'entities': count,
+        **writer.written,
+        'removed_trips': len(removed_trips),
+        'removed_vehicles': len(removed_vehicles),
+        'elapsed': round(time.perf_counter() - started, 3),
+    }
+
+
+# Fetch and ingest one bus feed, name is what gets logged (the url has the key)
+def ingest_bus_feed(db, url, name):
+    state = get_state(name)
+    with http_client.get(url, timeout=TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        stats = ingest_bus_chunks(db, response.iter_content(CHUNK_SIZE), state)
+    if stats is None:
+        print(f"{name}: unchanged")
+    else:
+        print(f"{name}: {stats['entities']} entities, {stats['trips']} trips"
+              f" ({stats['stop_times']} stop times) and {stats['vehicles']} vehicles written,"
+              f" {stats['removed_trips']} trips and {stats['removed_vehicles']} vehicles gone"
+              f" in {stats['elapsed']:.2f} s")
+    return stats
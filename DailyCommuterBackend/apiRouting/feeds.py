@@ -0,0 +1,263 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import requests
+from DailyCommuterBackend.apiRouting.http_client import http_client
+from google.protobuf.message import DecodeError
+from google.transit import gtfs_realtime_pb2
+
+
+'''
+Acquisition of the GTFS-RT feeds
+
+There is one FeedSource per url, shared by everything that reads that feed.
+A fetch is a conditional GET (If-None-Match/If-Modified-Since) with a timeout,
+gzip, and a cap on how many bytes we are willing to buffer. When the MTA does
+send a body we read only the feed header first, so every version of a feed is
+parsed exactly once. The parsed feed is wrapped in a FeedSnapshot and handed
+to every subscriber of the source, treat snapshot.feed as read-only since the
+same object goes to all of them.
+
+FeedPoller fetches a group of sources at the same time on a small thread pool,
+so a full refresh takes about as long as the slowest feed, then publishes the
+new snapshots to the subscribers on the calling thread (which has the app
+context the db needs).
+
+A new version only becomes the source's state (validators, version, feed)
+once every subscriber took it. When one raises, the next poll downloads and
+publishes the same version again, and the error is on the FeedResult.
+'''
+
+
+# Status of a single feed after a fetch
+UPDATED = 'updated'            # new data, parsed and ready to ingest
+NOT_MODIFIED = 'not_modified'  # server answered 304
+UNCHANGED = 'unchanged'        # body came back but the feed version is the same
+FAILED = 'failed'              # network error, bad status code or bad body
+
+DEFAULT_TIMEOUT = (5, 20)               # connect, read (seconds)
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024    # subway feeds are a few MB
+CHUNK_SIZE = 64 * 1024
+
+
+class FeedTooLargeError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class FeedSnapshot:
+    url: str
+    version: object         # header timestamp, or a hash of the body without one
+    feed: object            # parsed FeedMessage, shared by every subscriber
+    fetched_at: float
+
+
+@dataclass
+class FeedState:
+    etag: str = None
+    last_modified: str = None
+    timestamp: int = None   # header timestamp of the last feed we parsed
+    feed: object = None     # last parsed FeedMessage
+    snapshot: FeedSnapshot = None
+    polled_at: float = None
+    updated_at: float = None
+
+
+@dataclass
+class FeedResult:
+    url: str
+    status: str
+    feed: object = None
+    elapsed: float = 0.0
+    snapshot: FeedSnapshot = None
+    etag: str = None            # validators of an UPDATED body, kept by commit()
+    last_modified: str = None
+    error: str = None           # why a subscriber refused the new version
+
+
+# Read the header timestamp of a serialized FeedMessage without parsing
+# the (much larger) list of entities that follows it
+def peek_header_timestamp(content):
+    # The header is field 1 (tag 0x0A) and is always serialized first
+    if not content or content[0] != 0x0A:
+        return None
+    length, shift, pos = 0, 0, 1
+    while pos < len(content):
+        byte = content[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    header = gtfs_realtime_pb2.FeedHeader()
+    try:
+        header.ParseFromString(bytes(content[pos:pos + length]))
+    except DecodeError:
+        return None
+    return header.timestamp if header.HasField('timestamp') else None
+
+
+# GET a url into memory, refusing bodies bigger than max_bytes
+# Returns the response (with the body unread) and the body, None on a 304
+def download(url, headers=None, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES):
+    headers = {'Accept-Encoding': 'gzip', **(headers or {})}
+    with http_client.get(url, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code == 304:
+            return response, None
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and 'Content-Encoding' not in response.headers and int(length) > max_bytes:
+            raise FeedTooLargeError(f"{length} bytes is over the {max_bytes} byte limit")
+        body = bytearray()
+        # iter_content undoes the gzip for us, the cap is on the decoded size
+        for chunk in response.iter_content(CHUNK_SIZE):
+            body += chunk
+            if len(body) > max_bytes:
+                raise FeedTooLargeError(f"body is over the {max_bytes} byte limit")
+        return response, body
+
+
+class FeedSource:
+    def __init__(self, url, name=None, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES):
+        self.url = url
+        self.name = name or url     # what gets logged, keyed urls contain the key
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.state = FeedState()
+        self.subscribers = []
+        self._lock = threading.Lock()
+
+    # consumer(snapshot) is called once for every new version of the feed
+    def subscribe(self, consumer):
+        if consumer not in self.subscribers:
+            self.subscribers.append(consumer)
+
+    # Exceptions from a consumer reach the caller, the version isn't committed then
+    def publish(self, snapshot):
+        for consumer in self.subscribers:
+            consumer(snapshot)
+
+    # Keep an UPDATED result as the version we have
+    def commit(self, result):
+        with self._lock:
+            state = self.state
+            state.etag = result.etag
+            state.last_modified = result.last_modified
+            state.timestamp = result.feed.header.timestamp
+            state.feed = result.feed
+            state.snapshot = result.snapshot
+            state.updated_at = result.snapshot.fetched_at
+
+    # Fetch the feed, only parsing it when its version changed
+    # An UPDATED result isn't published or committed yet, see fetch()
+    def check(self):
+        with self._lock:
+            return self._fetch()
+
+    # Fetch the feed and hand a new version to the subscribers
+    def fetch(self):
+        result = self.check()
+        if result.status == UPDATED:
+            self.publish(result.snapshot)
+            self.commit(result)
+        return result
+
+    def _fetch(self):
+        state = self.state
+        started = time.perf_counter()
+        headers = {}
+        if state.etag:
+            headers['If-None-Match'] = state.etag
+        if state.last_modified:
+            headers['If-Modified-Since'] = state.last_modified
+
+        try:
+            response, content = download(self.url, headers, self.timeout, self.max_bytes)
+        except (requests.exceptions.RequestException, FeedTooLargeError) as e:
+            print(f"Failed to fetch {self.name}: {e}")
+            return FeedResult(self.url, FAILED, elapsed=time.perf_counter() - started)
+
+        state.polled_at = time.time()
+        if content is None:
+            return FeedResult(self.url, NOT_MODIFIED, state.feed,
+                              time.perf_counter() - started, state.snapshot)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+        version = peek_header_timestamp(content) or hashlib.sha1(content).hexdigest()
+        if state.snapshot is not None and version == state.snapshot.version:
+            # The validators are for the version we already have
+            state.etag, state.last_modified = etag, last_modified
+            return FeedResult(self.url, UNCHANGED, state.feed,
+                              time.perf_counter() - started, state.snapshot)
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        try:
+            feed.ParseFromString(bytes(content))
+        except DecodeError as e:
+            print(f"Failed to parse {self.name}: {e}")
+            return FeedResult(self.url, FAILED, elapsed=time.perf_counter() - started)
+
+        snapshot = FeedSnapshot(self.url, version, feed, state.polled_at)
+        return FeedResult(self.url, UPDATED, feed, time.perf_counter() - started, snapshot,
+                          etag, last_modified)
+
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+# The shared FeedSource for a url, created on first use
+def get_source(url, **kwargs):
+    with _sources_lock:
+        if url not in _sources:
+            _sources[url] = FeedSource(url, **kwargs)
+        return _sources[url]
+
+
+class FeedPoller:
+    def __init__(self, urls, max_workers=None, **source_kwargs):
+        self.sources = [get_source(url, **source_kwargs) for url in urls]
+        self.urls = [source.url for source in self.sources]
+        self.max_workers = max_workers or len(self.sources)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def states(self):
+        return {source.url: source.state for source in self.sources}
+
+    # Add a consumer to every feed in the group
+    def subscribe(self, consumer):
+        for source in self.sources:
+            source.subscribe(consumer)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='feed-poller'
+            )
+        return self._executor
+
+    # Fetch every feed concurrently, publish the new versions on this thread
+    # and return one FeedResult per url
+    # A version a subscriber failed on comes back FAILED with the error set
+    def poll(self):
+        with self._lock:
+            results = list(self._get_executor().map(FeedSource.check, self.sources))
+        for source, result in zip(self.sources, results):
+            if result.status != UPDATED:
+                continue
+            try:
+                source.publish(result.snapshot)
+            except Exception as e:
+                print(f"Failed to ingest {source.name}: {e}")
+                result.status = FAILED
+                result.error = f"{source.name}: {e}"
+            else:
+                source.commit(result)
+        return results
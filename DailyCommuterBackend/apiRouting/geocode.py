@@ -0,0 +1,111 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from DailyCommuterBackend.db import get_db
+
+
+'''
+Geocoding cache
+
+Addresses are normalized and looked up in an in-memory LRU first, then in
+the geocode_cache table, and only then sent to Nominatim. Concurrent lookups
+for the same address share one outbound call, and outbound calls go through
+a token bucket so only real cache misses are throttled (Nominatim allows
+about one request per second).
+'''
+
+
+# "370 Jay St., Brooklyn" and "370  jay st brooklyn" share a cache entry
+def normalize_address(address):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', address.lower()).split())
+
+
+class TokenBucket:
+    def __init__(self, rate=1.0, capacity=1):
+        self.rate = rate            # tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Block until a token is available
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GeocodeCache:
+    def __init__(self, max_size=10000, limiter=None):
+        self.max_size = max_size
+        self.limiter = limiter or TokenBucket()
+        self._entries = OrderedDict()   # key -> (lat, lon)
+        self._inflight = {}             # key -> Future shared by concurrent lookups
+        self._lock = threading.Lock()
+
+    def _remember(self, key, coords):
+        with self._lock:
+            self._entries[key] = coords
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _from_db(self, key):
+        row = get_db().execute(
+            'SELECT lat, lon FROM geocode_cache WHERE address_key = ?', (key,)
+        ).fetchone()
+        return (row['lat'], row['lon']) if row else None
+
+    def _to_db(self, key, address, coords):
+        db = get_db()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO geocode_cache (address_key, address, lat, lon, created_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (key, address, coords[0], coords[1], int(time.time()))
+            )
+
+    # Return (lat, lon) for an address, calling fetch(address) only on a miss
+    def lookup(self, address, fetch):
+        key = normalize_address(address)
+        with self._lock:
+            coords = self._entries.get(key)
+            if coords is not None:
+                self._entries.move_to_end(key)
+                return coords
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        # Somebody else is already looking this address up
+        if not owner:
+            return future.result()
+
+        try:
+            coords = self._from_db(key)
+            if coords is None:
+                self.limiter.acquire()
+                coords = fetch(address)
+                self._to_db(key, address, coords)
+            self._remember(key, coords)
+            future.set_result(coords)
+            return coords
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+geocode_cache = GeocodeCache()
@@ -0,0 +1,200 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+
+'''
+Shared client for every outbound HTTP call (MTA feeds, Transit, Nominatim,
+Photon, the notification sink)
+
+All threads send through one HTTPAdapter, so there is one urllib3 pool per
+host for the whole process and a call to a host we talked to recently reuses
+a kept-alive connection instead of paying a new TLS handshake. Each thread
+still has its own requests.Session, since a Session isn't thread-safe.
+
+Every call has a (connect, read) timeout, DEFAULT_TIMEOUT unless the caller
+passes one. GET and HEAD are retried up to RETRIES times on connection
+errors, timeouts and RETRY_STATUSES, after a jittered exponential backoff
+(or the server's Retry-After when it sends one); anything else is only
+retried when the caller asks for it. At most HOST_LIMIT calls to the same
+host are in flight at once (HOST_LIMITS for the hosts that want another
+cap, set_host_limit for hosts only known from the config), the others wait;
+a streamed call holds its slot until the headers are in.
+
+Latency is recorded per endpoint (host and path, never the query which can
+hold keys) in a histogram of LATENCY_BUCKETS, see stats().
+'''
+
+
+DEFAULT_TIMEOUT = (5, 20)       # connect, read (seconds)
+RETRIES = 2
+RETRY_STATUSES = {429, 502, 503, 504}
+IDEMPOTENT = {'GET', 'HEAD'}
+BACKOFF_BASE = 0.5              # seconds, doubled on every retry
+BACKOFF_MAX = 10
+POOL_HOSTS = 32                 # hosts with a pool of kept-alive connections
+POOL_SIZE = 16                  # kept-alive connections per host
+HOST_LIMIT = 8                  # calls in flight per host
+HOST_LIMITS = {
+    'nominatim.openstreetmap.org': 1,   # their usage policy allows one at a time
+}
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]    # ms, upper bounds
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # the last one is over buckets[-1]
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_ms = 0.0
+
+    def record(self, ms, error=False):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.calls += 1
+        self.errors += error
+        self.total_ms += ms
+
+    # Upper bound of the bucket the q-th quantile falls in, None when over the last one
+    def quantile(self, q):
+        if not self.calls:
+            return None
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.calls:
+                return self.buckets[position] if position < len(self.buckets) else None
+        return None
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'mean_ms': round(self.total_ms / self.calls, 1) if self.calls else None,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'buckets': {**{f'<={edge}': count for edge, count in zip(self.buckets, self.counts)},
+                        f'>{self.buckets[-1]}': self.counts[-1]},
+        }
+
+
+# Seconds the server asked us to wait in Retry-After, None when it didn't
+def retry_after(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=RETRIES, host_limit=HOST_LIMIT, host_limits=None,
+                 pool_hosts=POOL_HOSTS, pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.host_limit = host_limit
+        self.host_limits = dict(HOST_LIMITS if host_limits is None else host_limits)
+        # Retries are ours, urllib3's would hide them from the histograms
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=0)
+        self._local = threading.local()
+        self._hosts = {}            # host -> BoundedSemaphore
+        self._latency = {}          # endpoint -> LatencyHistogram
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+        return session
+
+    def _slot(self, host):
+        with self._lock:
+            slot = self._hosts.get(host)
+            if slot is None:
+                slot = self._hosts[host] = threading.BoundedSemaphore(self.host_limits.get(host, self.host_limit))
+            return slot
+
+    # Cap the calls in flight to host at limit, calls already in flight keep their slot
+    def set_host_limit(self, host, limit):
+        with self._lock:
+            self.host_limits[host] = limit
+            self._hosts[host] = threading.BoundedSemaphore(limit)
+
+    def _histogram(self, endpoint):
+        with self._lock:
+            histogram = self._latency.get(endpoint)
+            if histogram is None:
+                histogram = self._latency[endpoint] = LatencyHistogram()
+            return histogram
+
+    def _record(self, histogram, ms, error=False, retried=False):
+        with self._lock:
+            histogram.record(ms, error)
+            histogram.retries += retried
+
+    # Full jitter: anywhere between 0 and the exponential backoff of this attempt
+    def backoff(self, attempt, response=None):
+        wait = retry_after(response)
+        if wait is not None:
+            return min(wait, BACKOFF_MAX)
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    # requests.request with the shared pools, a timeout, retries and the host cap
+    # retries=None retries GET and HEAD only, pass a number to retry anything
+    def request(self, method, url, retries=None, **kwargs):
+        method = method.upper()
+        if retries is None:
+            retries = self.retries if method in IDEMPOTENT else 0
+        kwargs.setdefault('timeout', self.timeout)
+        parts = urlsplit(url)
+        histogram = self._histogram(f'{parts.netloc}{parts.path}')
+        slot = self._slot(parts.netloc)
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            response = None
+            try:
+                with slot:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._record(histogram, (time.perf_counter() - started) * 1000, True, attempt > 0)
+                if attempt >= retries:
+                    raise
+            else:
+                failed = response.status_code >= 500 or response.status_code == 429
+                self._record(histogram, (time.perf_counter() - started) * 1000, failed, attempt > 0)
+                if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                    return response
+                response.close()
+            time.sleep(self.backoff(attempt, response))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {endpoint: histogram.as_dict() for endpoint, histogram in sorted(self._latency.items())}
+
+
+http_client = HttpClient()
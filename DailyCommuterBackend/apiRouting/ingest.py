@@ -0,0 +1,221 @@
+import hashlib
+import json
+import threading
+import time
+
+
+'''
+Delta ingest of the train GTFS-RT feeds
+
+Consecutive versions of a feed are mostly identical, so every trip's vector
+of stop time updates is fingerprinted and compared with the previous version
+of the same feed (kept in memory in a FeedDiff, and in trip_update.fingerprint
+so a restart doesn't rewrite everything). Only new and changed trips are
+written, trips that dropped out of the feed are marked retired, and vehicle
+positions are only written when they moved. A vehicle whose trip isn't in
+this version of the feed goes on the newest row of its trip in the db, and
+is left out of the FeedDiff when there is none so it's tried again.
+
+All the rows are pulled out of the FeedMessage and deduped in memory first,
+then written with a handful of executemany calls inside one transaction.
+'''
+
+
+class FeedDiff:
+    def __init__(self):
+        self.trips = {}     # update_id -> fingerprint, as of the last ingest
+        self.vehicles = {}  # trip_id -> (timestmp, curr_stop_id)
+
+
+_diffs = {}
+_diffs_lock = threading.Lock()
+
+
+# The FeedDiff that remembers the previous version of a feed
+def get_diff(key):
+    with _diffs_lock:
+        return _diffs.setdefault(key, FeedDiff())
+
+
+# Stable across processes, unlike hash()
+def fingerprint(stops):
+    digest = hashlib.blake2b(digest_size=8)
+    for arrival, departure, stop_id, direction in stops:
+        digest.update(f'{stop_id}{direction}:{arrival}:{departure};'.encode())
+    return int.from_bytes(digest.digest(), 'big', signed=True)
+
+
+# Rows pulled out of a single FeedMessage, deduped by entity id
+def collect_rows(feed):
+    trips = {}      # update_id -> (update_id, trip_id, start_tm, start_dt, route_id)
+    stops = {}      # update_id -> [(arrival, departure, stop_id, direction), ...]
+    vehicles = {}   # trip_id -> (timestmp, curr_stop_id)
+    for entity in feed.entity:
+        if entity.HasField('trip_update') and entity.id not in trips:
+            trip = entity.trip_update.trip
+            trips[entity.id] = (entity.id, trip.trip_id, trip.start_time,
+                                trip.start_date, trip.route_id)
+            # The last character of the stop id is the direction (N/S),
+            # a stop listed twice keeps its last prediction
+            by_stop = {}
+            for update in entity.trip_update.stop_time_update:
+                stop_id, direction = update.stop_id[:-1], update.stop_id[-1:]
+                by_stop[(stop_id, direction)] = (update.arrival.time, update.departure.time,
+                                                 stop_id, direction)
+            stops[entity.id] = list(by_stop.values())
+        if entity.HasField('vehicle'):
+            vehicles.setdefault(entity.vehicle.trip.trip_id,
+                                (entity.vehicle.timestamp, entity.vehicle.stop_id))
+    return trips, stops, vehicles
+
+
+# Write only what changed since the previous version of the feed
+def write_rows(db, trips, stops, vehicles, diff):
+    now = int(time.time())
+    fingerprints = {update_id: fingerprint(stops[update_id]) for update_id in trips}
+
+    # Trips we haven't seen in this process yet are compared with the db
+    unknown = [update_id for update_id in trips if update_id not in diff.trips]
+    stored = {}
+    if unknown:
+        for update_id, stored_fingerprint, retired_at in db.execute(
+            'SELECT update_id, fingerprint, retired_at FROM trip_update'
+            ' WHERE update_id IN (SELECT value FROM json_each(?))',
+            (json.dumps(unknown),)
+        ):
+            # A retired trip that shows up again has to be written again
+            stored[update_id] = None if retired_at else stored_fingerprint
+
+    new_ids, changed_ids = [], []
+    for update_id in trips:
+        if update_id in diff.trips:
+            previous = diff.trips[update_id]
+        elif update_id in stored:
+            previous = stored[update_id]
+        else:
+            new_ids.append(update_id)
+            continue
+        if previous != fingerprints[update_id]:
+            changed_ids.append(update_id)
+    removed_ids = [update_id for update_id in diff.trips if update_id not in trips]
+    moved = [trip_id for trip_id, position in vehicles.items()
+             if diff.vehicles.get(trip_id) != position]
+
+    written_ids = new_ids + changed_ids
+    db.executemany(
+        """
+        INSERT INTO trip_update
+        (update_id, trip_id, start_tm, start_dt, route_id, fingerprint)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(update_id) DO UPDATE SET
+            trip_id = excluded.trip_id,
+            start_tm = excluded.start_tm,
+            start_dt = excluded.start_dt,
+            route_id = excluded.route_id,
+            fingerprint = excluded.fingerprint,
+            retired_at = NULL
+        """,
+        (trips[update_id] + (fingerprints[update_id],) for update_id in written_ids)
+    )
+
+    stop_rows = []
+    vehicle_rows = []
+    unwritten = set()
+    if written_ids or moved:
+        # One query for the row ids of every trip in this feed
+        row_ids = {}
+        trip_row_ids = {}
+        for row_id, update_id, trip_id in db.execute(
+            'SELECT id, update_id, trip_id FROM trip_update'
+            ' WHERE update_id IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(trips)),)
+        ):
+            row_ids[update_id] = row_id
+            trip_row_ids[trip_id] = row_id
+        # Vehicles whose trip update was in an earlier version of the feed
+        missing = [trip_id for trip_id in moved if trip_id not in trip_row_ids]
+        if missing:
+            trip_row_ids.update(db.execute(
+                'SELECT trip_id, MAX(id) FROM trip_update'
+                ' WHERE trip_id IN (SELECT value FROM json_each(?)) GROUP BY trip_id',
+                (json.dumps(missing),)
+            ).fetchall())
+
+        # Stops that already passed drop out of the vector, their rows are kept
+        stop_rows = [
+            (row_ids[update_id],) + stop
+            for update_id in written_ids
+            for stop in stops[update_id]
+        ]
+        db.executemany(
+            """
+            INSERT INTO stop_update
+            (trip_update_id, arrival, departure, stop_id, direction)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(trip_update_id, stop_id, direction) DO UPDATE SET
+                arrival = excluded.arrival,
+                departure = excluded.departure
+            WHERE arrival != excluded.arrival OR departure != excluded.departure
+            """,
+            stop_rows
+        )
+
+        vehicle_rows = [
+            (trip_row_ids[trip_id],) + vehicles[trip_id]
+            for trip_id in moved
+            if trip_id in trip_row_ids
+        ]
+        unwritten = {trip_id for trip_id in moved if trip_id not in trip_row_ids}
+        db.executemany(
+            """
+            INSERT INTO vehicle_update
+            (trip_update_id, timestmp, curr_stop_id)
+            VALUES (?, ?, ?)
+            """,
+            vehicle_rows
+        )
+
+    db.execute(
+        'UPDATE trip_update SET retired_at = ?'
+        ' WHERE update_id IN (SELECT value FROM json_each(?)) AND retired_at IS NULL',
+        (now, json.dumps(removed_ids))
+    )
+
+    counts = {
+        'new': len(new_ids),
+        'changed': len(changed_ids),
+        'unchanged': len(trips) - len(written_ids),
+        'removed': len(removed_ids),
+        'stops': len(stop_rows),
+        'vehicles': len(vehicle_rows),
+    }
+    positions = {trip_id: position for trip_id, position in vehicles.items() if trip_id not in unwritten}
+    return counts, fingerprints, positions
+
+
+# Ingest a whole feed and report how fast it went
+# diff remembers the previous version of this feed, without one every trip
+# is compared with the db and nothing is retired
+def ingest_feed(db, feed, diff=None):
+    diff = diff or FeedDiff()
+    started = time.perf_counter()
+    trips, stops, vehicles = collect_rows(feed)
+    with db:
+        counts, fingerprints, positions = write_rows(db, trips, stops, vehicles, diff)
+    # Only remember this version once it is committed
+    diff.trips = fingerprints
+    diff.vehicles = positions
+    elapsed = time.perf_counter() - started
+
+    entities = len(feed.entity)
+    stats = {
+        'entities': entities,
+        **counts,
+        'seconds': elapsed,
+        'entities_per_sec': entities / elapsed if elapsed else 0.0,
+    }
+    print(f"Ingested {entities} entities in {elapsed * 1000:.1f} ms"
+          f" ({stats['entities_per_sec']:.0f} entities/s):"
+          f" {counts['new']} new, {counts['changed']} changed,"
+          f" {counts['unchanged']} unchanged, {counts['removed']} removed trips")
+    return stats
@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+'''
+Cache for Transit OTP plans
+
+Plans are keyed by the start and end coordinates snapped to a ~100 m grid,
+the arrival time floored to a bucket and the service date. The request sent
+to OTP uses the snapped values too, so a cached plan is exactly what any
+other request in the same key would have gotten (arriving at the start of
+the bucket is never late for a later time in it).
+'''
+
+
+COORD_PRECISION = 3     # decimal places, about 110 m of latitude
+BUCKET_MINUTES = 5
+TIME_FORMATS = ['%H:%M', '%H:%M:%S', '%I:%M%p', '%I:%M %p', '%I%p', '%I %p']
+
+
+def snap_coord(lat, lon):
+    return round(lat, COORD_PRECISION), round(lon, COORD_PRECISION)
+
+
+# "9:07am" -> "09:05", times we can't parse are passed through untouched
+def bucket_time(arrival_time):
+    text = str(arrival_time).strip().upper()
+    for fmt in TIME_FORMATS:
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        minutes = parsed.hour * 60 + parsed.minute
+        minutes -= minutes % BUCKET_MINUTES
+        return f'{minutes // 60:02d}:{minutes % 60:02d}'
+    return arrival_time
+
+
+class PlanCache:
+    def __init__(self, max_size=1000, ttl=900):
+        self.max_size = max_size
+        self.ttl = ttl                  # seconds, plans go stale as service changes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (stored_at, plan)
+        self._lock = threading.Lock()
+
+    # since is a time.monotonic(), plans stored before it are a miss
+    def get(self, key, since=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            if since is not None and entry[0] < since:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, plan):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), plan)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+plan_cache = PlanCache()
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+
+'''
+Listing a user's saved routes
+
+Every user has a version number in route_list_version that is bumped in the
+same transaction as any change to their routes (see touch_user_routes). A
+listing page is cached under (userid, version, after, limit), so a changed
+version invalidates every cached page of that user, in every process, and
+the version doubles as the ETag.
+'''
+
+
+class ListingCache:
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+listing_cache = ListingCache()
+
+
+# Call inside the transaction that creates, updates or deletes a user's routes
+def touch_user_routes(db, userid):
+    db.execute(
+        'INSERT INTO route_list_version (userid, version) VALUES (?, 1)'
+        ' ON CONFLICT(userid) DO UPDATE SET version = version + 1',
+        (userid,)
+    )
+
+
+def get_routes_version(db, userid):
+    row = db.execute(
+        'SELECT version FROM route_list_version WHERE userid = ?', (userid,)
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def listing_etag(userid, version, limit, after):
+    return f'{userid}-{version}-{limit}-{after}'
+
+
+# One page of a user's routes, ordered by routeid
+# Pass the returned 'next_after' as `after` to get the next page
+def list_saved_routes(db, userid, limit=50, after=0, version=None):
+    if version is None:
+        version = get_routes_version(db, userid)
+    key = (userid, version, limit, after)
+    body = listing_cache.get(key)
+    if body is not None:
+        return body
+
+    rows = db.execute(
+        '''
+        SELECT routeid, route_name, start_address, end_address, arrival_time
+        FROM routes
+        WHERE userid = ? AND routeid > ?
+        ORDER BY routeid
+        LIMIT ?
+        ''',
+        (userid, after, limit + 1)
+    ).fetchall()
+    routes = [dict(row) for row in rows[:limit]]
+    body = {
+        'routes': routes,
+        'next_after': routes[-1]['routeid'] if len(rows) > limit else None,
+    }
+    listing_cache.put(key, body)
+    return body
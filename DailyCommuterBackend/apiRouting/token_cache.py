@@ -0,0 +1,177 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import firebase_admin
+import google.auth.transport.requests
+from firebase_admin import auth
+
+
+'''
+Cache for verified Firebase ID tokens
+
+auth.verify_id_token checks the JWT signature against Google's certs on
+every call. A session sends the same token with every request until it
+expires, so the decoded claims are kept, keyed by the SHA-256 of the token
+(the token itself is never stored), until the token's exp. The cache is an
+LRU bounded at max_size entries.
+
+revoke_user(uid) drops a user's cached tokens and refuses any token of
+theirs issued before that moment, even one that still verifies; call it
+wherever the user's sessions are ended. With end_sessions=True it also
+revokes their Firebase refresh tokens. A revocation is forgotten once
+MAX_TOKEN_LIFETIME has passed, every token it refuses has expired by then.
+
+warm_certs() goes through the SDK's own cert fetcher, which honors the
+certs' Cache-Control, so running it on a schedule refetches expired certs
+off the request path. The SDK doesn't expose that fetcher, so when it
+can't be found (a newer firebase_admin) this is logged and the certs are
+only fetched through google.auth's public transport, which still reports
+an unreachable cert endpoint.
+'''
+
+
+CERT_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+MAX_TOKEN_LIFETIME = 60 * 60    # seconds, Firebase ID tokens expire an hour after they're issued
+
+
+def token_key(id_token):
+    return hashlib.sha256(id_token.encode() if isinstance(id_token, str) else id_token).digest()
+
+
+class TokenCache:
+    def __init__(self, max_size=10000, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._entries = OrderedDict()   # token hash -> (exp, claims)
+        self._by_uid = {}               # uid -> {token hash, ...}
+        self._revoked = {}              # uid -> revoked at, tokens issued before are refused
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        _, claims = self._entries.pop(key)
+        keys = self._by_uid.get(claims['uid'])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_uid[claims['uid']]
+
+    # Claims of a token verified before and not expired yet, None otherwise
+    def get(self, id_token):
+        key = token_key(id_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self.clock():
+                self._drop(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def is_revoked(self, claims):
+        revoked_at = self._revoked.get(claims.get('uid'))
+        return revoked_at is not None and claims.get('iat', 0) < revoked_at
+
+    # Forget the revocations whose tokens have all expired
+    def _prune_revoked(self):
+        cutoff = self.clock() - MAX_TOKEN_LIFETIME
+        for uid in [uid for uid, revoked_at in self._revoked.items() if revoked_at < cutoff]:
+            del self._revoked[uid]
+
+    # Keep the claims of a freshly verified token, False when the user's tokens were revoked
+    def put(self, id_token, claims):
+        key = token_key(id_token)
+        with self._lock:
+            if self.is_revoked(claims):
+                return False
+            exp = claims.get('exp')
+            if not exp or exp <= self.clock() or 'uid' not in claims:
+                return True
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (exp, claims)
+            self._by_uid.setdefault(claims['uid'], set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+                self.evicted += 1
+            return True
+
+    # Forget a user's tokens and refuse the ones issued before now
+    def revoke(self, uid, at=None):
+        with self._lock:
+            self._prune_revoked()
+            self._revoked[uid] = int(at if at is not None else self.clock())
+            for key in list(self._by_uid.get(uid, ())):
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            self._prune_revoked()
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'revoked_users': len(self._revoked),
+            }
+
+
+token_cache = TokenCache()
+
+
+# The revocation hook, see the top of the file
+def revoke_user(uid, end_sessions=False):
+    token_cache.revoke(uid)
+    if end_sessions:
+        auth.revoke_refresh_tokens(uid)
+
+
+# verify_id_token's cert fetcher, kept on the app's auth client, None when it isn't there
+# Not part of the SDK's API, so every step is checked
+def sdk_cert_request(app):
+    try:
+        client = auth._get_client(app)
+    except AttributeError:
+        return None
+    return getattr(getattr(client, '_token_verifier', None), 'request', None)
+
+
+_warned = False
+
+
+# Fetch Google's signing certs through the SDK's cert fetcher when its copy
+# has expired, so the next verify_id_token doesn't wait for them
+# Returns whether the SDK's copy was warmed
+def warm_certs():
+    global _warned
+    try:
+        app = firebase_admin.get_app()
+    except ValueError:
+        return False    # Firebase isn't set up in this process
+    request = sdk_cert_request(app)
+    warmed = request is not None
+    if not warmed:
+        if not _warned:
+            print("The Firebase SDK's cert fetcher wasn't found, the certs are fetched without warming its copy")
+            _warned = True
+        request = google.auth.transport.requests.Request()
+    response = request(CERT_URL, method='GET')
+    if response.status != 200:
+        raise RuntimeError(f"Fetching the Firebase signing certs answered {response.status}")
+    return warmed
@@ -0,0 +1,110 @@
+import threading
+import time
+import numpy as np
+
+
+'''
+In-memory index of upcoming train arrivals
+
+Keyed by (stop_id, direction) the same way update_trains splits the GTFS stop
+id (e.g. "A28S" -> ("A28", "S")). Each key holds a sorted array of arrival
+epochs and the matching route ids, so the next N arrivals are a binary search
+and a slice. The index is rebuilt from the parsed feeds after every refresh
+and swapped in with a single assignment, requests never see a half-built one.
+A process that doesn't poll the feeds (web workers next to a separate
+run-scheduler) builds it from stop_update instead, at most INDEX_TTL seconds
+old, like the alerts and outage indexes.
+'''
+
+
+INDEX_TTL = 30
+
+
+class ArrivalsIndex:
+    def __init__(self, entries=None, built_at=None):
+        # (stop_id, direction) -> (arrival epochs, route ids), both sorted by arrival
+        self.entries = entries or {}
+        self.built_at = built_at
+
+    # Build a new index from a list of FeedMessages
+    @classmethod
+    def from_feeds(cls, feeds):
+        rows = []
+        for feed in feeds:
+            for entity in feed.entity:
+                if not entity.HasField('trip_update'):
+                    continue
+                route_id = entity.trip_update.trip.route_id
+                for update in entity.trip_update.stop_time_update:
+                    arrival = update.arrival.time or update.departure.time
+                    if not arrival or not update.stop_id:
+                        continue
+                    rows.append((update.stop_id[:-1], update.stop_id[-1:], arrival, route_id))
+        return cls.from_rows(rows)
+
+    # Build a new index from what the ingest stored, for processes that
+    # don't poll the feeds themselves (the scheduler runs in its own process)
+    @classmethod
+    def from_db(cls, db, now=None):
+        now = int(time.time() if now is None else now)
+        return cls.from_rows(db.execute(
+            'SELECT s.stop_id, s.direction, COALESCE(NULLIF(s.arrival, 0), s.departure), t.route_id'
+            ' FROM stop_update s JOIN trip_update t ON t.id = s.trip_update_id'
+            ' WHERE t.retired_at IS NULL AND COALESCE(NULLIF(s.arrival, 0), s.departure) >= ?',
+            (now - INDEX_TTL,)
+        ))
+
+    # rows: [(stop_id, direction, arrival, route_id), ...]
+    @classmethod
+    def from_rows(cls, rows):
+        grouped = {}
+        for stop_id, direction, arrival, route_id in rows:
+            if arrival:
+                grouped.setdefault((stop_id, direction), []).append((arrival, route_id))
+
+        entries = {}
+        for key, rows in grouped.items():
+            rows.sort()
+            arrivals = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            routes = np.array([row[1] for row in rows], dtype=object)
+            entries[key] = (arrivals, routes)
+        return cls(entries, time.time())
+
+    # The next n arrivals at or after `now` for a stop and direction
+    def next_arrivals(self, stop_id, direction, n=5, now=None):
+        entry = self.entries.get((stop_id, direction))
+        if entry is None:
+            return []
+        arrivals, routes = entry
+        now = int(time.time() if now is None else now)
+        start = int(np.searchsorted(arrivals, now, side='left'))
+        return [
+            {'route_id': routes[i], 'arrival': int(arrivals[i])}
+            for i in range(start, min(start + n, len(arrivals)))
+        ]
+
+
+_index = ArrivalsIndex()
+_index_lock = threading.Lock()
+
+
+# The arrivals index for this process. The process running the scheduler
+# rebuilds it from the feeds after every refresh, any other process rebuilds
+# it from the db when it's older than INDEX_TTL
+def get_index(db=None):
+    global _index
+    if db is None:
+        return _index
+    with _index_lock:
+        if _index.built_at is None or time.time() - _index.built_at > INDEX_TTL:
+            _index = ArrivalsIndex.from_db(db)
+        return _index
+
+
+# Build the new index off to the side, then swap it in
+def rebuild(feeds):
+    global _index
+    index = ArrivalsIndex.from_feeds(feeds)
+    with _index_lock:
+        _index = index
+    return index
@@ -1,18 +1,32 @@
+import os
 import sqlite3
+import threading
 from datetime import datetime
+from urllib.parse import quote
 import click
 from flask import current_app, g
+from DailyCommuterBackend.migrations import apply_migrations, get_version, BUS_MIGRATIONS
 
 
 '''
 Functions for initialization and teardown of the app
+
+Connections are pooled per process (ConnectionPool): each db file has a
+pool of writer connections and DATABASE also a pool of read-only ones, all
+configured once when opened. An app context borrows at most one of each
+(g.db, g.read_db, g.bus_db) and close_db hands them back on teardown.
 '''
 
 
-# Register close_db and init_db_command with the Application
+POOL_SIZE = 8               # idle connections kept per pool, DB_POOL_SIZE overrides it
+CACHED_STATEMENTS = 256     # prepared statements kept per connection (sqlite3 default 128)
+
+
+# Register close_db, init_db_command and migrate_db_command with the Application
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
 
 
 # Initialize the db
@@ -22,6 +36,7 @@ def init_db():
 
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    apply_migrations(db)
 
 
 # Set up the command 'init-db' for the Flask CLI
@@ -32,6 +47,18 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+# Set up the command 'migrate-db' for the Flask CLI
+@click.command('migrate-db')
+def migrate_db_command():
+    """Apply pending schema migrations without dropping any data."""
+    db = get_db()
+    applied = apply_migrations(db)
+    if applied:
+        click.echo(f"Applied migrations {', '.join(map(str, applied))}.")
+    click.echo(f"Database is at version {get_version(db)}.")
+    click.echo(f"Bus database is at version {get_version(get_bus_db())}.")
+
+
 # Tell Python how to interpret timestamp values in the db
 sqlite3.register_converter(
     "timestamp", lambda v: datetime.fromisoformat(v.decode())
@@ -39,23 +66,162 @@ sqlite3.register_converter(
 
 
 # Connect the db with the running instance of the app and it receives a request
-# Establish a connection to the file pointed at by the DATABASE configuration key
+# The connection comes from the writer pool of the file pointed at by the
+# DATABASE configuration key and goes back to it on teardown
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row # act like a dict
-        # Enable foreign key support
-        g.db.execute('PRAGMA foreign_keys = ON;')
+        g.db = get_pool(current_app.config['DATABASE']).acquire()
 
     return g.db
 
 
-# Close the db when finished with the request
+# A read-only connection to DATABASE for paths that never write, from its own
+# pool so reads don't take connections the writers need
+# Falls back to get_db() until the file exists, a read-only open can't create it
+def get_read_db():
+    if 'read_db' not in g:
+        path = current_app.config['DATABASE']
+        if not os.path.exists(path):
+            return get_db()
+        g.read_db = get_pool(path, readonly=True).acquire()
+
+    return g.read_db
+
+
+# The bus realtime db (BUS_DATABASE), a separate file so bus ingest never
+# holds the lock the subway tables need, migrated when its pool opens the
+# first connection
+def get_bus_db():
+    if 'bus_db' not in g:
+        g.bus_db = get_pool(current_app.config['BUS_DATABASE'], migrations=BUS_MIGRATIONS).acquire()
+
+    return g.bus_db
+
+
+# Per-connection settings, journal_mode = WAL is set once by the migrations
+def configure_db(db):
+    # Enable foreign key support
+    db.execute('PRAGMA foreign_keys = ON;')
+    # Safe with WAL and much cheaper than a full sync on every commit
+    db.execute('PRAGMA synchronous = NORMAL;')
+    # Wait for the ingest writer instead of failing with "database is locked"
+    db.execute('PRAGMA busy_timeout = 5000;')
+    db.execute('PRAGMA temp_store = MEMORY;')
+    db.execute('PRAGMA cache_size = -16000;')   # 16 MB
+    db.execute('PRAGMA mmap_size = 268435456;') # 256 MB
+
+
+class ConnectionPool:
+    # Idle connections to one db file, opened and configured once and reused
+    # by every app context of this process (check_same_thread is off so a
+    # connection can move between request threads, only one uses it at a time)
+    # Up to size idle connections are kept, more are opened when busy and
+    # closed once they come back
+    def __init__(self, path, readonly=False, size=POOL_SIZE, migrations=None):
+        self.path = path
+        self.readonly = readonly
+        self.size = size
+        self.migrations = migrations
+        self.opened = 0
+        self.reused = 0
+        self._idle = []
+        self._migrated = False
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self.readonly:
+            db = sqlite3.connect(
+                f'file:{quote(self.path)}?mode=ro', uri=True,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=CACHED_STATEMENTS,
+                check_same_thread=False
+            )
+        else:
+            db = sqlite3.connect(
+                self.path,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=CACHED_STATEMENTS,
+                check_same_thread=False
+            )
+        db.row_factory = sqlite3.Row # act like a dict
+        configure_db(db)
+        if self.migrations is not None and not self._migrated:
+            apply_migrations(db, migrations=self.migrations)
+            self._migrated = True
+        return db
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.opened += 1
+        return self.connect()
+
+    def release(self, db):
+        try:
+            # Whatever the request left uncommitted is not kept for the next one
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            db.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(db)
+                return
+        db.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            db.close()
+
+    def stats(self):
+        with self._lock:
+            return {'idle': len(self._idle), 'opened': self.opened, 'reused': self.reused}
+
+
+_pools = {}             # (path, readonly) -> ConnectionPool of this process
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(path, readonly=False, migrations=None):
+    global _pools, _pools_pid
+    with _pools_lock:
+        # Connections must not cross a fork, a forked worker opens its own
+        if _pools_pid != os.getpid():
+            _pools, _pools_pid = {}, os.getpid()
+        pool = _pools.get((path, readonly))
+        if pool is None:
+            size = current_app.config.get('DB_POOL_SIZE', POOL_SIZE)
+            pool = _pools[(path, readonly)] = ConnectionPool(path, readonly, size, migrations)
+        return pool
+
+
+# Close every idle connection and forget the pools, a connection still
+# borrowed goes back to a new pool
+def close_pools():
+    global _pools
+    with _pools_lock:
+        pools, _pools = list(_pools.values()), {}
+    for pool in pools:
+        pool.close()
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [{'path': pool.path, 'readonly': pool.readonly, **pool.stats()} for pool in pools]
+
+
+# Hand the db connections back to their pools when finished with the request
 def close_db(e=None):
-    db = g.pop('db', None)
+    for name, readonly in (('db', False), ('read_db', True), ('bus_db', False)):
+        db = g.pop(name, None)
 
-    if db is not None:
-        db.close()
\ No newline at end of file
+        if db is not None:
+            path = current_app.config['BUS_DATABASE' if name == 'bus_db' else 'DATABASE']
+            get_pool(path, readonly).release(db)
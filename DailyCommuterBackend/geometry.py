@@ -0,0 +1,83 @@
+import json
+
+
+'''
+Compact storage for the stops of a planned route
+
+A route's stops are stored as one route_geometry row: the coordinates as a
+Google encoded polyline (1e-5 degree precision, about 1 m), the stop names
+as a JSON array and the stop types as a string of digits, all in stop order.
+Stop types are 0 for the start, 1 for intermediate and 2 for the end.
+'''
+
+
+PRECISION = 1e5
+
+
+def _encode_value(value, out):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+# [(lat, lon), ...] -> "_p~iF~ps|U_ulLnnqC"
+def encode_polyline(coords):
+    out = []
+    prev_lat = prev_lon = 0
+    for lat, lon in coords:
+        lat, lon = round(lat * PRECISION), round(lon * PRECISION)
+        _encode_value(lat - prev_lat, out)
+        _encode_value(lon - prev_lon, out)
+        prev_lat, prev_lon = lat, lon
+    return ''.join(out)
+
+
+def decode_polyline(polyline):
+    coords = []
+    values = []
+    value = shift = 0
+    for char in polyline:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    lat = lon = 0
+    for i in range(0, len(values) - 1, 2):
+        lat += values[i]
+        lon += values[i + 1]
+        coords.append((lat / PRECISION, lon / PRECISION))
+    return coords
+
+
+# Store the stops of a route in a single statement
+# stops is the list of {'lat', 'lon', 'name', 'type'} dicts Router builds
+def save_route_stops(db, routeid, stops):
+    db.execute(
+        'INSERT OR REPLACE INTO route_geometry (routeid, polyline, names, types)'
+        ' VALUES (?, ?, ?, ?)',
+        (routeid,
+         encode_polyline((stop['lat'], stop['lon']) for stop in stops),
+         json.dumps([stop.get('name', '') for stop in stops]),
+         ''.join(str(stop['type']) for stop in stops),)
+    )
+
+
+def decode_stops(polyline, names, types):
+    names = json.loads(names)
+    return [
+        {'name': name, 'lat': lat, 'lon': lon, 'type': int(type)}
+        for (lat, lon), name, type in zip(decode_polyline(polyline), names, types)
+    ]
+
+
+# The stops of a route in order, or [] if it hasn't been planned yet
+def load_route_stops(db, routeid):
+    row = db.execute(
+        'SELECT polyline, names, types FROM route_geometry WHERE routeid = ?',
+        (routeid,)
+    ).fetchone()
+    return decode_stops(*row) if row else []
@@ -0,0 +1,259 @@
+import csv
+import io
+import itertools
+import operator
+import threading
+import time
+import zipfile
+from array import array
+from zoneinfo import ZoneInfo
+import click
+import numpy as np
+from DailyCommuterBackend.db import get_db, get_read_db
+from DailyCommuterBackend import stations
+
+
+'''
+Static GTFS for the subway
+
+'flask load-gtfs path/to/google_transit.zip' streams stops.txt, routes.txt,
+trips.txt, stop_times.txt and calendar.txt straight out of the zip (nothing
+is extracted) and writes them with chunked executemany, one transaction per
+file.
+
+Timetable keeps the whole schedule in flat int32 NumPy arrays (seconds past
+midnight, stop/trip indices) sorted by trip and stop sequence, plus a second
+ordering by stop and departure time, so schedule lookups never touch SQL.
+'''
+
+
+CHUNK_ROWS = 50000
+# agency_timezone of the MTA, schedule times and the MTA's local timestamps are in it
+TIMEZONE = ZoneInfo('America/New_York')
+
+
+# Rows of one file in the zip as tuples of the given columns, read lazily
+# Optional columns the file doesn't have come back as ''
+def read_zip_csv(archive, name, columns):
+    with archive.open(name) as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+        header = next(reader)
+        if all(column in header for column in columns):
+            # The common case, one C call a row
+            yield from map(operator.itemgetter(*(header.index(column) for column in columns)), reader)
+            return
+        positions = [header.index(column) if column in header else None for column in columns]
+        for row in reader:
+            yield tuple('' if i is None else row[i] for i in positions)
+
+
+# "25:10:00" -> 90600, GTFS times can run past midnight
+def parse_gtfs_time(value):
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def insert_chunks(db, sql, rows):
+    count = 0
+    with db:
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_ROWS))
+            if not chunk:
+                break
+            db.executemany(sql, chunk)
+            count += len(chunk)
+    return count
+
+
+def load_gtfs(db, path):
+    counts = {}
+    with zipfile.ZipFile(path) as archive:
+        # Children first so the foreign keys hold while we replace everything
+        with db:
+            db.execute('DELETE FROM subway_stop_times')
+            db.execute('DELETE FROM subway_trips')
+            db.execute('DELETE FROM subway_routes')
+            db.execute('DELETE FROM subway_calendar')
+
+        counts['stops'] = insert_chunks(db, '''
+            INSERT OR REPLACE INTO subway_stops (global_stop_id, parent_station_global_stop_id, route_type,
+                rt_stop_id, stop_lat, stop_lon, stop_name, wheelchair_boarding)
+            VALUES (?1, ?2, 1, ?1, ?3, ?4, ?5, NULLIF(?6, ''))
+            ''', read_zip_csv(archive, 'stops.txt', (
+                'stop_id', 'parent_station', 'stop_lat', 'stop_lon', 'stop_name', 'wheelchair_boarding'
+            )))
+        if 'calendar.txt' in archive.namelist():
+            counts['services'] = insert_chunks(db, '''
+                INSERT INTO subway_calendar (service_id, monday, tuesday, wednesday, thursday,
+                    friday, saturday, sunday, start_date, end_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', read_zip_csv(archive, 'calendar.txt', (
+                    'service_id', 'monday', 'tuesday', 'wednesday', 'thursday',
+                    'friday', 'saturday', 'sunday', 'start_date', 'end_date'
+                )))
+        counts['routes'] = insert_chunks(db, '''
+            INSERT INTO subway_routes (route_id, route_short_name, route_long_name, route_color)
+            VALUES (?, ?, ?, ?)
+            ''', read_zip_csv(archive, 'routes.txt', (
+                'route_id', 'route_short_name', 'route_long_name', 'route_color'
+            )))
+        counts['trips'] = insert_chunks(db, '''
+            INSERT INTO subway_trips (trip_id, route_id, service_id, trip_headsign, direction, shape_id)
+            VALUES (?, ?, ?, ?, COALESCE(NULLIF(?5, ''), 0), ?)
+            ''', read_zip_csv(archive, 'trips.txt', (
+                'trip_id', 'route_id', 'service_id', 'trip_headsign', 'direction_id', 'shape_id'
+            )))
+        # The column affinities turn the numeric strings into numbers, so the
+        # rows go from the csv reader to sqlite without a Python loop.
+        # The stop index is cheaper to build once at the end than row by row
+        db.execute('DROP INDEX IF EXISTS subway_stop_times_stop_id')
+        try:
+            counts['stop_times'] = insert_chunks(db, '''
+                INSERT INTO subway_stop_times (trip_id, stop_id, arrival_time, departure_time, stop_sequence)
+                VALUES (?, ?, ?, ?, ?)
+                ''', read_zip_csv(archive, 'stop_times.txt', (
+                    'trip_id', 'stop_id', 'arrival_time', 'departure_time', 'stop_sequence'
+                )))
+        finally:
+            with db:
+                db.execute('CREATE INDEX IF NOT EXISTS subway_stop_times_stop_id ON subway_stop_times (stop_id)')
+    return counts
+
+
+class Timetable:
+    def __init__(self, stop_ids, trip_ids, route_ids, service_ids, trip_route, trip_service,
+                 st_trip, st_stop, st_arrival, st_departure, st_sequence):
+        self.stop_ids = stop_ids            # index -> stop_id
+        self.trip_ids = trip_ids            # index -> trip_id
+        self.route_ids = route_ids          # index -> route_id
+        self.service_ids = service_ids      # index -> service_id
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+        self.trip_route = trip_route        # trip index -> route index
+        self.trip_service = trip_service    # trip index -> service index
+
+        # One entry per stop time, sorted by trip then stop sequence
+        self.st_trip = st_trip
+        self.st_stop = st_stop
+        self.st_arrival = st_arrival
+        self.st_departure = st_departure
+        self.st_sequence = st_sequence
+        # trip i's stop times are [trip_offsets[i], trip_offsets[i + 1])
+        self.trip_offsets = np.searchsorted(st_trip, np.arange(len(trip_ids) + 1)).astype(np.int32)
+
+        # The same stop times ordered by stop then departure
+        self.by_stop = np.lexsort((st_departure, st_stop)).astype(np.int32)
+        self.stop_offsets = np.searchsorted(
+            st_stop[self.by_stop], np.arange(len(stop_ids) + 1)
+        ).astype(np.int32)
+
+    def __len__(self):
+        return len(self.st_trip)
+
+    # Stream the schedule out of the db into typed arrays (4 bytes a value)
+    @classmethod
+    def from_db(cls, db):
+        trip_ids, route_ids, service_ids = [], [], []
+        route_index, service_index = {}, {}
+        trip_route, trip_service = array('i'), array('i')
+        for trip_id, route_id, service_id in db.execute(
+            'SELECT trip_id, route_id, service_id FROM subway_trips ORDER BY trip_id'
+        ):
+            trip_ids.append(trip_id)
+            trip_route.append(route_index.setdefault(route_id, len(route_index)))
+            trip_service.append(service_index.setdefault(service_id, len(service_index)))
+        route_ids = list(route_index)
+        service_ids = list(service_index)
+        trip_index = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+
+        stop_index = {}
+        seconds = {}    # a schedule only has a few thousand distinct times
+        columns = [array('i') for _ in range(5)]
+        st_trip, st_stop, st_arrival, st_departure, st_sequence = columns
+        for trip_id, stop_id, arrival, departure, sequence in db.execute(
+            'SELECT trip_id, stop_id, arrival_time, departure_time, stop_sequence'
+            ' FROM subway_stop_times ORDER BY trip_id, stop_sequence'
+        ):
+            if trip_id not in trip_index:
+                continue
+            st_trip.append(trip_index[trip_id])
+            st_stop.append(stop_index.setdefault(stop_id, len(stop_index)))
+            if arrival not in seconds:
+                seconds[arrival] = parse_gtfs_time(arrival)
+            if departure not in seconds:
+                seconds[departure] = parse_gtfs_time(departure)
+            st_arrival.append(seconds[arrival])
+            st_departure.append(seconds[departure])
+            st_sequence.append(sequence)
+
+        return cls(list(stop_index), trip_ids, route_ids, service_ids,
+                   np.frombuffer(trip_route, dtype=np.int32),
+                   np.frombuffer(trip_service, dtype=np.int32),
+                   *(np.frombuffer(column, dtype=np.int32) for column in columns))
+
+    # The stop times of one trip as (stop_id, arrival, departure) in order
+    def trip_stops(self, trip_id):
+        i = self.trip_index[trip_id]
+        start, end = self.trip_offsets[i], self.trip_offsets[i + 1]
+        return [
+            (self.stop_ids[self.st_stop[j]], int(self.st_arrival[j]), int(self.st_departure[j]))
+            for j in range(start, end)
+        ]
+
+    # The next scheduled departures from a stop at or after `seconds` past midnight
+    def departures(self, stop_id, seconds, limit=5):
+        i = self.stop_index.get(stop_id)
+        if i is None:
+            return []
+        rows = self.by_stop[self.stop_offsets[i]:self.stop_offsets[i + 1]]
+        start = int(np.searchsorted(self.st_departure[rows], seconds))
+        return [
+            (self.trip_ids[self.st_trip[j]],
+             self.route_ids[self.trip_route[self.st_trip[j]]],
+             int(self.st_departure[j]))
+            for j in rows[start:start + limit]
+        ]
+
+
+_timetable = None
+_timetable_lock = threading.Lock()
+
+
+# The timetable for this process, built from the db on first use
+# An empty one isn't kept, so a load from another process is picked up
+def get_timetable():
+    global _timetable
+    if _timetable is None:
+        with _timetable_lock:
+            if _timetable is None:
+                timetable = Timetable.from_db(get_read_db())
+                if not len(timetable):
+                    return timetable
+                _timetable = timetable
+    return _timetable
+
+
+def reload_timetable():
+    global _timetable
+    _timetable = Timetable.from_db(get_read_db())
+    return _timetable
+
+
+# Register load_gtfs_command with the Application
+def init_app(app):
+    app.cli.add_command(load_gtfs_command)
+
+
+# Set up the command 'load-gtfs' for the Flask CLI
+@click.command('load-gtfs')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def load_gtfs_command(path):
+    """Load a static subway GTFS zip into the db."""
+    started = time.perf_counter()
+    counts = load_gtfs(get_db(), path)
+    loaded = time.perf_counter()
+    timetable = reload_timetable()
+    stations.invalidate()
+    click.echo(', '.join(f'{count} {name}' for name, count in counts.items())
+               + f' loaded in {loaded - started:.1f} s,'
+               f' timetable of {len(timetable)} stop times built in {time.perf_counter() - loaded:.1f} s.')
@@ -7,8 +7,17 @@ from dotenv import load_dotenv
 import os
 # change whenever we change the name of the app
 from DailyCommuterBackend.auth import login_required
-from DailyCommuterBackend.db import get_db
-from DailyCommuterBackend.apiRouting.api import createRoute, Router
+from DailyCommuterBackend.db import get_db, get_read_db, pool_stats
+from DailyCommuterBackend.geometry import load_route_stops
+from DailyCommuterBackend.apiRouting.api import address_autocomplete, get_saved_routes
+from DailyCommuterBackend.apiRouting.saved_routes import get_routes_version, listing_etag
+from DailyCommuterBackend.apiRouting.plan_cache import plan_cache
+from DailyCommuterBackend.apiRouting.token_cache import token_cache
+from DailyCommuterBackend.apiRouting.http_client import http_client
+from DailyCommuterBackend.scheduler import get_feed_status
+from DailyCommuterBackend import alerts, arrivals, outages, stations
+from DailyCommuterBackend.models import Route
+from DailyCommuterBackend.jobs import enqueue_route_job, get_job, QueueFullError, DONE
 
 
 load_dotenv()
@@ -22,8 +31,7 @@ CORS(bp, resources={r"/*": {"origins": "http://localhost:5173"}})
 
 @bp.route('/')
 def index():
-    # Update the databases when the home page loads
-    # TODO implement updating the db at some interval (maybe every 2 minutes?)
+    # The realtime tables are kept fresh by the scheduler (flask run-scheduler)
     db = get_db()
     trip_update = db.execute(
         'SELECT *'
@@ -35,28 +43,148 @@ def index():
     return render_template('home/index.html', trip_update = trip_update)
 
 
+# How far behind each realtime feed is
+@bp.route('/feeds/status')
+def feed_status():
+    return jsonify(get_feed_status())
+
+
+# Hit and miss counts of the in-process caches and how often db connections were reused
+@bp.route('/caches/stats')
+def cache_stats():
+    return jsonify({'plans': plan_cache.stats(), 'tokens': token_cache.stats(), 'db': pool_stats()})
+
+
+# Latency histograms of the outbound HTTP calls, per endpoint
+@bp.route('/http/stats')
+def http_stats():
+    return jsonify(http_client.stats())
+
+
+# Next arrivals at a stop in one direction (N or S), e.g. /arrivals/A28/N?n=5
+# Served from the in-memory index, which the scheduler rebuilds after every
+# refresh or, in a process without the scheduler, is reloaded from the db
+@bp.route('/arrivals/<stop_id>/<direction>')
+def next_arrivals(stop_id, direction):
+    n = request.args.get('n', default=5, type=int)
+    index = arrivals.get_index(get_read_db())
+    return jsonify({
+        'stop_id': stop_id,
+        'direction': direction,
+        'built_at': index.built_at,
+        'arrivals': index.next_arrivals(stop_id, direction.upper(), n),
+    })
+
+
+# Service alerts active now, e.g. /alerts?stop=A28&route=A&route=C
+# Without stops or routes every active alert is returned
+@bp.route('/alerts')
+def active_alerts():
+    index = alerts.get_index(get_read_db())
+    return jsonify({
+        'built_at': index.built_at,
+        'alerts': index.active(request.args.getlist('stop'), request.args.getlist('route')),
+    })
+
+
+# Closest stations to a point, e.g. /stations/near?lat=40.69&lon=-73.98&k=3
+# or every station within a radius in meters with &radius=800
+# POST {"points": [[lat, lon], ...], "k": 3} answers many points at once
+@bp.route('/stations/near', methods=['GET', 'POST'])
+def stations_near():
+    index = stations.get_stations()
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        points = data.get('points') or []
+        k = max(1, min(int(data.get('k', 3)), 50))
+        if not points:
+            return jsonify({'stations': []})
+        try:
+            lats, lons = zip(*((float(lat), float(lon)) for lat, lon in points))
+        except (TypeError, ValueError):
+            abort(400)
+        positions, meters = index.index.nearest_batch(lats, lons, k)
+        return jsonify({'stations': [
+            [index.describe(i, m) for i, m in zip(row_positions.tolist(), row_meters.tolist())]
+            for row_positions, row_meters in zip(positions, meters)
+        ]})
+
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None:
+        abort(400)
+    radius = request.args.get('radius', type=float)
+    if radius is not None:
+        return jsonify({'stations': index.within(lat, lon, min(radius, 5000))})
+    k = max(1, min(request.args.get('k', default=5, type=int), 50))
+    return jsonify({'stations': index.nearest(lat, lon, k)})
+
+
+# Closest stations to the start and end of each of a user's saved routes
+@bp.route('/savedRoutes/<userid>/stations')
+def saved_route_stations(userid):
+    k = max(1, min(request.args.get('k', default=3, type=int), 10))
+    routes = [
+        Route(id=row['routeid'], start_lat=row['start_lat'], start_lon=row['start_lon'],
+              end_lat=row['end_lat'], end_lon=row['end_lon'])
+        for row in get_read_db().execute(
+            'SELECT routeid, start_lat, start_lon, end_lat, end_lon FROM routes'
+            ' WHERE userid = ? AND start_lat IS NOT NULL AND end_lat IS NOT NULL ORDER BY routeid',
+            (userid,)
+        )
+    ]
+    return jsonify({'routes': stations.get_stations().near_routes(routes, k)})
+
+
+# Elevator and escalator outages at a station now, e.g. /stations/A28/outages
+# with &upcoming=1 the planned ones are listed too
+@bp.route('/stations/<stop_id>/outages')
+def station_outages(stop_id):
+    index = outages.get_index(get_read_db())
+    return jsonify({
+        'built_at': index.built_at,
+        'stop_id': stop_id,
+        'outages': index.at_station(stop_id, upcoming=request.args.get('upcoming', default=0, type=int) == 1),
+    })
+
+
+# Whether each of a user's saved routes is step-free right now
+@bp.route('/savedRoutes/<userid>/stepFree')
+def saved_routes_step_free(userid):
+    return jsonify({'routes': outages.routes_step_free(get_read_db(), userid)})
+
+
+# Address suggestions for the new commute form, e.g. /autocomplete?q=370 Jay
+@bp.route('/autocomplete')
+def autocomplete():
+    return jsonify(address_autocomplete(request.args.get('q', '')))
+
+
 @bp.route('/displayroute/<routeid>')
 def map_view(routeid):
-    conn = get_db()
-    c = conn.cursor()
-    query = '''
-        SELECT name, lat, lon, type
-        FROM points
-        WHERE routeid = ?
-        ORDER BY type ASC
-    '''
-    c.execute(query, (routeid,))
-    rows = c.fetchall()
-    conn.close()
-
-    # Structure for the template
-    stops = [
-        {'name': name, 'lat': lat, 'lon': lon, 'type': type}
-        for name, lat, lon, type in rows
-    ]
+    # Stops come back in the order Router stored them
+    stops = load_route_stops(get_read_db(), routeid)
     return render_template('home/map.html', stops=stops, MAPBOX_TOKEN = MAPBOX_TOKEN)
 
 
+# A page of a user's saved routes, e.g. /savedRoutes/69?limit=20&after=123
+# Unchanged pages come back as 304 when the client sends If-None-Match
+@bp.route('/savedRoutes/<userid>')
+def saved_routes(userid):
+    limit = max(1, min(request.args.get('limit', default=50, type=int), 200))
+    after = request.args.get('after', default=0, type=int)
+    version = get_routes_version(get_read_db(), userid)
+    etag = listing_etag(userid, version, limit, after)
+    if etag in request.if_none_match:
+        return '', 304
+
+    response = jsonify(get_saved_routes(userid, limit, after))
+    response.set_etag(etag)
+    return response
+
+
+# Creating a route takes a few network calls, so the POST only queues a job
+# and answers 202 with where to poll, the job's status has the redirect_url once done
 @bp.route('/addRoute', methods=['GET', 'POST'])
 def createRouteForm():
     if request.method == 'POST':
@@ -67,15 +195,22 @@ def createRouteForm():
         userid = '69'  # placeholder user ID
 
         try:
-            print("before route created")
-            print(start_address, end_address, arriveby, userid)
-            newroute = createRoute(start_address, end_address, arriveby, userid)
-            print("route created")
-            Router(newroute)
-            return jsonify({"redirect_url": url_for('home.map_view', routeid=newroute.id)}), 200
-        except Exception as e:
-            return f"Error: {e}", 502
+            job_id = enqueue_route_job(start_address, end_address, arriveby, userid)
+        except QueueFullError as e:
+            return jsonify({"error": str(e)}), 503
+        return jsonify({
+            "job_id": job_id,
+            "status_url": url_for('home.route_job_status', job_id=job_id),
+        }), 202
     return render_template('addroute.html')
 
 
-
+# Poll a route creation job
+@bp.route('/addRoute/jobs/<job_id>')
+def route_job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+    if job['status'] == DONE:
+        job['redirect_url'] = url_for('home.map_view', routeid=job['routeid'])
+    return jsonify(job)
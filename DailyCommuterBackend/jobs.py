@@ -0,0 +1,138 @@
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from DailyCommuterBackend.db import get_db, get_read_db
+
+
+'''
+Background route creation
+
+POST /addRoute only inserts a route_jobs row and hands the job to a small
+worker pool, the geocoding and the OTP call happen off the request worker.
+The job row is the source of truth for its status, so any process can answer
+a poll. At most ROUTE_JOB_WORKERS jobs run at once and at most
+ROUTE_JOB_QUEUE wait, beyond that new jobs are refused.
+
+Jobs only live in the memory of the process that queued them, so on startup
+every queued or running row that hasn't moved in ROUTE_JOB_TIMEOUT seconds
+is marked failed, its worker is gone and the client would poll it forever.
+'''
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class RouteJobPool:
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def _setup(self, app):
+        with self._lock:
+            if self._executor is None:
+                workers = app.config.get('ROUTE_JOB_WORKERS', 4)
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='route-job')
+                self._slots = threading.BoundedSemaphore(workers + app.config.get('ROUTE_JOB_QUEUE', 64))
+
+    def submit(self, func, *args):
+        app = current_app._get_current_object()
+        self._setup(app)
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError("Too many routes are being created right now")
+
+        def run():
+            try:
+                with app.app_context():
+                    func(*args)
+            finally:
+                self._slots.release()
+
+        self._executor.submit(run)
+
+
+route_job_pool = RouteJobPool()
+
+
+def set_job_status(job_id, status, routeid=None, error=None):
+    db = get_db()
+    with db:
+        db.execute(
+            'UPDATE route_jobs SET status = ?, routeid = COALESCE(?, routeid), error = ?, updated_at = ?'
+            ' WHERE job_id = ?',
+            (status, routeid, error, int(time.time()), job_id)
+        )
+
+
+def run_route_job(job_id, start_address, end_address, arriveby, userid):
+    from DailyCommuterBackend.apiRouting.api import createRoute, Router
+    set_job_status(job_id, RUNNING)
+    try:
+        newroute = createRoute(start_address, end_address, arriveby, userid)
+        if newroute is None:
+            raise ValueError("Could not save the route")
+        result = Router(newroute)
+        # Router answers (response, status) when the planning request fails
+        if isinstance(result, tuple):
+            raise RuntimeError(result[0].get_json().get('error', 'Could not plan the route'))
+        set_job_status(job_id, DONE, routeid=newroute.id)
+    except Exception as e:
+        print(f"Route job {job_id} failed: {e}")
+        set_job_status(job_id, FAILED, error=str(e))
+
+
+# Record a new job and queue it, returns the job id
+def enqueue_route_job(start_address, end_address, arriveby, userid):
+    job_id = uuid.uuid4().hex
+    now = int(time.time())
+    db = get_db()
+    with db:
+        db.execute(
+            'INSERT INTO route_jobs (job_id, status, userid, created_at, updated_at)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (job_id, QUEUED, userid, now, now)
+        )
+    try:
+        route_job_pool.submit(run_route_job, job_id, start_address, end_address, arriveby, userid)
+    except QueueFullError as e:
+        set_job_status(job_id, FAILED, error=str(e))
+        raise
+    return job_id
+
+
+# Fail the jobs a stopped process left queued or running, returns how many
+def fail_stale_jobs(db, max_age, now=None):
+    now = int(time.time() if now is None else now)
+    with db:
+        return db.execute(
+            'UPDATE route_jobs SET status = ?, error = ?, updated_at = ?'
+            ' WHERE status IN (?, ?) AND updated_at < ?',
+            (FAILED, "The server restarted before the route was created", now,
+             QUEUED, RUNNING, now - max_age)
+        ).rowcount
+
+
+def init_app(app):
+    with app.app_context():
+        try:
+            fail_stale_jobs(get_db(), app.config.get('ROUTE_JOB_TIMEOUT', 300))
+        except sqlite3.OperationalError:
+            pass    # no route_jobs table until init-db or migrate-db ran
+
+
+def get_job(job_id):
+    row = get_read_db().execute(
+        'SELECT job_id, status, routeid, error, created_at, updated_at FROM route_jobs WHERE job_id = ?',
+        (job_id,)
+    ).fetchone()
+    return dict(row) if row else None
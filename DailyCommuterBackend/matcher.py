@@ -0,0 +1,251 @@
+import json
+import threading
+import time
+from array import array
+import click
+import numpy as np
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.alerts import stop_keys
+from DailyCommuterBackend.geometry import decode_stops
+from DailyCommuterBackend.stations import get_stations
+
+
+'''
+Matching alerts to the saved routes they affect
+
+Every planned route has one route_index row with the subway stations it
+stops at and the lines it rides (save_route_entities, called by Router).
+RouteMatcher inverts those rows in memory: for each station and each line
+a sorted NumPy array of routeids, stored CSR style (one array of routeids
+and one of offsets), so 100k routes with ~20 stations each fit in a few MB
+and a lookup is a dict hit and a slice.
+
+Routes indexed after the arrays were built live in a small overlay that is
+checked next to them, and once the overlay grows past OVERLAY_LIMIT the
+arrays are rebuilt. Before every match the matcher reads the route_index
+rows updated since its last look, so routes planned in another process
+are picked up too.
+
+When an alert feed changes, only the stations and lines of the alerts that
+changed are looked up and the routes found are queued in route_recalc_queue,
+where the 'recalc' scheduler job replans them.
+'''
+
+
+OVERLAY_LIMIT = 5000
+SUBWAY_AGENCIES = {None, '', 'MTASBWY', 'MTA NYCT'}
+STOP_MATCH_METERS = 75      # a route stop this close to a station is that station
+
+
+# Stations are indexed without the N/S platform suffix
+def station_key(stop_id):
+    stop_id = str(stop_id).rsplit(':', 1)[-1]     # OTP ids look like "MTASBWY:A28N"
+    return stop_keys(stop_id)[-1]
+
+
+def place_station(place, stations):
+    if place.get('stopId'):
+        return station_key(place['stopId'])
+    if stations is not None and place.get('lat') is not None:
+        near = stations.nearest(place['lat'], place['lon'], 1, STOP_MATCH_METERS)
+        if near:
+            return station_key(near[0]['stop_id'])
+    return None
+
+
+# Stations and lines of a planned itinerary (Transit's or planner.py's), and
+# the stations where it boards, transfers and alights (access)
+def plan_entities(itinerary, stations=None):
+    stops, routes, access = set(), set(), set()
+    for leg in itinerary.get('legs', []):
+        if leg.get('mode', 'WALK') == 'WALK':
+            continue
+        route = leg.get('routeShortName') or leg.get('route')
+        if isinstance(route, str) and route:
+            routes.add(route)
+        ends = [place_station(leg.get('from', {}), stations), place_station(leg.get('to', {}), stations)]
+        access.update(ends)
+        stops.update(ends)
+        stops.update(place_station(place, stations) for place in leg.get('intermediateStops', []))
+    stops.discard(None)
+    access.discard(None)
+    return sorted(stops), sorted(routes), sorted(access)
+
+
+# Replace a route's row in the index, call inside the transaction that saved its stops
+# access is None when only the stations it passes are known
+def save_route_entities(db, routeid, stops, routes, access=None):
+    db.execute(
+        'INSERT OR REPLACE INTO route_index (routeid, stops, routes, access, updated_at) VALUES (?, ?, ?, ?, ?)',
+        (routeid, json.dumps(list(stops)), json.dumps(list(routes)),
+         json.dumps(list(access)) if access is not None else None, int(time.time()))
+    )
+
+
+class RouteMatcher:
+    def __init__(self):
+        self.keys = {}                                  # ('stop'|'route', id) -> key number
+        self.offsets = np.zeros(1, dtype=np.int64)      # key k's routes are routeids[offsets[k]:offsets[k + 1]]
+        self.routeids = np.zeros(0, dtype=np.int32)
+        self.indexed = set()        # routeids in the arrays
+        self.max_routeid = 0
+        self.overlay = {}           # routeid -> set of keys, routes indexed after the arrays
+        self.seen_until = None      # updated_at of the newest route_index row read
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.indexed | self.overlay.keys())
+
+    @staticmethod
+    def entity_keys(stops, routes):
+        return {('stop', station_key(stop)) for stop in stops} | {('route', route) for route in routes}
+
+    # Build the arrays from every route_index row
+    def build(self, db):
+        started = int(time.time())
+        keys = {}
+        stop_numbers, route_numbers = {}, {}     # the same few hundred ids over and over
+        key_numbers, routeids = array('i'), array('i')
+        for routeid, stops, routes in db.execute('SELECT routeid, stops, routes FROM route_index'):
+            numbers = set()
+            for stop in json.loads(stops):
+                number = stop_numbers.get(stop)
+                if number is None:
+                    number = stop_numbers[stop] = keys.setdefault(('stop', station_key(stop)), len(keys))
+                numbers.add(number)
+            for route in json.loads(routes):
+                number = route_numbers.get(route)
+                if number is None:
+                    number = route_numbers[route] = keys.setdefault(('route', route), len(keys))
+                numbers.add(number)
+            key_numbers.extend(numbers)
+            routeids.extend([routeid] * len(numbers))
+        key_numbers = np.frombuffer(key_numbers, dtype=np.int32)
+        routeids = np.frombuffer(routeids, dtype=np.int32)
+        order = np.lexsort((routeids, key_numbers))
+        with self._lock:
+            self.keys = keys
+            self.routeids = routeids[order]
+            self.offsets = np.concatenate(([0], np.cumsum(np.bincount(key_numbers, minlength=len(keys)))))
+            self.indexed = set(np.unique(routeids).tolist())
+            self.max_routeid = int(routeids.max()) if len(routeids) else 0
+            self.overlay = {}
+            # Rows written while we were reading are read again by catch_up
+            self.seen_until = started - 1
+
+    # Read the route_index rows written since the last look
+    def catch_up(self, db):
+        if self.seen_until is None:
+            self.build(db)
+            return
+        newest = self.seen_until
+        rows = db.execute(
+            'SELECT routeid, stops, routes, updated_at FROM route_index WHERE updated_at >= ?',
+            (self.seen_until,)
+        ).fetchall()
+        with self._lock:
+            for routeid, stops, routes, updated_at in rows:
+                self.overlay[routeid] = self.entity_keys(json.loads(stops), json.loads(routes))
+                newest = max(newest, updated_at)
+            self.seen_until = newest
+            rebuild = len(self.overlay) > OVERLAY_LIMIT
+        if rebuild:
+            self.build(db)
+
+    # Sorted routeids of every route that stops at any of the stations or rides any of the lines
+    def affected(self, stops=(), routes=()):
+        keys = self.entity_keys(stops, routes)
+        with self._lock:
+            parts = [
+                self.routeids[self.offsets[k]:self.offsets[k + 1]]
+                for k in (self.keys.get(key) for key in keys) if k is not None
+            ]
+            # The union of the sorted slices as a bitmap over routeids,
+            # the overlay has the newest version of its routes
+            hit = np.zeros(max(self.max_routeid, max(self.overlay, default=0)) + 1, dtype=bool)
+            for part in parts:
+                hit[part] = True
+            if self.overlay:
+                hit[list(self.overlay)] = False
+                hit[[routeid for routeid, route_keys in self.overlay.items() if route_keys & keys]] = True
+        return np.flatnonzero(hit).tolist()
+
+
+matcher = RouteMatcher()
+
+
+# Queue the routes affected by changed alert entities for replanning,
+# entities is {(agency_id, route_id, stop_id), ...} from alerts.ingest_alerts
+def queue_affected_routes(db, entities, reason='alert'):
+    stops = {stop_id for agency_id, _, stop_id in entities if stop_id and agency_id in SUBWAY_AGENCIES}
+    routes = {route_id for agency_id, route_id, _ in entities if route_id and agency_id in SUBWAY_AGENCIES}
+    if not stops and not routes:
+        return []
+    matcher.catch_up(db)
+    routeids = matcher.affected(stops, routes)
+    now = int(time.time())
+    with db:
+        # A route already waiting keeps its place in the queue
+        db.executemany(
+            'INSERT INTO route_recalc_queue (routeid, reason, queued_at) VALUES (?, ?, ?)'
+            ' ON CONFLICT(routeid) DO NOTHING',
+            ((routeid, reason, now) for routeid in routeids)
+        )
+    return routeids
+
+
+# Take up to limit routeids off the front of the queue
+def pop_queued_routes(db, limit):
+    with db:
+        rows = db.execute(
+            'SELECT routeid FROM route_recalc_queue ORDER BY queued_at, routeid LIMIT ?', (limit,)
+        ).fetchall()
+        routeids = [row[0] for row in rows]
+        db.execute(
+            'DELETE FROM route_recalc_queue WHERE routeid IN (SELECT value FROM json_each(?))',
+            (json.dumps(routeids),)
+        )
+    return routeids
+
+
+# Put routes whose replan failed back at the end of the queue
+def requeue_routes(db, routeids, reason='retry'):
+    now = int(time.time())
+    with db:
+        db.executemany(
+            'INSERT INTO route_recalc_queue (routeid, reason, queued_at)'
+            ' SELECT routeid, ?, ? FROM routes WHERE routeid = ?'
+            ' ON CONFLICT(routeid) DO NOTHING',
+            ((reason, now, routeid) for routeid in routeids)
+        )
+
+
+# Index the planned routes that have no route_index row yet, from their stored stops
+def index_planned_routes(db, stations):
+    count = 0
+    rows = db.execute(
+        'SELECT g.routeid, g.polyline, g.names, g.types FROM route_geometry g'
+        ' WHERE NOT EXISTS (SELECT 1 FROM route_index i WHERE i.routeid = g.routeid)'
+    ).fetchall()
+    with db:
+        for routeid, polyline, names, types in rows:
+            stops = set()
+            for stop in decode_stops(polyline, names, types):
+                near = stations.nearest(stop['lat'], stop['lon'], 1, STOP_MATCH_METERS)
+                if near:
+                    stops.add(station_key(near[0]['stop_id']))
+            save_route_entities(db, routeid, sorted(stops), [])
+            count += 1
+    return count
+
+
+def init_app(app):
+    app.cli.add_command(index_routes_command)
+
+
+# Set up the command 'index-routes' for the Flask CLI
+@click.command('index-routes')
+def index_routes_command():
+    """Index the stations of routes planned before route_index existed."""
+    count = index_planned_routes(get_db(), get_stations())
+    click.echo(f'Indexed {count} routes.')
@@ -0,0 +1,330 @@
+from DailyCommuterBackend.geometry import save_route_stops
+
+
+'''
+Versioned schema migrations
+
+schema.sql is version 0. Every entry in MIGRATIONS upgrades the database by
+one version, and the current version is stored in PRAGMA user_version, so
+'flask migrate-db' only applies what is missing and never drops data.
+init-db runs all of them right after schema.sql.
+
+A migration is either a SQL script or a function that takes the connection.
+Append new ones at the end, never edit one that has shipped.
+
+The bus realtime tables live in their own file (BUS_DATABASE) so bus writes
+never lock the subway tables, BUS_MIGRATIONS is versioned the same way.
+'''
+
+
+# 4: one encoded geometry row per route instead of one points row per stop
+def store_route_geometry(db):
+    db.execute(
+        '''
+        CREATE TABLE route_geometry (
+            routeid INTEGER PRIMARY KEY,
+            polyline TEXT NOT NULL,  -- encoded polyline of the stops, in order
+            names TEXT NOT NULL,     -- JSON array of stop names
+            types TEXT NOT NULL,     -- one digit per stop: 0 start, 1 intermediate, 2 end
+            FOREIGN KEY (routeid) REFERENCES routes(routeid) ON DELETE CASCADE
+        )
+        '''
+    )
+    stops = {}
+    for row in db.execute('SELECT routeid, lat, lon, name, type FROM points ORDER BY routeid, pointid'):
+        stops.setdefault(row[0], []).append(
+            {'lat': row[1], 'lon': row[2], 'name': row[3] or '', 'type': row[4] or 0}
+        )
+    for routeid, route_stops in stops.items():
+        save_route_stops(db, routeid, route_stops)
+    db.execute('DROP TABLE points')
+
+
+MIGRATIONS = [
+    # 1: indexes for the lookups the app actually does
+    """
+    CREATE INDEX IF NOT EXISTS routes_userid ON routes (userid);
+    CREATE INDEX IF NOT EXISTS points_routeid ON points (routeid);
+    CREATE INDEX IF NOT EXISTS trip_update_route_id ON trip_update (route_id);
+    CREATE INDEX IF NOT EXISTS trip_update_trip_id ON trip_update (trip_id);
+    CREATE INDEX IF NOT EXISTS stop_update_stop ON stop_update (stop_id, direction, arrival);
+    CREATE INDEX IF NOT EXISTS stop_update_trip_update_id ON stop_update (trip_update_id);
+    CREATE INDEX IF NOT EXISTS vehicle_update_trip_update_id ON vehicle_update (trip_update_id);
+    CREATE INDEX IF NOT EXISTS subway_alerts_stop_id ON subway_alerts (stop_id);
+    CREATE INDEX IF NOT EXISTS subway_alerts_route_id ON subway_alerts (route_id);
+    """,
+    # 2: lets retention find expired stop updates without a full scan
+    """
+    CREATE INDEX IF NOT EXISTS stop_update_arrival ON stop_update (arrival);
+    """,
+    # 3: geocoding results keyed by normalized address
+    """
+    CREATE TABLE IF NOT EXISTS geocode_cache (
+        address_key TEXT PRIMARY KEY,
+        address TEXT NOT NULL,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL,
+        created_at INTEGER NOT NULL
+    );
+    """,
+    store_route_geometry,
+    # 5: bumped whenever a user's routes change, versions their cached listings
+    """
+    CREATE TABLE IF NOT EXISTS route_list_version (
+        userid TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    );
+    """,
+    # 6: background route creation jobs
+    """
+    CREATE TABLE IF NOT EXISTS route_jobs (
+        job_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        userid TEXT,
+        routeid INTEGER,
+        error TEXT,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS route_jobs_updated_at ON route_jobs (updated_at);
+    """,
+    # 7: delta ingest, one row per (trip, stop) updated in place
+    """
+    ALTER TABLE trip_update ADD COLUMN fingerprint INTEGER;
+    ALTER TABLE trip_update ADD COLUMN retired_at INTEGER;
+    DELETE FROM stop_update WHERE id NOT IN (
+        SELECT MAX(id) FROM stop_update GROUP BY trip_update_id, stop_id, direction
+    );
+    DROP INDEX IF EXISTS stop_update_trip_update_id;
+    CREATE UNIQUE INDEX stop_update_trip_stop ON stop_update (trip_update_id, stop_id, direction);
+    """,
+    # 8: static GTFS, subway_stop_times pointed its stop_id foreign key at a
+    # column subway_stops doesn't have and route_id was declared INTEGER,
+    # neither table could be loaded so they are recreated empty
+    """
+    DROP TABLE IF EXISTS subway_stop_times;
+    DROP TABLE IF EXISTS subway_trips;
+    CREATE TABLE subway_trips (
+        trip_id TEXT PRIMARY KEY,
+        route_id TEXT NOT NULL,
+        service_id TEXT NOT NULL,
+        trip_headsign TEXT NOT NULL,
+        direction INTEGER NOT NULL,
+        shape_id TEXT NOT NULL,
+        FOREIGN KEY (route_id) REFERENCES subway_routes(route_id)
+    );
+    CREATE TABLE subway_stop_times (
+        trip_id TEXT NOT NULL,
+        stop_id TEXT NOT NULL,
+        arrival_time TEXT NOT NULL,
+        departure_time TEXT NOT NULL,
+        stop_sequence INTEGER NOT NULL,
+        PRIMARY KEY (trip_id, stop_sequence),
+        FOREIGN KEY (trip_id) REFERENCES subway_trips(trip_id)
+    );
+    CREATE INDEX subway_trips_route_id ON subway_trips (route_id);
+    CREATE INDEX subway_stop_times_stop_id ON subway_stop_times (stop_id);
+    """,
+    # 9: which days each static GTFS service runs, for the local planner
+    """
+    CREATE TABLE IF NOT EXISTS subway_calendar (
+        service_id TEXT PRIMARY KEY,
+        monday INTEGER NOT NULL,
+        tuesday INTEGER NOT NULL,
+        wednesday INTEGER NOT NULL,
+        thursday INTEGER NOT NULL,
+        friday INTEGER NOT NULL,
+        saturday INTEGER NOT NULL,
+        sunday INTEGER NOT NULL,
+        start_date TEXT NOT NULL,
+        end_date TEXT NOT NULL
+    );
+    """,
+    # 10: service alerts upserted by id, replaces the never-filled subway_alerts
+    """
+    DROP TABLE IF EXISTS subway_alerts;
+    CREATE TABLE service_alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        feed TEXT NOT NULL,
+        alert_id TEXT NOT NULL,
+        fingerprint INTEGER NOT NULL,
+        header_text TEXT,
+        description_text TEXT,
+        effect INTEGER,
+        cause INTEGER,
+        updated_at INTEGER NOT NULL,
+        UNIQUE (feed, alert_id)
+    );
+    CREATE TABLE service_alert_entities (
+        id INTEGER PRIMARY KEY,
+        alert_row INTEGER NOT NULL,
+        agency_id TEXT,
+        route_id TEXT,
+        stop_id TEXT,
+        FOREIGN KEY (alert_row) REFERENCES service_alerts(id)
+    );
+    CREATE TABLE service_alert_periods (
+        id INTEGER PRIMARY KEY,
+        alert_row INTEGER NOT NULL,
+        start INTEGER NOT NULL,
+        end INTEGER,
+        FOREIGN KEY (alert_row) REFERENCES service_alerts(id)
+    );
+    CREATE INDEX service_alert_entities_alert_row ON service_alert_entities (alert_row);
+    CREATE INDEX service_alert_entities_stop_id ON service_alert_entities (stop_id);
+    CREATE INDEX service_alert_entities_route_id ON service_alert_entities (route_id);
+    CREATE INDEX service_alert_periods_alert_row ON service_alert_periods (alert_row);
+    """,
+    # 11: stations and lines of every planned route, and routes waiting to be replanned
+    """
+    CREATE TABLE IF NOT EXISTS route_index (
+        routeid INTEGER PRIMARY KEY,
+        stops TEXT NOT NULL,
+        routes TEXT NOT NULL,
+        updated_at INTEGER NOT NULL,
+        FOREIGN KEY (routeid) REFERENCES routes(routeid) ON DELETE CASCADE
+    );
+    CREATE INDEX IF NOT EXISTS route_index_updated_at ON route_index (updated_at);
+    CREATE TABLE IF NOT EXISTS route_recalc_queue (
+        routeid INTEGER PRIMARY KEY,
+        reason TEXT,
+        queued_at INTEGER NOT NULL,
+        FOREIGN KEY (routeid) REFERENCES routes(routeid) ON DELETE CASCADE
+    );
+    """,
+    # 12: notifications waiting to be sent, at most one per user
+    """
+    CREATE TABLE IF NOT EXISTS notification_queue (
+        userid TEXT PRIMARY KEY,
+        messages TEXT NOT NULL,
+        queued_at INTEGER NOT NULL,
+        due_at INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS notification_queue_due_at ON notification_queue (due_at);
+    """,
+    # 13: elevator and escalator outages, and the stations where a route boards and alights
+    """
+    ALTER TABLE route_index ADD COLUMN access TEXT;
+    CREATE TABLE IF NOT EXISTS elevator_equipment (
+        equipment_id TEXT PRIMARY KEY,
+        station TEXT,
+        equipment_type TEXT,
+        serving TEXT,
+        ada INTEGER NOT NULL DEFAULT 0,
+        active INTEGER NOT NULL DEFAULT 1,
+        updated_at INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS elevator_equipment_stops (
+        equipment_id TEXT NOT NULL,
+        stop_id TEXT NOT NULL,
+        PRIMARY KEY (equipment_id, stop_id)
+    );
+    CREATE INDEX IF NOT EXISTS elevator_equipment_stops_stop_id ON elevator_equipment_stops (stop_id);
+    CREATE TABLE IF NOT EXISTS elevator_outages (
+        id INTEGER PRIMARY KEY,
+        feed TEXT NOT NULL,
+        equipment_id TEXT NOT NULL,
+        stop_id TEXT,
+        station TEXT,
+        equipment_type TEXT,
+        serving TEXT,
+        ada INTEGER NOT NULL DEFAULT 0,
+        start INTEGER,
+        end INTEGER,
+        reason TEXT,
+        upcoming INTEGER NOT NULL DEFAULT 0,
+        maintenance INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS elevator_outages_feed ON elevator_outages (feed);
+    CREATE INDEX IF NOT EXISTS elevator_outages_stop_id ON elevator_outages (stop_id);
+    """,
+    # 14: feed_status was only ever in schema.sql, a database upgraded with
+    # migrate-db didn't have it
+    """
+    CREATE TABLE IF NOT EXISTS feed_status (
+        name TEXT PRIMARY KEY,
+        last_attempt INTEGER,
+        last_success INTEGER,
+        data_timestamp INTEGER,
+        failures INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT
+    );
+    """,
+    # 15: the estimate a route's owner last heard of, replans are compared with it
+    """
+    ALTER TABLE routes ADD COLUMN baselineTime INTEGER;
+    UPDATE routes SET baselineTime = estimateTime;
+    """,
+]
+
+
+BUS_MIGRATIONS = [
+    # 1: bus trip updates and vehicle positions
+    """
+    CREATE TABLE IF NOT EXISTS bus_trips (
+        trip_id TEXT PRIMARY KEY,
+        route_id TEXT,
+        direction_id INTEGER,
+        start_date TEXT,
+        vehicle_id TEXT,
+        delay INTEGER,
+        timestamp INTEGER,
+        fingerprint INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS bus_stop_times (
+        trip_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        stop_id TEXT NOT NULL,
+        arrival INTEGER,
+        departure INTEGER,
+        PRIMARY KEY (trip_id, position)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS bus_stop_times_stop_id ON bus_stop_times (stop_id, arrival);
+    CREATE TABLE IF NOT EXISTS bus_vehicles (
+        vehicle_id TEXT PRIMARY KEY,
+        trip_id TEXT,
+        route_id TEXT,
+        lat REAL,
+        lon REAL,
+        bearing REAL,
+        stop_id TEXT,
+        status INTEGER,
+        timestamp INTEGER,
+        updated_at INTEGER NOT NULL
+    );
+    """,
+]
+
+
+def get_version(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Apply every migration newer than the database's version, up to target
+# Returns the list of versions that were applied
+def apply_migrations(db, target=None, migrations=None):
+    # WAL lets the ingest writer and readers work at the same time,
+    # it is stored in the file so it only has to be set once
+    db.execute('PRAGMA journal_mode = WAL')
+
+    applied = []
+    for version, migration in enumerate(migrations or MIGRATIONS, start=1):
+        if version <= get_version(db):
+            continue
+        if target is not None and version > target:
+            break
+        # The migration and the version bump commit together
+        if callable(migration):
+            with db:
+                db.execute('BEGIN')
+                migration(db)
+                db.execute(f'PRAGMA user_version = {version}')
+        else:
+            db.executescript(
+                f'BEGIN; {migration}; PRAGMA user_version = {version}; COMMIT;'
+            )
+        applied.append(version)
+    return applied
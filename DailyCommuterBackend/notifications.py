@@ -0,0 +1,265 @@
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+from flask import current_app
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.apiRouting.http_client import http_client
+
+
+'''
+Notification fan-out
+
+When replanning routes after an alert makes them slower, each change is
+queued as a (userid, routeid, message) item. notification_queue holds at
+most one row per user: a user's messages are merged into their row (newest
+message per route wins) and the row is only sent COALESCE_SECONDS after its
+first message, so a disruption that hits five of someone's routes is one
+notification, not five.
+
+dispatch() takes the due rows off the queue, splits them into batches of
+BATCH_SIZE and hands the batches to the transport on a pool of WORKERS
+threads, so at most WORKERS requests are in flight. Notifications that fail
+go back into the queue with an exponential, jittered delay, and are dropped
+after MAX_ATTEMPTS. Rows are deleted when they are taken, so a process that
+dies while sending loses that round rather than sending it twice.
+
+A transport is anything with send(notifications) returning one error (or
+None) per notification; raising fails the whole batch. FileSink (JSON lines)
+and HttpSink (POSTs each batch to a URL) stand in for a push service, pick
+one with NOTIFY_SINK in the config. Each app has its own Dispatcher, in
+app.extensions['notifications'], shut down when the app goes away or the
+process exits.
+'''
+
+
+COALESCE_SECONDS = 60
+BATCH_SIZE = 500
+WORKERS = 4
+CLAIM_LIMIT = 20000         # rows taken off the queue per round
+MAX_ATTEMPTS = 5
+RETRY_SECONDS = 30          # doubled with every failed attempt
+MAX_RETRY_SECONDS = 3600
+DISPATCH_BUDGET = 50        # seconds a scheduled dispatch keeps going for
+
+
+@dataclass
+class Notification:
+    userid: str
+    messages: dict          # routeid (str) -> message
+    attempts: int = 0
+    queued_at: int = 0
+
+    @property
+    def title(self):
+        if len(self.messages) == 1:
+            return 'Your commute changed'
+        return f'{len(self.messages)} of your commutes changed'
+
+    @property
+    def body(self):
+        messages = [self.messages[routeid] for routeid in sorted(self.messages, key=int)]
+        if len(messages) <= 3:
+            return '\n'.join(messages)
+        return '\n'.join(messages[:3]) + f'\nand {len(messages) - 3} more'
+
+    def payload(self):
+        return {
+            'userid': self.userid,
+            'title': self.title,
+            'body': self.body,
+            'routes': sorted(int(routeid) for routeid in self.messages),
+        }
+
+
+# Queue (userid, routeid, message) items, merged per user with what is already waiting
+# A user's row keeps the due time of its first message, that's the coalescing window
+def enqueue(db, items, delay=COALESCE_SECONDS):
+    now = int(time.time())
+    by_user = {}
+    for userid, routeid, message in items:
+        by_user.setdefault(str(userid), {})[str(routeid)] = message
+    with db:
+        db.executemany(
+            """
+            INSERT INTO notification_queue (userid, messages, queued_at, due_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(userid) DO UPDATE SET
+                messages = json_patch(messages, excluded.messages)
+            """,
+            ((userid, json.dumps(messages), now, now + delay) for userid, messages in by_user.items())
+        )
+    return len(by_user)
+
+
+# Put failed notifications back, anything queued for the user since keeps its newer message
+def requeue(db, failed):
+    now = int(time.time())
+    with db:
+        db.executemany(
+            """
+            INSERT INTO notification_queue (userid, messages, queued_at, due_at, attempts, last_error)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(userid) DO UPDATE SET
+                messages = json_patch(excluded.messages, messages),
+                queued_at = MIN(queued_at, excluded.queued_at),
+                due_at = MIN(due_at, excluded.due_at),
+                attempts = MAX(attempts, excluded.attempts),
+                last_error = excluded.last_error
+            """,
+            ((n.userid, json.dumps(n.messages), n.queued_at, now + retry_delay(n.attempts), n.attempts, error)
+             for n, error in failed)
+        )
+
+
+def retry_delay(attempts):
+    delay = min(RETRY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_SECONDS)
+    return int(delay * random.uniform(0.5, 1.5))
+
+
+# Take up to limit due notifications off the queue
+def claim(db, limit=CLAIM_LIMIT):
+    now = int(time.time())
+    with db:
+        # Nobody else can claim the same rows between the select and the delete
+        db.execute('BEGIN IMMEDIATE')
+        rows = db.execute(
+            'SELECT userid, messages, attempts, queued_at FROM notification_queue'
+            ' WHERE due_at <= ? ORDER BY due_at LIMIT ?',
+            (now, limit)
+        ).fetchall()
+        db.execute(
+            'DELETE FROM notification_queue WHERE userid IN (SELECT value FROM json_each(?))',
+            (json.dumps([row[0] for row in rows]),)
+        )
+    return [Notification(userid, json.loads(messages), attempts, queued_at)
+            for userid, messages, attempts, queued_at in rows]
+
+
+class FileSink:
+    # One JSON line per notification
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, notifications):
+        lines = ''.join(json.dumps(n.payload()) + '\n' for n in notifications)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+        return [None] * len(notifications)
+
+
+class HttpSink:
+    # POSTs {"notifications": [...]} and accepts {"results": [{"error": ...}, ...]}
+    # back, any other 2xx answer means the whole batch was delivered
+    # The sink's host gets one slot per dispatcher worker instead of http_client's HOST_LIMIT
+    def __init__(self, url, timeout=10, workers=WORKERS):
+        self.url = url
+        self.timeout = timeout
+        http_client.set_host_limit(urlsplit(url).netloc, workers)
+
+    def send(self, notifications):
+        # Not retried here, a failed batch goes back to the queue with its own backoff
+        response = http_client.post(self.url, json={'notifications': [n.payload() for n in notifications]},
+                                    timeout=self.timeout, retries=0)
+        response.raise_for_status()
+        try:
+            results = response.json().get('results')
+        except ValueError:
+            results = None
+        if not isinstance(results, list) or len(results) != len(notifications):
+            return [None] * len(notifications)
+        return [result.get('error') if isinstance(result, dict) else None for result in results]
+
+
+class Dispatcher:
+    def __init__(self, transport, workers=WORKERS, batch_size=BATCH_SIZE):
+        self.transport = transport
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='notify')
+
+    def _send(self, batch):
+        try:
+            errors = self.transport.send(batch)
+        except Exception as e:
+            errors = [str(e)] * len(batch)
+        return list(zip(batch, errors))
+
+    # Send one round of due notifications, returns the counts of what happened
+    def dispatch(self, db, limit=CLAIM_LIMIT):
+        counts = {'sent': 0, 'retrying': 0, 'dropped': 0}
+        notifications = claim(db, limit)
+        if not notifications:
+            return counts
+        batches = [notifications[i:i + self.batch_size] for i in range(0, len(notifications), self.batch_size)]
+        failed = []
+        for results in self._executor.map(self._send, batches):
+            for notification, error in results:
+                if error is None:
+                    counts['sent'] += 1
+                    continue
+                notification.attempts += 1
+                if notification.attempts >= MAX_ATTEMPTS:
+                    counts['dropped'] += 1
+                    print(f"Dropping notification for {notification.userid}"
+                          f" after {notification.attempts} attempts: {error}")
+                else:
+                    failed.append((notification, error))
+        if failed:
+            requeue(db, failed)
+            counts['retrying'] = len(failed)
+        return counts
+
+    def close(self):
+        self._executor.shutdown()
+
+
+_dispatcher_lock = threading.Lock()
+
+
+# Transport for NOTIFY_SINK: an http(s) url, or else a file path
+# (default notifications.jsonl in the instance folder)
+def get_transport(app):
+    sink = app.config.get('NOTIFY_SINK') or os.path.join(app.instance_path, 'notifications.jsonl')
+    if sink.startswith(('http://', 'https://')):
+        return HttpSink(sink, workers=app.config.get('NOTIFY_WORKERS', WORKERS))
+    return FileSink(sink)
+
+
+# The current app's Dispatcher, built from its config on first use
+def get_dispatcher():
+    app = current_app._get_current_object()
+    with _dispatcher_lock:
+        dispatcher = app.extensions.get('notifications')
+        if dispatcher is None:
+            dispatcher = app.extensions['notifications'] = Dispatcher(
+                get_transport(app),
+                app.config.get('NOTIFY_WORKERS', WORKERS),
+                app.config.get('NOTIFY_BATCH_SIZE', BATCH_SIZE),
+            )
+            # Runs when the app is garbage collected, or else at exit
+            weakref.finalize(app, dispatcher.close)
+    return dispatcher
+
+
+# Send rounds of due notifications until none are left or DISPATCH_BUDGET runs out
+def dispatch_due():
+    dispatcher = get_dispatcher()
+    db = get_db()
+    totals = {'sent': 0, 'retrying': 0, 'dropped': 0}
+    started = time.monotonic()
+    while time.monotonic() - started < DISPATCH_BUDGET:
+        counts = dispatcher.dispatch(db)
+        for name, count in counts.items():
+            totals[name] += count
+        if not any(counts.values()):
+            break
+    if any(totals.values()):
+        print(f"Notifications: {totals['sent']} sent, {totals['retrying']} to retry, {totals['dropped']} dropped")
+    return totals
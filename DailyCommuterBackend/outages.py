@@ -0,0 +1,353 @@
+import codecs
+import itertools
+import json
+import re
+import threading
+import time
+from datetime import datetime
+from DailyCommuterBackend.apiRouting.http_client import http_client
+from DailyCommuterBackend.alerts import IntervalIndex, FOREVER, stop_keys
+from DailyCommuterBackend.gtfs_static import TIMEZONE
+
+
+'''
+Elevator and escalator outages
+
+The MTA publishes three JSON documents (elev_escal_json_urls): the outages
+now, the planned ones, and the list of every elevator and escalator. Each is
+one big array, so it is parsed an item at a time as the body arrives
+(iter_json_array) and the rows are written with executemany straight from
+that stream; at no point is a whole document held in memory.
+
+Equipment and outages are normalized to subway_stops: an elevator lists the
+GTFS stations it serves, and when it doesn't (or it isn't in the equipment
+list) the station name is used if exactly one station has it. Every version
+of a document replaces the previous one.
+
+OutageIndex is the read side: the outages of each station, an IntervalIndex
+over the periods of the planned ones (a current outage is out until the
+feed stops listing it, whatever its estimated return), plus the stations
+that have an ADA elevator at all, so "is this route step-free now" is a few
+dict lookups.
+It is rebuilt after every ingest in that process and at most INDEX_TTL
+seconds after one in another process.
+'''
+
+
+INDEX_TTL = 60
+CHUNK_BYTES = 64 * 1024
+TIMEOUT = (5, 30)       # connect, read
+EQUIPMENT = 'equipment'
+CURRENT = 'current'
+UPCOMING = 'upcoming'
+SEPARATORS = re.compile(r'[ \t\r\n,]*')
+ITEM_END = ' \t\r\n,]'
+MAX_ITEM_CHARS = 1024 * 1024    # an item that long is a broken document
+TOKEN_CHARS = 8                 # a token cut by a chunk boundary fails this close to the end
+
+
+# Items of a top-level JSON array, decoded from byte chunks as they arrive
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer, pos = '', 0
+    opened = False
+    # One more round once the chunks ran out, for an item at the very end
+    for chunk, ended in itertools.chain(((chunk, False) for chunk in chunks), [(b'', True)]):
+        # Only the unparsed tail is kept between chunks
+        buffer = buffer[pos:] + utf8.decode(chunk, final=ended)
+        pos = 0
+        if not opened:
+            buffer = buffer.lstrip()
+            if not buffer:
+                continue
+            if buffer[0] != '[':
+                raise ValueError('Expected a JSON array')
+            opened = True
+            pos = 1
+        while True:
+            pos = SEPARATORS.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                # Input that ran out fails at the end of the buffer, or inside a
+                # string that isn't closed yet, anywhere else the item is broken
+                if e.pos < len(buffer) - TOKEN_CHARS and not e.msg.startswith('Unterminated string'):
+                    raise ValueError(f'Malformed item in the JSON array: {e}') from None
+                if len(buffer) - pos > MAX_ITEM_CHARS:
+                    raise ValueError('An item of the JSON array is too long') from None
+                break       # the item goes on in the next chunk
+            # A number that reaches the end of the buffer ("12" of "1234") or stops
+            # just short of it ("1.5" of "1.5e3") may go on in the next chunk
+            if end == len(buffer) or buffer[end] not in ITEM_END:
+                if not ended and end >= len(buffer) - TOKEN_CHARS:
+                    break
+                if end < len(buffer):
+                    raise ValueError(f'Malformed item in the JSON array at {end}')
+            pos = end
+            yield item
+    raise ValueError('The JSON array ended early')
+
+
+def field(item, *names):
+    for name in names:
+        value = item.get(name)
+        if value not in (None, ''):
+            return str(value).strip()
+    return None
+
+
+def flag(value):
+    return 1 if str(value or '').strip().upper() in ('Y', 'YES', 'TRUE', '1') else 0
+
+
+# "05/16/2025 09:00:00 AM", New York time like the rest of the MTA data
+def parse_time(text):
+    if not text:
+        return None
+    for fmt in ('%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %I:%M %p', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return int(datetime.strptime(text.strip(), fmt).replace(tzinfo=TIMEZONE).timestamp())
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_name(name):
+    return ' '.join(name.lower().replace('–', '-').split()) if name else None
+
+
+class StopResolver:
+    # Maps what the MTA sends to subway_stops stations
+    def __init__(self, stations):
+        # stations: [(stop_id, stop_name), ...]
+        self.ids = {stop_id for stop_id, _ in stations}
+        by_name = {}
+        for stop_id, name in stations:
+            by_name.setdefault(normalize_name(name), set()).add(stop_id)
+        self.by_name = {name: ids.pop() for name, ids in by_name.items() if len(ids) == 1}
+
+    @classmethod
+    def from_db(cls, db):
+        return cls([tuple(row) for row in db.execute(
+            'SELECT global_stop_id, stop_name FROM subway_stops s WHERE NOT EXISTS ('
+            ' SELECT 1 FROM subway_stops p WHERE p.global_stop_id = s.parent_station_global_stop_id)'
+        )])
+
+    # Stations in a list like "A28/128", or the station of that name when it's unique
+    def resolve(self, stop_ids, station):
+        found = []
+        for stop_id in (stop_ids or '').replace(',', '/').split('/'):
+            stop_id = stop_id.strip().upper()
+            if stop_id and stop_keys(stop_id)[-1] in self.ids:
+                found.append(stop_keys(stop_id)[-1])
+        if not found and normalize_name(station) in self.by_name:
+            found.append(self.by_name[normalize_name(station)])
+        return list(dict.fromkeys(found))
+
+
+_validators = {}        # url -> (ETag, Last-Modified) of the version we have
+
+
+# Items of a JSON document, or None when it hasn't changed since the last fetch
+def fetch_items(url):
+    etag, modified = _validators.get(url, (None, None))
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    response = http_client.get(url, headers=headers, timeout=TIMEOUT, stream=True)
+    if response.status_code == 304:
+        response.close()
+        return None
+    response.raise_for_status()
+
+    def items():
+        with response:
+            yield from iter_json_array(response.iter_content(CHUNK_BYTES))
+        # Only remembered once the whole document made it in
+        _validators[url] = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return items()
+
+
+# Replace the equipment list, returns how many elevators and escalators it has
+def ingest_equipment(db, items, resolver):
+    now = int(time.time())
+    stops = []
+    count = 0
+
+    def rows():
+        nonlocal count
+        for item in items:
+            equipment_id = field(item, 'equipmentno', 'equipment')
+            if not equipment_id:
+                continue
+            count += 1
+            station = field(item, 'station')
+            for stop_id in resolver.resolve(field(item, 'elevatorsgtfsstopid', 'gtfs_stop_id'), station):
+                stops.append((equipment_id, stop_id))
+            yield (equipment_id, station, field(item, 'equipmenttype'), field(item, 'serving'),
+                   flag(item.get('ADA')), flag(item.get('isactive', 'Y')), now)
+
+    with db:
+        db.execute('DELETE FROM elevator_equipment')
+        db.execute('DELETE FROM elevator_equipment_stops')
+        db.executemany(
+            'INSERT OR REPLACE INTO elevator_equipment'
+            ' (equipment_id, station, equipment_type, serving, ada, active, updated_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows()
+        )
+        db.executemany('INSERT OR IGNORE INTO elevator_equipment_stops (equipment_id, stop_id) VALUES (?, ?)', stops)
+    return count
+
+
+# Replace one outage feed (CURRENT or UPCOMING), returns (outages, outages without a station)
+def ingest_outages(db, feed, items, resolver):
+    equipment_stops = {}
+    for equipment_id, stop_id in db.execute('SELECT equipment_id, stop_id FROM elevator_equipment_stops'):
+        equipment_stops.setdefault(equipment_id, []).append(stop_id)
+    count = unmatched = 0
+
+    def rows():
+        nonlocal count, unmatched
+        for item in items:
+            equipment_id = field(item, 'equipment', 'equipmentno')
+            if not equipment_id:
+                continue
+            count += 1
+            station = field(item, 'station')
+            stop_ids = equipment_stops.get(equipment_id) or resolver.resolve(None, station)
+            if not stop_ids:
+                unmatched += 1
+            row = (feed, equipment_id, station, field(item, 'equipmenttype'), field(item, 'serving'),
+                   flag(item.get('ADA')), parse_time(field(item, 'outagedate')),
+                   parse_time(field(item, 'estimatedreturntoservice')), field(item, 'reason'),
+                   flag(item.get('isupcomingoutage')), flag(item.get('ismaintenanceoutage')))
+            for stop_id in stop_ids or [None]:
+                yield row[:2] + (stop_id,) + row[2:]
+
+    with db:
+        db.execute('DELETE FROM elevator_outages WHERE feed = ?', (feed,))
+        db.executemany(
+            'INSERT INTO elevator_outages (feed, equipment_id, stop_id, station, equipment_type, serving,'
+            ' ada, start, end, reason, upcoming, maintenance) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            rows()
+        )
+    return count, unmatched
+
+
+class OutageIndex:
+    def __init__(self, outages, accessible, built_at=None):
+        # outages: [{equipment_id, stop_id, station, type, serving, ada, start, end, reason, upcoming, current}, ...]
+        # current is set for the rows of the CURRENT feed
+        # accessible: stations with an ADA elevator in service (when not out)
+        self.outages = outages
+        self.accessible = accessible
+        self.built_at = built_at
+        self.by_stop = {}
+        for position, outage in enumerate(outages):
+            self.by_stop.setdefault(outage['stop_id'], []).append(position)
+        # Current outages are out now even past their estimated return,
+        # only the planned ones go by their period
+        self.current = {position for position, outage in enumerate(outages) if outage['current']}
+        planned = [position for position in range(len(outages)) if position not in self.current]
+        self.periods = IntervalIndex(
+            [outages[position]['start'] or 0 for position in planned],
+            [outages[position]['end'] or FOREVER for position in planned],
+            planned,
+        )
+
+    @classmethod
+    def from_db(cls, db):
+        outages = [
+            {'equipment_id': equipment_id, 'stop_id': stop_id, 'station': station, 'type': equipment_type,
+             'serving': serving, 'ada': bool(ada), 'start': start, 'end': end, 'reason': reason,
+             'upcoming': bool(upcoming), 'current': feed == CURRENT}
+            for feed, equipment_id, stop_id, station, equipment_type, serving, ada, start, end, reason, upcoming
+            in db.execute(
+                # The same outage can be in both feeds, the other columns come from the row
+                # of MIN(feed), that is the current one
+                'SELECT MIN(feed), equipment_id, stop_id, station, equipment_type, serving, ada, start, end,'
+                ' reason, upcoming FROM elevator_outages WHERE stop_id IS NOT NULL'
+                ' GROUP BY equipment_id, stop_id, start ORDER BY stop_id, equipment_id, start'
+            )
+        ]
+        accessible = {stop_id for (stop_id,) in db.execute(
+            "SELECT DISTINCT s.stop_id FROM elevator_equipment_stops s"
+            " JOIN elevator_equipment e ON e.equipment_id = s.equipment_id"
+            " WHERE e.ada = 1 AND e.active = 1 AND e.equipment_type = 'EL'"
+        )}
+        return cls(outages, accessible, time.time())
+
+    def __len__(self):
+        return len(self.outages)
+
+    # Outages at a station at `now`, with the planned ones too when upcoming is set
+    def at_station(self, stop_id, now=None, upcoming=False):
+        now = now if now is not None else time.time()
+        active = self.periods.stab(now)
+        found = []
+        for position in self.by_stop.get(stop_keys(stop_id)[-1], ()):
+            if position in self.current or position in active:
+                found.append(self.outages[position])
+            elif upcoming and (self.outages[position]['start'] or 0) > now:
+                found.append(self.outages[position])
+        return found
+
+    # Whether every station is step-free at `now`: it has an ADA elevator
+    # and none of its ADA elevators is out
+    def step_free(self, stops, now=None):
+        stations = []
+        for stop_id in dict.fromkeys(stop_keys(stop_id)[-1] for stop_id in stops):
+            out = [outage for outage in self.at_station(stop_id, now)
+                   if outage['ada'] and outage['type'] == 'EL']
+            stations.append({
+                'stop_id': stop_id,
+                'accessible': stop_id in self.accessible,
+                'step_free': stop_id in self.accessible and not out,
+                'outages': out,
+            })
+        return {'step_free': all(station['step_free'] for station in stations), 'stations': stations}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# The outage index for this process, rebuilt from the db when it's older than INDEX_TTL
+def get_index(db):
+    global _index
+    with _index_lock:
+        if _index is None or time.time() - _index.built_at > INDEX_TTL:
+            _index = OutageIndex.from_db(db)
+        return _index
+
+
+def rebuild(db):
+    global _index
+    index = OutageIndex.from_db(db)
+    with _index_lock:
+        _index = index
+    return index
+
+
+# Whether each of a user's saved routes is step-free now, from the stations
+# where it boards, transfers and alights (every station it passes for routes
+# indexed before those were recorded)
+def routes_step_free(db, userid, now=None):
+    index = get_index(db)
+    results = []
+    for routeid, stops, access in db.execute(
+        'SELECT i.routeid, i.stops, i.access FROM route_index i JOIN routes r ON r.routeid = i.routeid'
+        ' WHERE r.userid = ? ORDER BY i.routeid',
+        (userid,)
+    ):
+        stations = json.loads(access) if access is not None else json.loads(stops)
+        results.append({'routeid': routeid, **index.step_free(stations, now)})
+    return results
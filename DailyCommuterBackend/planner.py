@@ -0,0 +1,341 @@
+import math
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import time as clock
+import numpy as np
+from DailyCommuterBackend.db import get_read_db
+from DailyCommuterBackend.gtfs_static import TIMEZONE, get_timetable
+from DailyCommuterBackend.stations import StationIndex
+
+
+'''
+Local subway journey planner
+
+An arrive-by Connection Scan over the static timetable (gtfs_static). Every
+pair of consecutive stop times of a trip is a connection; they are sorted by
+departure, latest first, and scanned once from the arrival time backwards
+while we keep the latest time we can be at each station and still make it.
+Platforms (A28N, A28S) are folded into their parent station, changing trains
+or boarding at the start needs TRANSFER_SECONDS on the platform, and the walk
+to and from stations within MAX_WALK is straight-line distance at WALK_SPEED.
+
+Realtime delays come from the ingested stop_update rows: a trip whose next
+predicted stop is late is shifted by that much for the rest of its run. The
+sorted connections of a day are rebuilt when the delays are more than
+DELAY_TTL seconds old, so a query only does the scan itself.
+
+The answer has the shape of a Transit/OTP plan (plan.itineraries[0].legs with
+from, to and intermediateStops), so Router can use it in place of the API's.
+'''
+
+
+WALK_SPEED = 1.3                # meters per second
+MAX_WALK = 800                  # meters to or from a station
+TRANSFER_SECONDS = 120
+MAX_JOURNEY = 3 * 60 * 60       # how far before the arrival time the scan goes
+DELAY_TTL = 30                  # seconds
+MAX_DELAY = 60 * 60             # predictions further off than this are ignored
+
+
+# "AFA23GEN-1038-Weekday-00_000600_1..S03R" -> "000600_1..S03R",
+# the realtime feeds only send the end of the static trip id
+def realtime_trip_id(static_trip_id):
+    tail = static_trip_id.rsplit('-', 1)[-1]
+    return tail.split('_', 1)[1] if tail.count('_') >= 2 else tail
+
+
+# Epoch of the day's schedule times, in the agency's timezone whatever the
+# host's is; GTFS counts from noon minus 12 hours so DST days line up
+def midnight_epoch(date):
+    return int(datetime.combine(date, clock(12), TIMEZONE).timestamp()) - 12 * 60 * 60
+
+
+def service_date(now):
+    return datetime.fromtimestamp(now, TIMEZONE).date()
+
+
+# The connections running on one day, in scan order
+@dataclass
+class DayConnections:
+    connection: np.ndarray  # connection index, latest departure first
+    neg_dep: np.ndarray     # -departure, ascending so it can be binary searched
+    dep: np.ndarray
+    arr: np.ndarray
+    delays: np.ndarray      # seconds late, per trip
+    loaded_at: float
+
+
+class Planner:
+    # stations: stop_id -> (station_id, name, lat, lon)
+    # calendar: service_id -> ((monday, ..., sunday), start_date, end_date), empty runs everything
+    def __init__(self, timetable, stations, calendar=None):
+        self.timetable = tt = timetable
+        self.calendar = calendar or {}
+
+        station_index = {}
+        self.station_ids, self.station_names, lats, lons = [], [], [], []
+        self.stop_station = np.empty(len(tt.stop_ids), dtype=np.int32)
+        for i, stop_id in enumerate(tt.stop_ids):
+            station_id, name, lat, lon = stations.get(stop_id, (stop_id, stop_id, None, None))
+            if station_id not in station_index:
+                station_index[station_id] = len(station_index)
+                self.station_ids.append(station_id)
+                self.station_names.append(name)
+                lats.append(math.nan if lat is None else lat)
+                lons.append(math.nan if lon is None else lon)
+            self.stop_station[i] = station_index[station_id]
+        self.station_lats = np.array(lats, dtype=np.float64)
+        self.station_lons = np.array(lons, dtype=np.float64)
+        self.station_index = StationIndex(self.station_lats, self.station_lons)
+
+        # Connection i leaves stop time c_index[i] and arrives at the next one
+        self.c_index = np.nonzero(tt.st_trip[:-1] == tt.st_trip[1:])[0].astype(np.int32)
+        self.c_trip = tt.st_trip[self.c_index]
+        self.c_from = self.stop_station[tt.st_stop[self.c_index]]
+        self.c_to = self.stop_station[tt.st_stop[self.c_index + 1]]
+        self.c_dep = tt.st_departure[self.c_index]
+        self.c_arr = tt.st_arrival[self.c_index + 1]
+
+        self._days = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_db(cls, db, timetable):
+        rows = {
+            row[0]: tuple(row) for row in db.execute(
+                'SELECT global_stop_id, parent_station_global_stop_id, stop_name, stop_lat, stop_lon'
+                ' FROM subway_stops'
+            )
+        }
+        stations = {}
+        for stop_id, parent, name, lat, lon in rows.values():
+            if parent in rows:
+                stations[stop_id] = (parent,) + rows[parent][2:]
+            else:
+                stations[stop_id] = (stop_id, name, lat, lon)
+        calendar = {
+            row[0]: (tuple(row[1:8]), row[8], row[9]) for row in db.execute(
+                'SELECT service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday,'
+                ' start_date, end_date FROM subway_calendar'
+            )
+        }
+        return cls(timetable, stations, calendar)
+
+    # True for every trip whose service runs on date
+    def active_trips(self, date):
+        tt = self.timetable
+        if not self.calendar:
+            return np.ones(len(tt.trip_ids), dtype=bool)
+        day, weekday = date.strftime('%Y%m%d'), date.weekday()
+        services = np.array([
+            service_id in self.calendar
+            and bool(self.calendar[service_id][0][weekday])
+            and self.calendar[service_id][1] <= day <= self.calendar[service_id][2]
+            for service_id in tt.service_ids
+        ], dtype=bool)
+        return services[tt.trip_service]
+
+    # Seconds late per trip, from the next predicted stop of every live trip
+    def load_delays(self, db, date, now):
+        tt = self.timetable
+        by_realtime_id = {}
+        for i in np.nonzero(self.active_trips(date))[0].tolist():
+            by_realtime_id.setdefault(realtime_trip_id(tt.trip_ids[i]), i)
+            by_realtime_id[tt.trip_ids[i]] = i
+
+        midnight = midnight_epoch(date)
+        delays = np.zeros(len(tt.trip_ids), dtype=np.int32)
+        seen = set()
+        for trip_id, stop_id, arrival in db.execute(
+            'SELECT t.trip_id, s.stop_id || s.direction, s.arrival FROM stop_update s'
+            ' JOIN trip_update t ON t.id = s.trip_update_id'
+            ' WHERE s.arrival >= ? AND t.retired_at IS NULL'
+            ' ORDER BY s.arrival',
+            (int(now),)
+        ):
+            i = by_realtime_id.get(trip_id)
+            stop = tt.stop_index.get(stop_id)
+            if i is None or stop is None or i in seen:
+                continue
+            start, end = tt.trip_offsets[i], tt.trip_offsets[i + 1]
+            hits = np.nonzero(tt.st_stop[start:end] == stop)[0]
+            if not len(hits):
+                continue
+            seen.add(i)
+            delay = arrival - (midnight + int(tt.st_arrival[start + hits[0]]))
+            if abs(delay) <= MAX_DELAY:
+                delays[i] = delay
+        return delays
+
+    def _build_day(self, db, date, now):
+        if date == service_date(now):
+            delays = self.load_delays(db, date, now)
+        else:
+            delays = np.zeros(len(self.timetable.trip_ids), dtype=np.int32)
+        keep = np.nonzero(self.active_trips(date)[self.c_trip])[0]
+        delay = delays[self.c_trip[keep]]
+        dep = self.c_dep[keep] + delay
+        arr = self.c_arr[keep] + delay
+        # Latest departure first, and on a tie the later arrival first
+        order = np.lexsort((-arr, -dep))
+        return DayConnections(keep[order].astype(np.int32), -dep[order], dep[order], arr[order],
+                              delays, now)
+
+    def _get_day(self, db, date, now):
+        with self._lock:
+            day = self._days.get(date)
+            if day is None or now - day.loaded_at > DELAY_TTL:
+                day = self._build_day(db, date, now)
+                if len(self._days) > 2:
+                    self._days.clear()
+                self._days[date] = day
+            return day
+
+    # {station: walking seconds} for the stations within MAX_WALK
+    def nearby(self, lat, lon):
+        return {station: int(meters / WALK_SPEED)
+                for meters, station in self.station_index.within(lat, lon, MAX_WALK)}
+
+    # The journey that leaves the latest and still arrives by arrive_by
+    # (seconds past midnight on date), None when there is no train journey
+    def plan(self, db, from_lat, from_lon, to_lat, to_lon, arrive_by, date=None, now=None):
+        now = now or time.time()
+        date = date or service_date(now)
+        access = self.nearby(from_lat, from_lon)
+        egress = self.nearby(to_lat, to_lon)
+        if not access or not egress:
+            return None
+        day = self._get_day(db, date, now)
+
+        start = int(np.searchsorted(day.neg_dep, -arrive_by, 'left'))
+        end = int(np.searchsorted(day.neg_dep, MAX_JOURNEY - arrive_by, 'right'))
+        window = day.connection[start:end]
+
+        # Latest time we can be at a station (ready to board) and still make it
+        latest = {station: arrive_by - walk for station, walk in egress.items()}
+        trip_exit = {}      # trip -> connection we get off at
+        pointer = {}        # station -> (connection we board, connection we get off at)
+        best, origin = -math.inf, None
+        for k, trip, frm, to, dep, arr in zip(
+            window.tolist(), self.c_trip[window].tolist(), self.c_from[window].tolist(),
+            self.c_to[window].tolist(), day.dep[start:end].tolist(), day.arr[start:end].tolist()
+        ):
+            if dep < best:
+                break
+            exit = trip_exit.get(trip)
+            if exit is None:
+                if arr > latest.get(to, -math.inf):
+                    continue
+                exit = trip_exit[trip] = k
+            board = dep - TRANSFER_SECONDS
+            if board > latest.get(frm, -math.inf):
+                latest[frm] = board
+                pointer[frm] = (k, exit)
+                if frm in access and board - access[frm] > best:
+                    best, origin = board - access[frm], frm
+
+        if origin is None:
+            return None
+        rides = []
+        station = origin
+        while station in pointer:
+            rides.append(pointer[station])
+            station = int(self.c_to[pointer[station][1]])
+        return self.itinerary(day, date, (from_lat, from_lon), (to_lat, to_lon),
+                              rides, access[origin], egress[station])
+
+    def place(self, station, name=None):
+        return {
+            'stopId': self.station_ids[station],
+            'name': name or self.station_names[station],
+            'lat': float(self.station_lats[station]),
+            'lon': float(self.station_lons[station]),
+        }
+
+    # Turn the rides into an OTP shaped plan
+    def itinerary(self, day, date, start, end, rides, access_walk, egress_walk):
+        tt = self.timetable
+        midnight = midnight_epoch(date)
+
+        def ms(seconds):
+            return (midnight + int(seconds)) * 1000
+
+        legs = []
+        for enter, exit in rides:
+            first, last = int(self.c_index[enter]), int(self.c_index[exit]) + 1
+            trip = int(tt.st_trip[first])
+            delay = int(day.delays[trip])
+            stations = self.stop_station[tt.st_stop[first:last + 1]].tolist()
+            legs.append({
+                'mode': 'SUBWAY',
+                'route': tt.route_ids[tt.trip_route[trip]],
+                'tripId': tt.trip_ids[trip],
+                'realTime': bool(delay),
+                'departureDelay': delay,
+                'startTime': ms(tt.st_departure[first] + delay),
+                'endTime': ms(tt.st_arrival[last] + delay),
+                'from': self.place(stations[0]),
+                'to': self.place(stations[-1]),
+                'intermediateStops': [self.place(station) for station in stations[1:-1]],
+            })
+
+        leave = legs[0]['startTime'] // 1000 - TRANSFER_SECONDS - access_walk
+        arrive = legs[-1]['endTime'] // 1000 + egress_walk
+        legs.insert(0, {
+            'mode': 'WALK',
+            'startTime': leave * 1000,
+            'endTime': (leave + access_walk) * 1000,
+            'from': {'name': 'Start', 'lat': start[0], 'lon': start[1]},
+            'to': legs[0]['from'],
+        })
+        legs.append({
+            'mode': 'WALK',
+            'startTime': legs[-1]['endTime'],
+            'endTime': arrive * 1000,
+            'from': legs[-1]['to'],
+            'to': {'name': 'Destination', 'lat': end[0], 'lon': end[1]},
+        })
+        return {
+            'source': 'local',
+            'plan': {
+                'date': midnight * 1000,
+                'itineraries': [{
+                    'duration': arrive - leave,
+                    'startTime': leave * 1000,
+                    'endTime': arrive * 1000,
+                    'walkTime': access_walk + egress_walk,
+                    'transfers': len(rides) - 1,
+                    'legs': legs,
+                }],
+            },
+        }
+
+
+_planner = None
+_planner_lock = threading.Lock()
+
+
+# The planner for the current timetable, None until a GTFS zip was loaded
+def get_planner():
+    global _planner
+    timetable = get_timetable()
+    if not len(timetable):
+        return None
+    with _planner_lock:
+        if _planner is None or _planner.timetable is not timetable:
+            _planner = Planner.from_db(get_read_db(), timetable)
+        return _planner
+
+
+# Arrive-by plan for a "HH:MM" arrival time today, None when we have no answer
+def plan_arrive_by(start, end, arrival_time, date=None):
+    try:
+        hours, minutes = (int(part) for part in str(arrival_time).split(':')[:2])
+    except ValueError:
+        return None
+    planner = get_planner()
+    if planner is None:
+        return None
+    return planner.plan(get_read_db(), start[0], start[1], end[0], end[1], hours * 3600 + minutes * 60, date)
@@ -0,0 +1,153 @@
+import glob
+import json
+import os
+import shutil
+import time
+import click
+import numpy as np
+from flask import current_app
+from DailyCommuterBackend.db import get_db
+
+
+'''
+Retention for the realtime tables
+
+Only the last RETENTION_WINDOW seconds of stop updates stay in SQLite. Older
+rows are moved into append-only segment directories under ARCHIVE_FOLDER, one
+fixed-dtype .npy file per column, so they can be memory-mapped back with
+read_segments(). Finished trips and vehicles are deleted and the freed pages
+are handed back to the filesystem with incremental vacuum, so the size of the
+database stays flat no matter how long the server runs.
+
+A database created before auto_vacuum was turned on needs one full VACUUM
+first, which rewrites the whole file; 'flask compact-db' does it, the
+scheduled job never does.
+'''
+
+
+# Column name -> dtype of each archived column, the width of the text
+# columns ('S') is that of the longest value in the segment
+SEGMENT_COLUMNS = {
+    'id': np.int64,
+    'trip_update_id': np.int64,
+    'arrival': np.int64,
+    'departure': np.int64,
+    'stop_id': 'S',
+    'direction': 'S',
+    'route_id': 'S',
+    'trip_id': 'S',
+}
+
+# Rows per segment, also bounds the memory used by one compaction step
+SEGMENT_ROWS = 100000
+
+
+# Write one segment atomically, the directory only appears once it is complete
+# A segment of the same ids left by a run that crashed before its delete is
+# replaced, its rows are all still in the db
+def write_segment(folder, rows):
+    columns = list(zip(*rows))
+    name = f'stop_update-{rows[0][0]:012d}-{rows[-1][0]:012d}'
+    tmp_path = os.path.join(folder, f'.{name}.tmp')
+    os.makedirs(tmp_path, exist_ok=True)
+    for (column, dtype), values in zip(SEGMENT_COLUMNS.items(), columns):
+        if dtype == 'S':
+            values = [(value or '').encode() for value in values]
+        np.save(os.path.join(tmp_path, f'{column}.npy'), np.array(values, dtype=dtype))
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return name
+
+
+# Memory-map every archived segment back, in id order
+# Yields {column: array} per segment
+def read_segments(folder, columns=None):
+    for path in sorted(glob.glob(os.path.join(folder, 'stop_update-*'))):
+        yield {
+            column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r')
+            for column in (columns or SEGMENT_COLUMNS)
+        }
+
+
+# Databases created before auto_vacuum was turned on need one full VACUUM,
+# returns whether it ran
+def enable_incremental_vacuum(db):
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return False
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('VACUUM')
+    return True
+
+
+# Archive and delete everything older than the retention window
+def compact(db, folder, window, now=None):
+    cutoff = int(time.time() if now is None else now) - window
+    os.makedirs(folder, exist_ok=True)
+    stats = {'archived': 0, 'segments': 0, 'trips': 0, 'vehicles': 0}
+
+    while True:
+        rows = db.execute(
+            'SELECT su.id, su.trip_update_id, su.arrival, su.departure,'
+            '       su.stop_id, su.direction, tu.route_id, tu.trip_id'
+            ' FROM stop_update su JOIN trip_update tu ON tu.id = su.trip_update_id'
+            ' WHERE su.arrival < ? AND su.departure < ?'
+            ' ORDER BY su.id LIMIT ?',
+            (cutoff, cutoff, SEGMENT_ROWS)
+        ).fetchall()
+        if not rows:
+            break
+        rows = [tuple(row) for row in rows]
+        # Segment first, then delete, after a crash in between the same rows are
+        # selected again and their segment is rewritten
+        write_segment(folder, rows)
+        with db:
+            db.execute(
+                'DELETE FROM stop_update WHERE id IN (SELECT value FROM json_each(?))',
+                (json.dumps([row[0] for row in rows]),)
+            )
+        stats['archived'] += len(rows)
+        stats['segments'] += 1
+
+    with db:
+        stats['vehicles'] = db.execute(
+            'DELETE FROM vehicle_update WHERE timestmp < ?', (cutoff,)
+        ).rowcount
+        # Finished route jobs are only polled for a few seconds
+        db.execute('DELETE FROM route_jobs WHERE updated_at < ?', (cutoff,))
+        # A trip is done once none of its stops or vehicles are left
+        stats['trips'] = db.execute(
+            'DELETE FROM trip_update'
+            ' WHERE NOT EXISTS (SELECT 1 FROM stop_update WHERE trip_update_id = trip_update.id)'
+            '   AND NOT EXISTS (SELECT 1 FROM vehicle_update WHERE trip_update_id = trip_update.id)'
+        ).rowcount
+
+    # Does nothing until compact-db turned incremental vacuum on
+    db.execute('PRAGMA incremental_vacuum').fetchall()
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return stats
+
+
+# Register compact_db_command with the Application
+def init_app(app):
+    app.cli.add_command(compact_db_command)
+
+
+def compact_db():
+    return compact(
+        get_db(),
+        current_app.config['ARCHIVE_FOLDER'],
+        current_app.config['RETENTION_WINDOW'],
+    )
+
+
+# Set up the command 'compact-db' for the Flask CLI
+@click.command('compact-db')
+def compact_db_command():
+    """Archive realtime rows older than the retention window."""
+    if enable_incremental_vacuum(get_db()):
+        click.echo("Turned on incremental vacuum (one full VACUUM).")
+    stats = compact_db()
+    click.echo(f"Archived {stats['archived']} stop updates into {stats['segments']} segments,"
+               f" removed {stats['trips']} trips and {stats['vehicles']} vehicle updates.")
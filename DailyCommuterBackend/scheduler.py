@@ -0,0 +1,274 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+import click
+from flask import current_app
+from DailyCommuterBackend.db import get_db, get_read_db
+
+
+'''
+Background refresh of the realtime data
+
+Every feed family runs on its own daemon thread with its own interval, so a
+slow or failing feed never holds up the others or a request worker. Failures
+back off exponentially, and every run is recorded in the feed_status table
+so freshness can be checked from any process (see /feeds/status).
+'''
+
+
+# Default refresh interval in seconds for each feed family,
+# can be overridden with SCHEDULER_INTERVALS in the instance config
+DEFAULT_INTERVALS = {
+    'subway': 30,
+    'bus': 30,
+    'alerts': 120,
+    'retention': 600,
+    'recalc': 60,
+    'notify': 10,
+    'outages': 300,
+    'certs': 600,
+}
+
+
+@dataclass
+class Job:
+    name: str
+    func: object
+    interval: float
+    jitter: float = 0.1         # +/- fraction of the interval
+    max_backoff: float = 900    # never wait longer than this after failures
+    failures: int = 0
+    last_attempt: float = None
+    last_success: float = None
+    last_error: str = None
+
+    # Seconds until the next run, doubling with every consecutive failure
+    def next_delay(self):
+        delay = self.interval
+        if self.failures:
+            delay = min(self.interval * 2 ** self.failures, self.max_backoff)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add_job(self, name, func, interval, **kwargs):
+        self.jobs[name] = Job(name, func, interval, **kwargs)
+
+    # Run a job once inside the current app context and record the outcome
+    # A job can return {feed_name: data_timestamp} to report per-feed freshness
+    def run_job(self, job):
+        job.last_attempt = time.time()
+        try:
+            feeds = job.func() or {}
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e)
+            print(f"Scheduled job {job.name} failed ({job.failures} in a row): {e}")
+            record_feed_status(job.name, job.last_attempt, error=job.last_error)
+            return False
+
+        job.failures = 0
+        job.last_error = None
+        job.last_success = job.last_attempt
+        record_feed_status(job.name, job.last_attempt)
+        for feed_name, data_timestamp in feeds.items():
+            record_feed_status(feed_name, job.last_attempt, data_timestamp=data_timestamp)
+        return True
+
+    def _loop(self, app, job):
+        while not self._stop.is_set():
+            # Nothing may end the thread, not even failing to record the outcome
+            try:
+                with app.app_context():
+                    self.run_job(job)
+            except Exception as e:
+                job.failures += 1
+                job.last_error = str(e)
+                print(f"Scheduled job {job.name} could not be recorded ({job.failures} in a row): {e}")
+            self._stop.wait(job.next_delay())
+
+    # Start one daemon thread per job
+    def start(self, app):
+        if self._threads:
+            return
+        self._stop.clear()
+        for job in self.jobs.values():
+            thread = threading.Thread(
+                target=self._loop, args=(app, job),
+                name=f'scheduler-{job.name}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+scheduler = Scheduler()
+
+
+# Upsert a row in feed_status for the given feed or job
+def record_feed_status(name, attempted_at, data_timestamp=None, error=None):
+    db = get_db()
+    with db:
+        if error is None:
+            db.execute(
+                """
+                INSERT INTO feed_status (name, last_attempt, last_success, data_timestamp, failures)
+                VALUES (?, ?, ?, ?, 0)
+                ON CONFLICT(name) DO UPDATE SET
+                    last_attempt = excluded.last_attempt,
+                    last_success = excluded.last_success,
+                    data_timestamp = COALESCE(excluded.data_timestamp, data_timestamp),
+                    failures = 0,
+                    last_error = NULL
+                """,
+                (name, int(attempted_at), int(attempted_at), data_timestamp)
+            )
+        else:
+            db.execute(
+                """
+                INSERT INTO feed_status (name, last_attempt, failures, last_error)
+                VALUES (?, ?, 1, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    last_attempt = excluded.last_attempt,
+                    failures = failures + 1,
+                    last_error = excluded.last_error
+                """,
+                (name, int(attempted_at), error)
+            )
+
+
+# How stale every feed is, lag is measured from the newest data we have
+def get_feed_status():
+    now = time.time()
+    rows = get_read_db().execute(
+        'SELECT name, last_attempt, last_success, data_timestamp, failures, last_error'
+        ' FROM feed_status ORDER BY name'
+    ).fetchall()
+    status = []
+    for row in rows:
+        freshest = row['data_timestamp'] or row['last_success']
+        status.append({
+            **dict(row),
+            'lag_seconds': int(now - freshest) if freshest else None,
+        })
+    return status
+
+
+# A feed that was fetched but not ingested fails the job, so feed_status shows it
+def raise_ingest_errors(results):
+    errors = [result.error for result in results if result.error]
+    if errors:
+        raise RuntimeError(f"Could not ingest {'; '.join(errors)}")
+
+
+def refresh_subway():
+    from DailyCommuterBackend.apiRouting.api import subway_poller, update_subway_feeds
+    from DailyCommuterBackend.apiRouting.feeds import FAILED
+    results = update_subway_feeds()
+    raise_ingest_errors(results)
+    failed = [result.url for result in results if result.status == FAILED]
+    if len(failed) == len(results):
+        raise RuntimeError("Every subway feed failed to fetch")
+    for url in failed:
+        print(f"Subway feed failed this round: {url}")
+    return {
+        url: state.timestamp
+        for url, state in subway_poller.states.items()
+        if state.timestamp
+    }
+
+
+def refresh_bus():
+    from DailyCommuterBackend.apiRouting.api import bus_feed_urls, update_bus_feeds
+    from DailyCommuterBackend.apiRouting.bus import get_state
+    update_bus_feeds()
+    return {
+        url: get_state(url).version
+        for url in bus_feed_urls
+        if get_state(url).version
+    }
+
+
+def refresh_alerts():
+    from DailyCommuterBackend.apiRouting.api import alerts_poller, update_service_alerts
+    from DailyCommuterBackend.apiRouting.feeds import FAILED
+    results = update_service_alerts()
+    raise_ingest_errors(results)
+    for result in results:
+        if result.status == FAILED:
+            print(f"Alert feed failed this round: {result.url}")
+    return {
+        url: state.timestamp
+        for url, state in alerts_poller.states.items()
+        if state.timestamp
+    }
+
+
+def refresh_outages():
+    from DailyCommuterBackend.apiRouting.api import update_elevator_outages
+    update_elevator_outages()
+
+
+def refresh_certs():
+    from DailyCommuterBackend.apiRouting.token_cache import warm_certs
+    warm_certs()
+
+
+def recalc_routes():
+    from DailyCommuterBackend.apiRouting.api import recalc_queued_routes
+    recalc_queued_routes()
+
+
+def send_notifications():
+    from DailyCommuterBackend.notifications import dispatch_due
+    dispatch_due()
+
+
+def compact_realtime_tables():
+    from DailyCommuterBackend.retention import compact_db
+    compact_db()
+
+
+def register_jobs(app):
+    intervals = {**DEFAULT_INTERVALS, **app.config.get('SCHEDULER_INTERVALS', {})}
+    scheduler.add_job('subway', refresh_subway, intervals['subway'])
+    scheduler.add_job('bus', refresh_bus, intervals['bus'])
+    scheduler.add_job('alerts', refresh_alerts, intervals['alerts'])
+    scheduler.add_job('retention', compact_realtime_tables, intervals['retention'])
+    scheduler.add_job('outages', refresh_outages, intervals['outages'])
+    scheduler.add_job('recalc', recalc_routes, intervals['recalc'])
+    scheduler.add_job('certs', refresh_certs, intervals['certs'])
+    scheduler.add_job('notify', send_notifications, intervals['notify'])
+
+
+# Register the jobs and the 'run-scheduler' command with the Application
+# Set SCHEDULER_ENABLED in the config to also run the jobs inside the web process
+def init_app(app):
+    register_jobs(app)
+    app.cli.add_command(run_scheduler_command)
+    if app.config.get('SCHEDULER_ENABLED'):
+        scheduler.start(app)
+
+
+# Set up the command 'run-scheduler' for the Flask CLI
+@click.command('run-scheduler')
+def run_scheduler_command():
+    """Keep the realtime data refreshed until stopped."""
+    scheduler.start(current_app._get_current_object())
+    click.echo(f"Running {', '.join(scheduler.jobs)} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        scheduler.stop()
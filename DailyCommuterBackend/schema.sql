@@ -1,12 +1,35 @@
+-- Version 0 of the schema, migrations.py upgrades it from here
+PRAGMA user_version = 0;
+-- Lets retention.py hand freed pages back, only applies to a new file
+PRAGMA auto_vacuum = INCREMENTAL;
+
+-- Children before the tables they reference, foreign_keys is on
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS subway_alerts;
-DROP TABLE IF EXISTS trip_update;
 DROP TABLE IF EXISTS stop_update;
 DROP TABLE IF EXISTS vehicle_update;
-DROP TABLE IF EXISTS subway_stops;
-DROP TABLE IF EXISTS subway_routes;
-DROP TABLE IF EXISTS subway_trips;
+DROP TABLE IF EXISTS trip_update;
 DROP TABLE IF EXISTS subway_stop_times;
+DROP TABLE IF EXISTS subway_trips;
+DROP TABLE IF EXISTS subway_routes;
+DROP TABLE IF EXISTS subway_stops;
+DROP TABLE IF EXISTS points;
+DROP TABLE IF EXISTS feed_status;
+-- Created by migrations.py
+DROP TABLE IF EXISTS geocode_cache;
+DROP TABLE IF EXISTS route_geometry;
+DROP TABLE IF EXISTS route_list_version;
+DROP TABLE IF EXISTS route_jobs;
+DROP TABLE IF EXISTS subway_calendar;
+DROP TABLE IF EXISTS service_alert_entities;
+DROP TABLE IF EXISTS service_alert_periods;
+DROP TABLE IF EXISTS service_alerts;
+DROP TABLE IF EXISTS route_index;
+DROP TABLE IF EXISTS route_recalc_queue;
+DROP TABLE IF EXISTS notification_queue;
+DROP TABLE IF EXISTS elevator_equipment_stops;
+DROP TABLE IF EXISTS elevator_outages;
+DROP TABLE IF EXISTS elevator_equipment;
 DROP TABLE IF EXISTS routes;
 
 
@@ -119,3 +142,14 @@ CREATE TABLE points (
     type INTEGER,
     FOREIGN KEY (routeid) REFERENCES routes(routeid) ON DELETE CASCADE
 );
+
+
+-- Freshness of each realtime feed, written by the scheduler
+CREATE TABLE feed_status (
+    name TEXT PRIMARY KEY,
+    last_attempt INTEGER,
+    last_success INTEGER,
+    data_timestamp INTEGER, -- header timestamp of the newest data we have
+    failures INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
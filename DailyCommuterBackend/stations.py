@@ -0,0 +1,262 @@
+import heapq
+import math
+import threading
+import numpy as np
+from DailyCommuterBackend.db import get_read_db
+
+
+'''
+In-memory spatial index of subway stations
+
+Coordinates are projected to meters on a plane through the middle of the
+stations (equirectangular, off by well under 1% across a city) and bucketed
+into square cells sized so there are a couple of stations per cell. A single
+lookup only visits the cells around the point, growing the ring of cells
+until the k nearest are known, so it costs microseconds and never touches
+the db. Batches of points (e.g. the start and end of every saved route) are
+grouped by cell and each group is compared with the stations of the cells
+around it in one NumPy operation.
+
+The index of the stations in subway_stops is built on first use and dropped
+by invalidate() whenever the stops are reloaded.
+'''
+
+
+STATIONS_PER_CELL = 2
+MIN_CELL_METERS = 100
+EARTH_RADIUS = 6371000
+
+
+class StationIndex:
+    # Positions in the results are positions in lats/lons, points without
+    # coordinates are never returned
+    def __init__(self, lats, lons, cell_meters=None):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        known = ~(np.isnan(lats) | np.isnan(lons))
+        self.lat0 = float(lats[known].mean()) if known.any() else 0.0
+        self.lon0 = float(lons[known].mean()) if known.any() else 0.0
+        self.scale = math.cos(math.radians(self.lat0))
+
+        self.x, self.y = self.project(lats, lons)
+        self.positions = np.nonzero(known)[0]
+        if cell_meters is None:
+            area = 0.0
+            if len(self.positions):
+                kx, ky = self.x[known], self.y[known]
+                area = float((kx.max() - kx.min()) * (ky.max() - ky.min()))
+            cell_meters = max(MIN_CELL_METERS, math.sqrt(area * STATIONS_PER_CELL / max(len(self.positions), 1)))
+        self.cell = cell_meters
+        self._xs = self.x.tolist()
+        self._ys = self.y.tolist()
+        self.cells = {}     # (cx, cy) -> [position, ...]
+        for i in self.positions.tolist():
+            key = (math.floor(self._xs[i] / self.cell), math.floor(self._ys[i] / self.cell))
+            self.cells.setdefault(key, []).append(i)
+        if self.cells:
+            keys = np.array(list(self.cells))
+            self.min_cell = keys.min(axis=0).tolist()
+            self.max_cell = keys.max(axis=0).tolist()
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Meters east and north of the middle of the index, works on arrays too
+    def project(self, lat, lon):
+        x = np.radians(np.subtract(lon, self.lon0)) * self.scale * EARTH_RADIUS
+        y = np.radians(np.subtract(lat, self.lat0)) * EARTH_RADIUS
+        return x, y
+
+    def _point(self, lat, lon):
+        x = math.radians(lon - self.lon0) * self.scale * EARTH_RADIUS
+        y = math.radians(lat - self.lat0) * EARTH_RADIUS
+        return x, y, math.floor(x / self.cell), math.floor(y / self.cell)
+
+    # The ring of cells at Chebyshev distance r around (cx, cy)
+    def _ring(self, cx, cy, r):
+        if r == 0:
+            yield self.cells.get((cx, cy), ())
+            return
+        for dx in range(-r, r + 1):
+            yield self.cells.get((cx + dx, cy - r), ())
+            yield self.cells.get((cx + dx, cy + r), ())
+        for dy in range(-r + 1, r):
+            yield self.cells.get((cx - r, cy + dy), ())
+            yield self.cells.get((cx + r, cy + dy), ())
+
+    # The k closest positions as [(meters, position), ...], closest first
+    def nearest(self, lat, lon, k=5, max_distance=None):
+        if not self.cells or k <= 0:
+            return []
+        x, y, cx, cy = self._point(lat, lon)
+        xs, ys = self._xs, self._ys
+        # Rings before the first one that reaches the stations, and past the
+        # last one, are empty
+        last = max(abs(cx - self.min_cell[0]), abs(cx - self.max_cell[0]),
+                   abs(cy - self.min_cell[1]), abs(cy - self.max_cell[1]))
+        r = max(0, self.min_cell[0] - cx, cx - self.max_cell[0],
+                self.min_cell[1] - cy, cy - self.max_cell[1])
+        found = []
+        while r <= last:
+            for cell in self._ring(cx, cy, r):
+                found.extend((math.hypot(xs[i] - x, ys[i] - y), i) for i in cell)
+            # Everything within r cells of the point has been seen
+            covered = r * self.cell
+            if max_distance is not None and covered >= max_distance:
+                break
+            if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= covered:
+                break
+            r += 1
+        best = heapq.nsmallest(k, found)
+        if max_distance is not None:
+            best = [(meters, i) for meters, i in best if meters <= max_distance]
+        return best
+
+    # Every position within radius meters as [(meters, position), ...], closest first
+    def within(self, lat, lon, radius):
+        if not self.cells:
+            return []
+        x, y, cx, cy = self._point(lat, lon)
+        xs, ys = self._xs, self._ys
+        found = []
+        for i in self._cells_around(cx, cy, math.ceil(radius / self.cell)):
+            meters = math.hypot(xs[i] - x, ys[i] - y)
+            if meters <= radius:
+                found.append((meters, i))
+        found.sort()
+        return found
+
+    # Points of a batch grouped by cell: (x, y, [((cx, cy), point numbers), ...])
+    def _group(self, lats, lons):
+        x, y = self.project(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+        cx = np.floor(x / self.cell).astype(np.int64)
+        cy = np.floor(y / self.cell).astype(np.int64)
+        order = np.lexsort((cy, cx))
+        cells = np.stack((cx[order], cy[order]), axis=1)
+        starts = np.flatnonzero(np.any(np.diff(cells, axis=0) != 0, axis=1)) + 1
+        groups = [
+            ((int(cells[start][0]), int(cells[start][1])), points)
+            for start, points in zip(np.concatenate(([0], starts)).tolist(), np.split(order, starts))
+        ] if len(order) else []
+        return x, y, groups
+
+    # Every position in the square of cells reach cells around (cx, cy)
+    def _cells_around(self, cx, cy, reach):
+        if (2 * reach + 1) ** 2 >= len(self.cells):
+            return self.positions.tolist()
+        found = []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                found.extend(self.cells.get((cx + dx, cy + dy), ()))
+        return found
+
+    # Rings around a cell that hold the k nearest stations of any point in it
+    def _reach(self, cx, cy, k):
+        r = max(0, self.min_cell[0] - cx, cx - self.max_cell[0],
+                self.min_cell[1] - cy, cy - self.max_cell[1])
+        seen = sum(len(cell) for ring in range(r + 1) for cell in self._ring(cx, cy, ring))
+        while seen < k:
+            r += 1
+            seen += sum(len(cell) for cell in self._ring(cx, cy, r))
+        # The k found are at most (r + 1) * sqrt(2) cells away from any point
+        # in the cell, and r rings cover r cells in every direction
+        return math.ceil((r + 1) * math.sqrt(2))
+
+    # k nearest for many points at once: (positions, meters), both shaped (points, k)
+    def nearest_batch(self, lats, lons, k=5):
+        k = min(k, len(self.positions))
+        x, y, groups = self._group(lats, lons)
+        positions = np.empty((len(x), k), dtype=np.int64)
+        meters = np.empty((len(x), k), dtype=np.float64)
+        if not k:
+            return positions, meters
+        for (cx, cy), points in groups:
+            candidates = np.array(self._cells_around(cx, cy, self._reach(cx, cy, k)))
+            distances = np.hypot(x[points, None] - self.x[candidates], y[points, None] - self.y[candidates])
+            closest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            closest_meters = np.take_along_axis(distances, closest, axis=1)
+            order = np.argsort(closest_meters, axis=1)
+            positions[points] = candidates[np.take_along_axis(closest, order, axis=1)]
+            meters[points] = np.take_along_axis(closest_meters, order, axis=1)
+        return positions, meters
+
+    # Everything within radius of many points: one (positions, meters) pair per point
+    def within_batch(self, lats, lons, radius):
+        x, y, groups = self._group(lats, lons)
+        results = [None] * len(x)
+        reach = math.ceil(radius / self.cell)
+        for (cx, cy), points in groups:
+            candidates = np.array(self._cells_around(cx, cy, reach), dtype=np.int64)
+            distances = np.hypot(x[points, None] - self.x[candidates], y[points, None] - self.y[candidates])
+            for point, row in zip(points.tolist(), distances):
+                hits = np.flatnonzero(row <= radius)
+                hits = hits[np.argsort(row[hits])]
+                results[point] = (candidates[hits], row[hits])
+        return results
+
+
+class SubwayStations:
+    def __init__(self, stops):
+        # stops: [(stop_id, stop_name, lat, lon), ...]
+        self.stops = stops
+        self.index = StationIndex([stop[2] for stop in stops], [stop[3] for stop in stops])
+
+    # Only stations, the platforms under a parent station share its spot
+    @classmethod
+    def from_db(cls, db):
+        return cls([tuple(row) for row in db.execute(
+            'SELECT global_stop_id, stop_name, stop_lat, stop_lon FROM subway_stops s'
+            ' WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL AND NOT EXISTS ('
+            '  SELECT 1 FROM subway_stops p WHERE p.global_stop_id = s.parent_station_global_stop_id)'
+            ' ORDER BY global_stop_id'
+        )])
+
+    def describe(self, position, meters):
+        stop_id, name, lat, lon = self.stops[position]
+        return {'stop_id': stop_id, 'name': name, 'lat': lat, 'lon': lon, 'distance': round(float(meters), 1)}
+
+    def nearest(self, lat, lon, k=5, max_distance=None):
+        return [self.describe(i, meters) for meters, i in self.index.nearest(lat, lon, k, max_distance)]
+
+    def within(self, lat, lon, radius):
+        return [self.describe(i, meters) for meters, i in self.index.within(lat, lon, radius)]
+
+    # Closest stations to the start and end of every route, in one pass
+    def near_routes(self, routes, k=3):
+        if not routes:
+            return []
+        lats = [coord[0] for route in routes for coord in (route.start_coord, route.end_coord)]
+        lons = [coord[1] for route in routes for coord in (route.start_coord, route.end_coord)]
+        positions, meters = self.index.nearest_batch(lats, lons, k)
+        stations = [
+            [self.describe(i, m) for i, m in zip(row_positions.tolist(), row_meters.tolist())]
+            for row_positions, row_meters in zip(positions, meters)
+        ]
+        return [
+            {'routeid': route.id, 'start': stations[2 * n], 'end': stations[2 * n + 1]}
+            for n, route in enumerate(routes)
+        ]
+
+
+_stations = None
+_stations_lock = threading.Lock()
+
+
+# The index for this process, built from subway_stops on first use
+# An empty one isn't kept, so stops loaded by another process are picked up
+def get_stations():
+    global _stations
+    if _stations is None:
+        with _stations_lock:
+            if _stations is None:
+                stations = SubwayStations.from_db(get_read_db())
+                if not len(stations.index):
+                    return stations
+                _stations = stations
+    return _stations
+
+
+# Call after subway_stops changed, the next lookup rebuilds the index
+def invalidate():
+    global _stations
+    _stations = None
@@ -19,8 +19,30 @@ export async function addCommuteToDB(formFields) {
     throw new Error("Failed to save address");
   }
   
-  const result = await response.json();
+  // The route is created in the background, poll until it's ready
+  const { status_url } = await response.json();
+  const result = await waitForRouteJob(status_url);
   const page = "http://localhost:5000/"+result.redirect_url
   window.location.href = page;  // Force browser redirect
   
-}
\ No newline at end of file
+}
+
+// Gives up after timeout ms, the server fails jobs left behind by a restart
+async function waitForRouteJob(status_url, interval = 500, timeout = 120000) {
+  const deadline = Date.now() + timeout;
+  while (Date.now() < deadline) {
+    const response = await fetch("http://localhost:5000" + status_url);
+    if (!response.ok) {
+      throw new Error("Failed to check on the new route");
+    }
+    const job = await response.json();
+    if (job.status === "done") {
+      return job;
+    }
+    if (job.status === "failed") {
+      throw new Error(job.error || "Failed to create the route");
+    }
+    await new Promise((resolve) => setTimeout(resolve, interval));
+  }
+  throw new Error("Timed out waiting for the new route");
+}
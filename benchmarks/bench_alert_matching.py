@@ -0,0 +1,138 @@
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from DailyCommuterBackend.migrations import apply_migrations
+from DailyCommuterBackend import matcher
+
+
+'''
+Matching service alerts to saved routes, inverted index against a scan
+
+Fills route_index with synthetic routes (random rides of 10-30 stations over
+a few lines out of ~470 stations and 25 lines, like the subway), then times
+building the RouteMatcher, looking up the routes affected by each of a set of
+synthetic alerts (one to a few stations, sometimes a whole line), queueing
+them all, and catching up after a batch of routes is replanned. The scan
+reads every route_index row for every alert the way a matcher without an
+index would, it is timed over the first SCAN_ALERTS alerts and extrapolated.
+
+python benchmarks/bench_alert_matching.py [routes] [alerts]
+'''
+
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'DailyCommuterBackend', 'schema.sql')
+LINES = [str(n) for n in range(1, 8)] + list('ABCDEFGJLMNQRSWZ') + ['SI', 'GS']
+STATIONS = [f'{letter}{n:02d}' for letter in 'ABDFGHJLMNR' for n in range(1, 44)]
+SCAN_ALERTS = 20
+REPLANNED = 1000
+
+
+def random_route(rng):
+    stops, lines = set(), set()
+    for _ in range(rng.randint(1, 3)):
+        line = rng.choice(LINES)
+        lines.add(line)
+        start = rng.randrange(len(STATIONS))
+        stops.update(STATIONS[(start + i) % len(STATIONS)] for i in range(rng.randint(4, 12)))
+    return sorted(stops), sorted(lines)
+
+
+def random_alert(rng):
+    entities = {('MTASBWY', None, rng.choice(STATIONS) + rng.choice('NS')) for _ in range(rng.randint(1, 3))}
+    if rng.random() < 0.2:
+        entities.add(('MTASBWY', rng.choice(LINES), None))
+    return entities
+
+
+def fill(db, count, rng):
+    now = int(time.time()) - 60
+    with db:
+        db.executemany(
+            'INSERT INTO route_index (routeid, stops, routes, updated_at) VALUES (?, ?, ?, ?)',
+            ((routeid, json.dumps(stops), json.dumps(lines), now)
+             for routeid, (stops, lines) in ((routeid, random_route(rng)) for routeid in range(1, count + 1)))
+        )
+
+
+def alert_keys(entities):
+    stops = {matcher.station_key(stop_id) for _, _, stop_id in entities if stop_id}
+    routes = {route_id for _, route_id, _ in entities if route_id}
+    return stops, routes
+
+
+def scan(db, stops, routes):
+    return sorted(
+        routeid for routeid, route_stops, route_lines in db.execute('SELECT routeid, stops, routes FROM route_index')
+        if stops.intersection(json.loads(route_stops)) or routes.intersection(json.loads(route_lines))
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    alert_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite3.connect(os.path.join(tmp, 'bench.sqlite'))
+        with open(SCHEMA) as f:
+            db.executescript(f.read())
+        apply_migrations(db)
+        db.execute('PRAGMA foreign_keys = OFF')     # route_index rows without routes rows
+        fill(db, count, rng)
+        alerts = [random_alert(rng) for _ in range(alert_count)]
+
+        index = matcher.RouteMatcher()
+        started = time.perf_counter()
+        index.build(db)
+        built = time.perf_counter() - started
+        print(f'{count} routes, {len(index.keys)} stations and lines: index built in {built:.2f} s,'
+              f' {(index.routeids.nbytes + index.offsets.nbytes) / 2 ** 20:.1f} MB of arrays')
+
+        timings, affected = [], 0
+        for entities in alerts:
+            started = time.perf_counter()
+            found = index.affected(*alert_keys(entities))
+            timings.append((time.perf_counter() - started) * 1000)
+            affected += len(found)
+        print(f'index: {alert_count} alerts, {affected} affected routes in total,'
+              f' p50 {statistics.median(timings):.3f} ms, max {max(timings):.3f} ms, all {sum(timings):.0f} ms')
+
+        sample = alerts[:SCAN_ALERTS]
+        started = time.perf_counter()
+        for entities in sample:
+            assert scan(db, *alert_keys(entities)) == index.affected(*alert_keys(entities))
+        per_alert = (time.perf_counter() - started) / len(sample) * 1000
+        print(f'scan: {per_alert:.1f} ms per alert, about {per_alert * alert_count / 1000:.0f} s for {alert_count}'
+              f' (timed over {len(sample)}, same routes found)')
+
+        # Every alert of a feed at once, the way ingest_alert_snapshot calls it
+        matcher.matcher = index
+        entities = set().union(*alerts)
+        started = time.perf_counter()
+        queued = matcher.queue_affected_routes(db, entities)
+        print(f'queue_affected_routes for all {alert_count} alerts: {len(queued)} routes queued'
+              f' in {(time.perf_counter() - started) * 1000:.0f} ms')
+
+        # Routes replanned since the build go to the overlay
+        with db:
+            for routeid in rng.sample(range(1, count + 1), REPLANNED):
+                matcher.save_route_entities(db, routeid, *random_route(rng))
+        started = time.perf_counter()
+        index.catch_up(db)
+        caught_up = time.perf_counter() - started
+        started = time.perf_counter()
+        for entities in alerts:
+            index.affected(*alert_keys(entities))
+        print(f'{REPLANNED} replanned routes: caught up in {caught_up * 1000:.0f} ms,'
+              f' {alert_count} alerts with the overlay {(time.perf_counter() - started) * 1000:.0f} ms')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from google.transit import gtfs_realtime_pb2
+from DailyCommuterBackend.migrations import apply_migrations, BUS_MIGRATIONS
+from DailyCommuterBackend.apiRouting.bus import BusFeedState, ingest_bus_chunks, CHUNK_SIZE
+
+
+'''
+Throughput of the bus GTFS-RT ingest on a synthetic full-city feed
+
+Builds a feed with one trip update (STOPS predictions each) and one vehicle
+position for every bus in service and ingests three versions of it: all
+new, then with a fifth of the trips changed and every bus moved, then the
+same version again (skipped from its header). The memory used by streaming
+a version into the db is compared with parsing it whole, each step in a
+fresh process and measured as the highest RSS seen during the step over the
+RSS before it (Linux only, read from /proc), for a quarter, half and all of
+the buses: parsing whole grows with the feed, streaming stays nearly flat
+(only the per-trip fingerprints kept in BusFeedState grow).
+
+The last part times a small subway write every 10 ms while a bus version is
+ingested, with the bus tables in the subway db file and in their own file.
+
+python benchmarks/bench_bus_ingest.py [buses] [stops]
+'''
+
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'DailyCommuterBackend', 'schema.sql')
+BUS_ROUTES = 320
+
+
+def build_feed(buses, stops, version, changed=1.0, seed=1):
+    rng = random.Random(seed)
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '1.0'
+    feed.header.timestamp = version
+    for n in range(buses):
+        route_id = f'B{n % BUS_ROUTES}'
+        trip_id = f'MTA NYCT_BUS-{route_id}-{n:05d}'
+        # Trips outside the changed fraction keep the predictions of version 1
+        shift = version - 1_700_000_001 if rng.random() < changed else 0
+        entity = feed.entity.add()
+        entity.id = f'trip{n}'
+        update = entity.trip_update
+        update.trip.trip_id = trip_id
+        update.trip.route_id = route_id
+        update.trip.direction_id = n % 2
+        update.trip.start_date = '20250516'
+        update.vehicle.id = f'MTA NYCT_{n + 1000}'
+        update.timestamp = version
+        for k in range(stops):
+            stop = update.stop_time_update.add()
+            stop.stop_id = f'{300000 + (n * 7 + k) % 15000}'
+            stop.arrival.time = 1_700_000_000 + shift + n + k * 90
+            stop.departure.time = stop.arrival.time
+        entity = feed.entity.add()
+        entity.id = f'vehicle{n}'
+        vehicle = entity.vehicle
+        vehicle.trip.trip_id = trip_id
+        vehicle.trip.route_id = route_id
+        vehicle.vehicle.id = f'MTA NYCT_{n + 1000}'
+        vehicle.position.latitude = 40.5 + rng.random() * 0.4
+        vehicle.position.longitude = -74.2 + rng.random() * 0.5
+        vehicle.position.bearing = rng.random() * 360
+        vehicle.timestamp = version
+        vehicle.stop_id = f'{300000 + n % 15000}'
+    return feed.SerializeToString()
+
+
+def chunks(body):
+    for start in range(0, len(body), CHUNK_SIZE):
+        yield body[start:start + CHUNK_SIZE]
+
+
+def open_db(path, bus=True, subway=False):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA busy_timeout = 30000')
+    db.execute('PRAGMA synchronous = NORMAL')
+    if subway:
+        with open(SCHEMA) as f:
+            db.executescript(f.read())
+        apply_migrations(db)
+    if bus:
+        apply_migrations(db, migrations=BUS_MIGRATIONS)
+    return db
+
+
+# Resident memory of this process in MB
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+# MB the RSS went up by while step ran, sampled every millisecond; what step
+# returns is still alive at the last sample
+def rss_growth(step):
+    before = rss()
+    peak = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], rss())
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        result = step()
+    finally:
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], rss())
+    del result
+    return peak[0] - before
+
+
+def parse_whole(body):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(body)
+    len(feed.entity)
+    return feed
+
+
+# Memory of parsing a serialized feed whole or streaming it into a bus db,
+# run in a fresh process so what an earlier step freed isn't reused
+def memory(mode, path):
+    with open(path, 'rb') as f:
+        body = f.read()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(os.path.join(tmp, 'bus.sqlite'))
+        if mode == 'whole':
+            growth = rss_growth(lambda: parse_whole(body))
+        else:
+            growth = rss_growth(lambda: ingest_bus_chunks(db, chunks(body), BusFeedState()))
+    print(f'{growth:.1f}')
+
+
+def subway_writes(db, stop, latencies):
+    n = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        with db:
+            db.execute('INSERT INTO feed_status (name, last_attempt, failures) VALUES (?, ?, 0)'
+                       ' ON CONFLICT(name) DO UPDATE SET last_attempt = excluded.last_attempt',
+                       ('subway', n))
+        latencies.append((time.perf_counter() - started) * 1000)
+        n += 1
+        time.sleep(0.01)
+
+
+def contention(tmp, body, separate):
+    path = os.path.join(tmp, f'subway-{separate}.sqlite')
+    subway = open_db(path, bus=False, subway=True)
+    if separate:
+        bus = open_db(os.path.join(tmp, 'bus-contention.sqlite'))
+    else:
+        # user_version already belongs to the subway migrations in this file
+        subway.executescript(BUS_MIGRATIONS[0])
+        bus = open_db(path, bus=False)
+    latencies, stop = [], threading.Event()
+    writer = threading.Thread(target=subway_writes, args=(subway, stop, latencies))
+    writer.start()
+    ingest_bus_chunks(bus, chunks(body), BusFeedState())
+    stop.set()
+    writer.join()
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[-1]
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--memory':
+        memory(sys.argv[2], sys.argv[3])
+        return
+    buses = int(sys.argv[1]) if len(sys.argv) > 1 else 6000
+    stops = int(sys.argv[2]) if len(sys.argv) > 2 else 35
+    first = build_feed(buses, stops, 1_700_000_001)
+    second = build_feed(buses, stops, 1_700_000_031, changed=0.2)
+    print(f'{buses} buses, {stops} predictions each: {2 * buses} entities, {len(first) / 2 ** 20:.1f} MB')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(os.path.join(tmp, 'bus.sqlite'))
+        state = BusFeedState()
+        print(f'{"version":10} {"seconds":>8} {"entities/s":>11} {"trips":>7} {"stop times":>11} {"vehicles":>9}')
+        for name, body in (('all new', first), ('20% new', second), ('same', second)):
+            started = time.perf_counter()
+            stats = ingest_bus_chunks(db, chunks(body), state)
+            elapsed = time.perf_counter() - started
+            if stats is None:
+                print(f'{name:10} {elapsed:8.3f} {"skipped from the header":>41}')
+                continue
+            print(f'{name:10} {elapsed:8.3f} {stats["entities"] / elapsed:11,.0f} {stats["trips"]:7}'
+                  f' {stats["stop_times"]:11} {stats["vehicles"]:9}')
+
+        print('memory of one version over the process before it:')
+        print(f'{"buses":>7} {"feed MB":>8} {"parsed whole MB":>16} {"streamed MB":>12}')
+        for size in (buses // 4, buses // 2, buses):
+            body = first if size == buses else build_feed(size, stops, 1_700_000_001)
+            path = os.path.join(tmp, f'feed-{size}.pb')
+            with open(path, 'wb') as f:
+                f.write(body)
+            growth = {
+                mode: float(subprocess.run(
+                    [sys.executable, __file__, '--memory', mode, path],
+                    capture_output=True, text=True, check=True
+                ).stdout)
+                for mode in ('whole', 'stream')
+            }
+            print(f'{size:7} {len(body) / 2 ** 20:8.1f} {growth["whole"]:16.1f} {growth["stream"]:12.1f}')
+
+        for separate in (False, True):
+            p50, worst = contention(tmp, first, separate)
+            where = 'own file' if separate else 'subway file'
+            print(f'subway write during bus ingest, bus tables in the {where}: p50 {p50:.2f} ms, max {worst:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
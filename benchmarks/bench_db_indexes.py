@@ -0,0 +1,112 @@
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from DailyCommuterBackend.migrations import apply_migrations
+
+
+'''
+Before/after timings for the index migrations in migrations.py
+
+Builds a database the size of roughly one day of polling plus a few thousand
+users, times the lookups the app does on the bare schema.sql, then applies
+the migrations and times them again.
+
+python benchmarks/bench_db_indexes.py [trips] [users]
+'''
+
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'DailyCommuterBackend', 'schema.sql')
+ROUTES = ['A', 'C', 'E', 'B', 'D', 'F', 'M', 'G', 'N', 'Q', 'R', 'W', 'L', '1', '2', '3', '4', '5', '6', '7', 'GS', 'SI']
+STOPS_PER_TRIP = 30
+
+
+def populate(db, trips, users):
+    rng = random.Random(1)
+    now = int(time.time())
+    with db:
+        db.executemany(
+            'INSERT INTO trip_update (update_id, trip_id, start_tm, start_dt, route_id) VALUES (?, ?, ?, ?, ?)',
+            ((f'{i:08d}', f'trip_{i}', '08:00:00', '20250324', rng.choice(ROUTES)) for i in range(trips))
+        )
+        db.executemany(
+            'INSERT INTO stop_update (trip_update_id, arrival, departure, stop_id, direction) VALUES (?, ?, ?, ?, ?)',
+            ((trip, now + rng.randint(-43200, 43200), 0, f'S{rng.randint(0, 500):03d}', rng.choice('NS'))
+             for trip in range(1, trips + 1) for _ in range(STOPS_PER_TRIP))
+        )
+        db.executemany(
+            'INSERT INTO vehicle_update (trip_update_id, timestmp, curr_stop_id) VALUES (?, ?, ?)',
+            ((trip, now, 'S001N') for trip in range(1, trips + 1))
+        )
+        db.executemany(
+            'INSERT INTO routes (route_name, start_address, end_address, arrival_time, userid) VALUES (?, ?, ?, ?, ?)',
+            ((f'route {i}', 'start', 'end', '09:00', str(i % users)) for i in range(users * 4))
+        )
+        db.executemany(
+            'INSERT INTO points (routeid, lat, lon, name, type) VALUES (?, ?, ?, ?, ?)',
+            ((route, 40.7, -73.9, 'stop', 1) for route in range(1, users * 4 + 1) for _ in range(20))
+        )
+
+
+def queries(users):
+    now = int(time.time())
+    return {
+        'get_saved_routes (routes.userid)': (
+            'SELECT routeid, route_name FROM routes WHERE userid = ?',
+            lambda rng: (str(rng.randrange(users)),)),
+        'map_view (points.routeid)': (
+            'SELECT name, lat, lon, type FROM points WHERE routeid = ?',
+            lambda rng: (rng.randint(1, users * 4),)),
+        'index (trip_update.route_id)': (
+            'SELECT * FROM trip_update WHERE route_id = ?',
+            lambda rng: (rng.choice(ROUTES),)),
+        'next arrivals at a stop': (
+            'SELECT su.arrival, tu.route_id FROM stop_update su'
+            ' JOIN trip_update tu ON tu.id = su.trip_update_id'
+            ' WHERE su.stop_id = ? AND su.direction = ? AND su.arrival >= ?'
+            ' ORDER BY su.arrival LIMIT 5',
+            lambda rng: (f'S{rng.randint(0, 500):03d}', rng.choice('NS'), now)),
+    }
+
+
+def time_queries(db, users, repeat=20):
+    timings = {}
+    for name, (sql, params) in queries(users).items():
+        rng = random.Random(2)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            db.execute(sql, params(rng)).fetchall()
+        timings[name] = (time.perf_counter() - started) / repeat * 1000
+    return timings
+
+
+def main():
+    trips = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite3.connect(os.path.join(tmp, 'bench.sqlite'))
+        with open(SCHEMA) as f:
+            db.executescript(f.read())
+        populate(db, trips, users)
+        print(f'{trips} trips, {trips * STOPS_PER_TRIP} stop updates, '
+              f'{users * 4} routes, {users * 80} points')
+
+        before = time_queries(db, users)
+        started = time.perf_counter()
+        # Migration 4 replaces points with route_geometry, stop before it
+        apply_migrations(db, target=3)
+        print(f'migrations took {time.perf_counter() - started:.1f} s')
+        after = time_queries(db, users)
+
+        print(f'{"query":40} {"before ms":>10} {"after ms":>10}')
+        for name in before:
+            print(f'{name:40} {before[name]:10.3f} {after[name]:10.3f}')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from DailyCommuterBackend import create_app
+from DailyCommuterBackend.db import configure_db, init_db
+
+
+'''
+Cost of getting a db connection per request, pooled against opened fresh
+
+Serves the saved routes listing of a user with 20 routes through the Flask
+test client, first with the pools and then with get_read_db patched to open
+and configure a new connection every time, as get_db used to.
+
+python benchmarks/bench_db_pool.py [requests]
+'''
+
+
+def fresh_connection(path):
+    def get_read_db():
+        from flask import g
+        if 'fresh_db' not in g:
+            g.fresh_db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+            g.fresh_db.row_factory = sqlite3.Row
+            configure_db(g.fresh_db)
+        return g.fresh_db
+    return get_read_db
+
+
+def run(client, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        assert client.get('/savedRoutes/69').status_code == 200
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sqlite')
+        app = create_app({'TESTING': True, 'DATABASE': path, 'BUS_DATABASE': os.path.join(tmp, 'bus.sqlite')})
+        with app.app_context():
+            init_db()
+            from DailyCommuterBackend.db import get_db
+            with get_db() as db:
+                db.executemany(
+                    'INSERT INTO routes (route_name, start_address, end_address, arrival_time, userid)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    [(f'Route {n}', f'{n} Jay St', f'{n} Broadway', '09:00', '69') for n in range(20)]
+                )
+
+        @app.teardown_appcontext
+        def close_fresh(e=None):
+            from flask import g
+            db = g.pop('fresh_db', None)
+            if db is not None:
+                db.close()
+
+        client = app.test_client()
+        run(client, 100)
+        pooled = run(client, count)
+
+        import DailyCommuterBackend.home as home
+        import DailyCommuterBackend.apiRouting.api as api
+        home.get_read_db = api.get_read_db = fresh_connection(path)
+        run(client, 100)
+        fresh = run(client, count)
+        print(f'{count} listings: pooled {pooled:.0f} us per request, fresh connection {fresh:.0f} us per request')
+
+
+if __name__ == '__main__':
+    main()
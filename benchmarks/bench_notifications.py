@@ -0,0 +1,129 @@
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from DailyCommuterBackend.migrations import apply_migrations
+from DailyCommuterBackend import notifications
+
+
+'''
+Throughput of the notification fan-out
+
+Queues route changes for synthetic users and sends everything that is due
+through each sink: FileSink, HttpSink against a local HTTP server in this
+process, and a sink that fails one batch in ten to exercise the retry path.
+The coalescing run queues the same number of changes for a quarter as many
+users, as when a disruption hits several routes of the same people.
+
+python benchmarks/bench_notifications.py [notifications]
+'''
+
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'DailyCommuterBackend', 'schema.sql')
+
+
+class Receiver(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        answer = json.dumps({'results': [{} for _ in body['notifications']]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, *args):
+        pass
+
+
+class FlakySink:
+    def __init__(self, inner, rate, seed=1):
+        self.inner = inner
+        self.rate = rate
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send(self, batch):
+        with self._lock:
+            fail = self.rng.random() < self.rate
+        if fail:
+            raise ConnectionError('push service unavailable')
+        return self.inner.send(batch)
+
+
+def open_db(tmp, name):
+    db = sqlite3.connect(os.path.join(tmp, name))
+    with open(SCHEMA) as f:
+        db.executescript(f.read())
+    apply_migrations(db)
+    return db
+
+
+def changes(count, users):
+    return [(f'user{n % users}', n, f'Route {n} now takes 42 min, 9 min longer than planned') for n in range(count)]
+
+
+def make_due(db):
+    with db:
+        db.execute('UPDATE notification_queue SET due_at = 0')
+
+
+def drain(db, dispatcher):
+    totals = {'sent': 0, 'retrying': 0, 'dropped': 0}
+    rounds = 0
+    while True:
+        counts = dispatcher.dispatch(db)
+        rounds += 1
+        for name, count in counts.items():
+            totals[name] += count
+        if not counts['sent'] and not counts['dropped']:
+            # Retries are due later, bring them forward until the queue is empty
+            if not db.execute('SELECT COUNT(*) FROM notification_queue').fetchone()[0]:
+                return totals, rounds
+            make_due(db)
+    return totals, rounds
+
+
+def run(name, db, sink, items):
+    started = time.perf_counter()
+    users = notifications.enqueue(db, items, delay=0)
+    queued = time.perf_counter() - started
+    make_due(db)
+    dispatcher = notifications.Dispatcher(sink)
+    started = time.perf_counter()
+    totals, rounds = drain(db, dispatcher)
+    sent = time.perf_counter() - started
+    dispatcher.close()
+    print(f'{name:14} {len(items):8} {users:8} {queued:8.2f} {sent:8.2f} {totals["sent"] / sent * 60:12,.0f}'
+          f' {rounds:7} {totals["retrying"]:8}')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Receiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/push'
+    print(f'{notifications.WORKERS} workers, batches of {notifications.BATCH_SIZE}')
+    print(f'{"sink":14} {"changes":>8} {"users":>8} {"queue s":>8} {"send s":>8} {"sent/minute":>12}'
+          f' {"rounds":>7} {"retried":>8}')
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(tmp, 'file.sqlite')
+        run('file', db, notifications.FileSink(os.path.join(tmp, 'out.jsonl')), changes(count, count))
+        db = open_db(tmp, 'http.sqlite')
+        run('http', db, notifications.HttpSink(url), changes(count, count))
+        db = open_db(tmp, 'flaky.sqlite')
+        run('http, 10% fail', db, FlakySink(notifications.HttpSink(url), 0.1), changes(count, count))
+        db = open_db(tmp, 'coalesce.sqlite')
+        run('http, coalesce', db, notifications.HttpSink(url), changes(count, count // 4))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import io
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from DailyCommuterBackend.migrations import apply_migrations
+from DailyCommuterBackend.gtfs_static import load_gtfs, Timetable
+from DailyCommuterBackend.planner import Planner
+
+
+'''
+Latency of the local journey planner next to the Transit OTP call
+
+Builds a static GTFS zip for a grid of n x n stations over lower Manhattan,
+one line per row and per column running both ways every 6 minutes from 5am
+to midnight, loads it with load_gtfs and times arrive-by queries between
+random points. With TRANSIT_TOKEN set the same queries are also sent to
+external.transitapp.com (one request each, no plan cache) for comparison.
+
+python benchmarks/bench_planner.py [n] [queries]
+'''
+
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'DailyCommuterBackend', 'schema.sql')
+OTP_URL = 'https://external.transitapp.com/v3/otp/plan'
+ORIGIN = (40.70, -74.01)
+SPACING = 0.008         # degrees between stations, about 700-900 m
+HEADWAY = 6 * 60
+HOP = 2 * 60            # seconds between stations
+
+
+def station_coord(row, col):
+    return ORIGIN[0] + row * SPACING, ORIGIN[1] + col * SPACING
+
+
+def gtfs_time(seconds):
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def build_zip(n):
+    stops = ['stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station']
+    for row in range(n):
+        for col in range(n):
+            lat, lon = station_coord(row, col)
+            station = f'G{row:02d}{col:02d}'
+            stops.append(f'{station},Station {row}-{col},{lat:.6f},{lon:.6f},1,')
+            stops += [f'{station}{d},Station {row}-{col},{lat:.6f},{lon:.6f},,{station}' for d in 'NS']
+
+    routes = ['route_id,agency_id,route_short_name,route_long_name,route_type,route_color']
+    trips = ['route_id,trip_id,service_id,trip_headsign,direction_id,shape_id']
+    stop_times = ['trip_id,arrival_time,departure_time,stop_id,stop_sequence']
+    lines = [(f'R{i}', [(i, col) for col in range(n)]) for i in range(n)]
+    lines += [(f'C{i}', [(row, i) for row in range(n)]) for i in range(n)]
+    for route_id, stations in lines:
+        routes.append(f'{route_id},MTA,{route_id},Line {route_id},1,000000')
+        for direction, path in enumerate((stations, stations[::-1])):
+            for k, start in enumerate(range(5 * 3600, 24 * 3600, HEADWAY)):
+                trip_id = f'BENCH-{route_id}-Everyday-00_{k:06d}_{route_id}..{"NS"[direction]}'
+                trips.append(f'{route_id},{trip_id},Everyday,{route_id},{direction},{route_id}')
+                for sequence, (row, col) in enumerate(path):
+                    at = gtfs_time(start + sequence * HOP)
+                    stop_times.append(f'{trip_id},{at},{at},G{row:02d}{col:02d}{"NS"[direction]},{sequence + 1}')
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('stops.txt', '\n'.join(stops) + '\n')
+        archive.writestr('routes.txt', '\n'.join(routes) + '\n')
+        archive.writestr('trips.txt', '\n'.join(trips) + '\n')
+        archive.writestr('stop_times.txt', '\n'.join(stop_times) + '\n')
+        archive.writestr('calendar.txt', 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,'
+                         'start_date,end_date\nEveryday,1,1,1,1,1,1,1,20000101,20991231\n')
+    return buffer, len(stop_times) - 1
+
+
+def random_queries(n, count):
+    rng = random.Random(1)
+    queries = []
+    for _ in range(count):
+        start = station_coord(rng.uniform(0, n - 1), rng.uniform(0, n - 1))
+        end = station_coord(rng.uniform(0, n - 1), rng.uniform(0, n - 1))
+        arrive_by = rng.randrange(7 * 3600, 22 * 3600, 60)
+        queries.append((start, end, arrive_by))
+    return queries
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return (statistics.median(samples), samples[int(len(samples) * 0.95) - 1], samples[-1])
+
+
+def time_local(db, planner, queries, today):
+    timings, found = [], 0
+    for start, end, arrive_by in queries:
+        started = time.perf_counter()
+        plan = planner.plan(db, *start, *end, arrive_by, today)
+        timings.append((time.perf_counter() - started) * 1000)
+        found += plan is not None
+    return timings, found
+
+
+def time_transit(queries, today, token):
+    import requests
+    timings, found = [], 0
+    for start, end, arrive_by in queries:
+        params = {
+            'fromPlace': f'{start[0]},{start[1]}',
+            'toPlace': f'{end[0]},{end[1]}',
+            'arriveBy': 'true',
+            'time': f'{arrive_by // 3600:02d}:{arrive_by % 3600 // 60:02d}',
+            'date': today.strftime('%Y-%m-%d'),
+        }
+        started = time.perf_counter()
+        try:
+            response = requests.get(OTP_URL, headers={'apiKey': token}, params=params, timeout=30)
+            found += response.ok and bool(response.json().get('plan', {}).get('itineraries'))
+        except requests.exceptions.RequestException as e:
+            print(f'Transit request failed: {e}')
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, found
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    today = date.today()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite3.connect(os.path.join(tmp, 'bench.sqlite'))
+        with open(SCHEMA) as f:
+            db.executescript(f.read())
+        apply_migrations(db)
+
+        archive, stop_times = build_zip(n)
+        started = time.perf_counter()
+        load_gtfs(db, archive)
+        loaded = time.perf_counter()
+        timetable = Timetable.from_db(db)
+        planner = Planner.from_db(db, timetable)
+        built = time.perf_counter()
+        print(f'{n * n} stations, {2 * n} lines, {stop_times} stop times:'
+              f' load {loaded - started:.1f} s, timetable and planner {built - loaded:.1f} s')
+
+        queries = random_queries(n, count)
+        started = time.perf_counter()
+        planner.plan(db, *queries[0][0], *queries[0][1], queries[0][2], today)
+        print(f'first query (sorts the day\'s connections) {(time.perf_counter() - started) * 1000:.1f} ms')
+
+        print(f'{"planner":10} {"queries":>8} {"found":>6} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8}')
+        timings, found = time_local(db, planner, queries, today)
+        print(f'{"local":10} {len(queries):8} {found:6} ' + ' '.join(f'{t:8.2f}' for t in percentiles(timings)))
+
+        token = os.getenv('TRANSIT_TOKEN')
+        if token:
+            sample = queries[:20]
+            timings, found = time_transit(sample, today, token)
+            print(f'{"transit":10} {len(sample):8} {found:6} ' + ' '.join(f'{t:8.2f}' for t in percentiles(timings)))
+        else:
+            print('set TRANSIT_TOKEN to time the same queries against the Transit API')
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
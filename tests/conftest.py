@@ -0,0 +1,184 @@
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from DailyCommuterBackend import create_app
+from DailyCommuterBackend.db import close_pools, init_db
+from DailyCommuterBackend.apiRouting import api
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'test.sqlite'),
+        'BUS_DATABASE': str(tmp_path / 'bus.sqlite'),
+        'ARCHIVE_FOLDER': str(tmp_path / 'archive'),
+        'NOTIFY_SINK': str(tmp_path / 'notifications.jsonl'),
+    })
+
+    with app.app_context():
+        init_db()
+
+    yield app
+
+    close_pools()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def runner(app):
+    return app.test_cli_runner()
+
+
+class Server:
+    # A local HTTP server, routes maps a path to handler(request) -> (status, headers, body)
+    # and every request is kept in requests as (method, path, headers, body)
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                server.connections.add(self.client_address)
+                server.requests.append((self.command, self.path, dict(self.headers), body))
+                handler = server.routes.get(self.path.split('?')[0])
+                if handler is None:
+                    status, headers, payload = 404, {}, b''
+                else:
+                    status, headers, payload = handler(self)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.close()
+
+
+class Response:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class Transit:
+    # Stands in for the Transit OTP plan endpoint, every plan is one subway
+    # leg on `line` from A28 to A27 that takes `duration` seconds
+    def __init__(self):
+        self.duration = 1200
+        self.line = 'A'
+        self.calls = []
+
+    def plan(self):
+        return {'plan': {'itineraries': [{
+            'duration': self.duration,
+            'legs': [{
+                'mode': 'SUBWAY',
+                'routeShortName': self.line,
+                'from': {'lat': 40.752, 'lon': -73.993, 'name': '34 St-Penn Station', 'stopId': 'MTASBWY:A28S'},
+                'to': {'lat': 40.740, 'lon': -74.001, 'name': '14 St', 'stopId': 'MTASBWY:A27S'},
+                'intermediateStops': [],
+            }],
+        }]}}
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs.get('params')))
+        return Response(self.plan())
+
+
+# Router asks the fake Transit instead of the local planner or the network
+@pytest.fixture
+def transit(monkeypatch):
+    transit = Transit()
+    monkeypatch.setattr(api, 'http_client', transit)
+    monkeypatch.setattr(api, 'LOCAL_PLANNER', False)
+    monkeypatch.setattr(api, 'plan_cache', api.plan_cache.__class__())
+    return transit
+
+
+GTFS_FILES = {
+    'stops.txt': [
+        'stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station',
+        'A28,34 St-Penn Station,40.752287,-73.993391,1,',
+        'A28N,34 St-Penn Station,40.752287,-73.993391,,A28',
+        'A28S,34 St-Penn Station,40.752287,-73.993391,,A28',
+        'A27,42 St-Port Authority,40.757308,-73.989735,1,',
+        'A27N,42 St-Port Authority,40.757308,-73.989735,,A27',
+        'A27S,42 St-Port Authority,40.757308,-73.989735,,A27',
+        'A25,50 St,40.762456,-73.985984,1,',
+        'A25N,50 St,40.762456,-73.985984,,A25',
+        'A25S,50 St,40.762456,-73.985984,,A25',
+    ],
+    'routes.txt': [
+        'route_id,route_short_name,route_long_name,route_color',
+        'A,A,8 Avenue Express,0039A6',
+        'C,C,8 Avenue Local,0039A6',
+    ],
+    'calendar.txt': [
+        'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date',
+        'Weekday,1,1,1,1,1,0,0,20250101,20261231',
+    ],
+    'trips.txt': [
+        'route_id,trip_id,service_id,trip_headsign,direction_id,shape_id',
+        'A,A_0900_N,Weekday,Inwood,0,A..N',
+        'A,A_0910_N,Weekday,Inwood,0,A..N',
+        'C,C_2350_N,Weekday,168 St,0,C..N',
+    ],
+    'stop_times.txt': [
+        'trip_id,arrival_time,departure_time,stop_id,stop_sequence',
+        'A_0900_N,09:00:00,09:00:30,A28N,1',
+        'A_0900_N,09:02:00,09:02:30,A27N,2',
+        'A_0900_N,09:05:00,09:05:30,A25N,3',
+        'A_0910_N,09:10:00,09:10:30,A28N,1',
+        'A_0910_N,09:12:00,09:12:30,A27N,2',
+        'C_2350_N,23:50:00,23:50:30,A28N,1',
+        'C_2350_N,24:01:00,24:01:30,A25N,2',
+    ],
+}
+
+
+# A static GTFS zip with two A trips and one C trip running past midnight
+@pytest.fixture
+def gtfs_zip(tmp_path):
+    path = tmp_path / 'google_transit.zip'
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, lines in GTFS_FILES.items():
+            archive.writestr(name, '\n'.join(lines) + '\n')
+    return path
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from google.transit import gtfs_realtime_pb2
+from DailyCommuterBackend import alerts
+from DailyCommuterBackend.alerts import FOREVER, AlertsIndex, IntervalIndex, ingest_alerts, stop_keys
+from DailyCommuterBackend.db import get_db
+
+FEED = 'https://example.com/camsys/subway-alerts'
+
+
+@pytest.fixture(autouse=True)
+def fingerprints(monkeypatch):
+    monkeypatch.setattr(alerts, '_fingerprints', {})
+
+
+# alerts: {alert id: (header, [(route_id, stop_id), ...], [(start, end), ...])}
+def alert_feed(entries):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    for alert_id, (header, informed, periods) in entries.items():
+        entity = feed.entity.add()
+        entity.id = alert_id
+        entity.alert.header_text.translation.add(text=header, language='en')
+        for route_id, stop_id in informed:
+            informed_entity = entity.alert.informed_entity.add(agency_id='MTASBWY')
+            if route_id:
+                informed_entity.route_id = route_id
+            if stop_id:
+                informed_entity.stop_id = stop_id
+        for start, end in periods:
+            entity.alert.active_period.add(start=start, end=end)
+    return feed
+
+
+def test_stab_matches_a_full_scan():
+    rng = np.random.default_rng(3)
+    starts = rng.integers(0, 1000, 300)
+    ends = starts + rng.integers(1, 200, 300)
+    index = IntervalIndex(starts, ends, range(300))
+    for t in [0, 1, 150, 500, 999, 1199, 5000]:
+        expected = {i for i in range(300) if starts[i] <= t < ends[i]}
+        assert index.stab(t) == expected
+        assert index.stab(t) == expected     # the cached answer
+    assert IntervalIndex([], [], []).stab(10) == frozenset()
+
+
+def test_stop_keys():
+    assert stop_keys('A28N') == ('A28N', 'A28')
+    assert stop_keys('A28') == ('A28',)
+
+
+def test_only_changed_alerts_are_written(app):
+    feed = alert_feed({
+        'lane': ('Trains run local', [('A', None)], [(100, 200)]),
+        'elevator': ('No trains stop here', [(None, 'A28N')], []),
+    })
+    with app.app_context():
+        db = get_db()
+        first = ingest_alerts(db, FEED, feed)
+        assert (first['changed'], first['removed']) == (2, 0)
+        assert first['entities'] == {('MTASBWY', 'A', None), ('MTASBWY', None, 'A28N')}
+
+        assert ingest_alerts(db, FEED, feed)['unchanged'] == 2
+        second = ingest_alerts(db, FEED, alert_feed({
+            'lane': ('Trains run local', [('C', None)], [(100, 200)]),
+        }))
+        assert (second['changed'], second['removed']) == (1, 1)
+        # What the alerts informed before and after the change
+        assert second['entities'] == {('MTASBWY', 'A', None), ('MTASBWY', 'C', None), ('MTASBWY', None, 'A28N')}
+        assert db.execute('SELECT COUNT(*) FROM service_alert_entities').fetchone()[0] == 1
+
+
+def test_active_alerts_by_time_stop_and_route(app):
+    with app.app_context():
+        db = get_db()
+        ingest_alerts(db, FEED, alert_feed({
+            'lane': ('Trains run local', [('A', None)], [(100, 200)]),
+            'elevator': ('No trains stop here', [(None, 'A28N')], []),
+        }))
+        index = AlertsIndex.from_db(db)
+    assert [alert['alert_id'] for alert in index.active(now=150)] == ['elevator', 'lane']
+    assert [alert['alert_id'] for alert in index.active(now=250)] == ['elevator']
+    assert [alert['alert_id'] for alert in index.active(routes=['A'], now=150)] == ['lane']
+    assert index.active(routes=['A'], now=250) == []
+    assert [alert['alert_id'] for alert in index.active(stops=['A28N'], now=FOREVER - 1)] == ['elevator']
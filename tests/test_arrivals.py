@@ -0,0 +1,61 @@
+import time
+from google.transit import gtfs_realtime_pb2
+from DailyCommuterBackend import arrivals
+from DailyCommuterBackend.arrivals import ArrivalsIndex
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.apiRouting.ingest import ingest_feed
+
+
+def feed(trips):
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '2.0'
+    for entity_id, route_id, stops in trips:
+        entity = message.entity.add()
+        entity.id = entity_id
+        entity.trip_update.trip.trip_id = entity_id
+        entity.trip_update.trip.route_id = route_id
+        for stop_id, arrival in stops:
+            update = entity.trip_update.stop_time_update.add()
+            update.stop_id = stop_id
+            update.arrival.time = arrival
+    return message
+
+
+def test_next_arrivals_are_sorted_and_start_at_now():
+    index = ArrivalsIndex.from_feeds([
+        feed([('t1', 'A', [('A28S', 300), ('A27S', 400)])]),
+        feed([('t2', 'C', [('A28S', 200)]), ('t3', 'E', [('A28S', 100), ('A28N', 150)])]),
+    ])
+    assert index.next_arrivals('A28', 'S', n=5, now=0) == [
+        {'route_id': 'E', 'arrival': 100},
+        {'route_id': 'C', 'arrival': 200},
+        {'route_id': 'A', 'arrival': 300},
+    ]
+    assert index.next_arrivals('A28', 'S', n=1, now=150) == [{'route_id': 'C', 'arrival': 200}]
+    assert index.next_arrivals('A28', 'S', now=301) == []
+    assert index.next_arrivals('B01', 'N') == []
+
+
+def test_a_process_without_the_scheduler_builds_the_index_from_the_db(app, client, monkeypatch):
+    now = int(time.time())
+    with app.app_context():
+        ingest_feed(get_db(), feed([('t1', 'A', [('A28S', now + 120), ('A27S', now + 240)]),
+                                    ('t2', 'C', [('A28S', now - 3600)])]))
+    # Nothing was polled in this process
+    monkeypatch.setattr(arrivals, '_index', ArrivalsIndex())
+
+    body = client.get('/arrivals/A28/S').get_json()
+    assert body['arrivals'] == [{'route_id': 'A', 'arrival': now + 120}]
+    assert body['built_at'] is not None
+
+
+def test_an_index_older_than_the_ttl_is_reloaded(app, monkeypatch):
+    now = int(time.time())
+    stale = ArrivalsIndex.from_feeds([])
+    stale.built_at = time.time() - arrivals.INDEX_TTL - 1
+    monkeypatch.setattr(arrivals, '_index', stale)
+    with app.app_context():
+        ingest_feed(get_db(), feed([('t1', 'A', [('A28N', now + 60)])]))
+        index = arrivals.get_index(get_db())
+    assert index is not stale
+    assert index.next_arrivals('A28', 'N') == [{'route_id': 'A', 'arrival': now + 60}]
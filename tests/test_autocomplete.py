@@ -0,0 +1,61 @@
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.apiRouting import api
+from DailyCommuterBackend.apiRouting.autocomplete import AutocompleteIndex, feature_label
+
+
+def names(features):
+    return [feature['properties']['name'] for feature in features]
+
+
+def test_prefix_search_is_ordered_by_distance_to_nyc():
+    index = AutocompleteIndex()
+    index.add('370 Jay Street, Albany', 42.65, -73.75)
+    index.add('370 Jay Street, Brooklyn', 40.693, -73.987)
+    index.add('370 Jay Street, Brooklyn', 40.693, -73.987)    # already there
+    index.add('1 Main Street', 40.70, -73.99)
+    assert names(index.search('370 jay')) == ['370 Jay Street, Brooklyn', '370 Jay Street, Albany']
+    assert names(index.search('370 jay', limit=1)) == ['370 Jay Street, Brooklyn']
+    assert index.search('999') == []
+    assert index.search('  ') == []
+
+
+def test_feature_label():
+    assert feature_label({'housenumber': '319', 'street': 'East 73rd Street', 'city': 'New York',
+                          'postcode': '10021'}) == '319 East 73rd Street, New York, 10021'
+
+
+def test_load_fills_the_index_from_the_db(app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO subway_stops (global_stop_id, parent_station_global_stop_id, route_type,"
+                   " rt_stop_id, stop_lat, stop_lon, stop_name) VALUES ('s1', '', 1, 'A28', 40.75, -73.99,"
+                   " '34 St-Penn Station')")
+        db.execute("INSERT INTO geocode_cache (address_key, address, lat, lon, created_at)"
+                   " VALUES ('370 jay st', '370 Jay St', 40.69, -73.98, 0)")
+        db.commit()
+        index = AutocompleteIndex()
+        index.load()
+    assert names(index.search('34 st')) == ['34 St-Penn Station']
+    assert names(index.search('370')) == ['370 Jay St']
+
+
+def test_photon_is_only_asked_when_the_index_runs_short(app, monkeypatch):
+    index = AutocompleteIndex()
+    index.loaded = True
+    monkeypatch.setattr(api, 'autocomplete_index', index)
+    calls = []
+
+    def photon(text, limit):
+        calls.append(text)
+        return {'features': [{
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [-73.98, 40.69]},
+            'properties': {'housenumber': '370', 'street': 'Jay Street', 'city': 'Brooklyn'},
+        }]}
+    monkeypatch.setattr(api, 'photon_lookup', photon)
+
+    first = api.address_autocomplete('370 Ja', limit=1)['features']
+    assert first[0]['properties']['street'] == 'Jay Street'
+    # The next keystroke is answered locally
+    assert api.address_autocomplete('370 Jay', limit=1)['features'] == first
+    assert calls == ['370 Ja']
@@ -0,0 +1,70 @@
+from google.transit import gtfs_realtime_pb2
+from DailyCommuterBackend.db import get_bus_db
+from DailyCommuterBackend.apiRouting.bus import BusFeedState, ingest_bus_chunks, iter_feed
+
+
+# trips: {trip_id: [arrival, ...]}, vehicles: {vehicle_id: timestamp}
+def bus_feed(timestamp, trips=None, vehicles=None):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+    for trip_id, arrivals in (trips or {}).items():
+        entity = feed.entity.add(id=trip_id)
+        entity.trip_update.trip.trip_id = trip_id
+        entity.trip_update.trip.route_id = 'M15'
+        for arrival in arrivals:
+            entity.trip_update.stop_time_update.add(stop_id='401234').arrival.time = arrival
+    for vehicle_id, vehicle_timestamp in (vehicles or {}).items():
+        entity = feed.entity.add(id=vehicle_id)
+        entity.vehicle.vehicle.id = vehicle_id
+        entity.vehicle.timestamp = vehicle_timestamp
+        entity.vehicle.position.latitude = 40.7
+        entity.vehicle.position.longitude = -73.9
+    return feed.SerializeToString()
+
+
+def chunks(data, size=7):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def ids(db, table, column):
+    return sorted(row[0] for row in db.execute(f'SELECT {column} FROM {table}'))
+
+
+def test_iter_feed_reads_entities_across_chunks():
+    data = bus_feed(100, trips={'t1': [1, 2], 't2': [3]}, vehicles={'v1': 5})
+    items = list(iter_feed(chunks(data, 3)))
+    assert items[0][0].timestamp == 100
+    assert [entity.id for _, entity in items[1:]] == ['t1', 't2', 'v1']
+
+
+def test_only_changes_are_written_and_missing_rows_deleted(app):
+    state = BusFeedState()
+    with app.app_context():
+        db = get_bus_db()
+        stats = ingest_bus_chunks(db, chunks(bus_feed(100, trips={'t1': [1], 't2': [2]})), state)
+        assert (stats['trips'], stats['stop_times']) == (2, 2)
+        assert ingest_bus_chunks(db, chunks(bus_feed(100, trips={'t1': [1]})), state) is None
+
+        stats = ingest_bus_chunks(db, chunks(bus_feed(130, trips={'t1': [1], 't3': [9]})), state)
+        assert (stats['trips'], stats['removed_trips']) == (1, 1)
+        assert ids(db, 'bus_trips', 'trip_id') == ['t1', 't3']
+        assert ids(db, 'bus_stop_times', 'trip_id') == ['t1', 't3']
+
+
+def test_rows_from_before_a_restart_are_deleted(app):
+    with app.app_context():
+        db = get_bus_db()
+        ingest_bus_chunks(db, chunks(bus_feed(100, trips={'t1': [1], 't2': [2]})), BusFeedState())
+        ingest_bus_chunks(db, chunks(bus_feed(100, vehicles={'v1': 50, 'v2': 50})), BusFeedState())
+
+        # A new process, with nothing in memory
+        trips, vehicles = BusFeedState(), BusFeedState()
+        stats = ingest_bus_chunks(db, chunks(bus_feed(160, trips={'t1': [1]})), trips)
+        assert (stats['trips'], stats['removed_trips']) == (0, 1)
+        stats = ingest_bus_chunks(db, chunks(bus_feed(160, vehicles={'v2': 80})), vehicles)
+        assert (stats['vehicles'], stats['removed_vehicles']) == (1, 1)
+
+        assert ids(db, 'bus_trips', 'trip_id') == ['t1']
+        assert ids(db, 'bus_stop_times', 'trip_id') == ['t1']
+        assert ids(db, 'bus_vehicles', 'vehicle_id') == ['v2']
@@ -0,0 +1,152 @@
+import sqlite3
+import threading
+import pytest
+from DailyCommuterBackend.db import ConnectionPool, close_pools, get_db, get_pool, get_read_db, init_db, pool_stats
+from DailyCommuterBackend.gtfs_static import load_gtfs
+from DailyCommuterBackend.migrations import apply_migrations, get_version, MIGRATIONS
+
+
+def test_init_db_command(app, runner):
+    with app.app_context():
+        result = runner.invoke(args=['init-db'])
+    assert 'Initialized' in result.output
+
+
+def test_init_db_brings_the_schema_to_the_last_version(app):
+    with app.app_context():
+        db = get_db()
+        assert get_version(db) == len(MIGRATIONS)
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        indexes = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {'routes_userid', 'stop_update_stop', 'trip_update_route_id'} <= indexes
+
+
+def test_migrate_db_keeps_the_data_of_a_version_0_database(app, runner, tmp_path):
+    path = app.config['DATABASE']
+    # A database from before the migrations, with a route and its stops
+    with app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf8')
+    db = sqlite3.connect(path)
+    db.executescript(schema)
+    db.execute("INSERT INTO routes (routeid, start_address, end_address, arrival_time, userid)"
+               " VALUES (1, 'a', 'b', '09:00', 'u1')")
+    db.executemany('INSERT INTO points (routeid, lat, lon, name, type) VALUES (1, ?, ?, ?, ?)',
+                   [(40.7, -73.9, 'Start', 0), (40.8, -73.95, 'End', 2)])
+    db.commit()
+    db.close()
+
+    with app.app_context():
+        result = runner.invoke(args=['migrate-db'])
+    assert f'Database is at version {len(MIGRATIONS)}' in result.output
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT userid FROM routes WHERE routeid = 1').fetchone()[0] == 'u1'
+        assert db.execute('SELECT COUNT(*) FROM route_geometry WHERE routeid = 1').fetchone()[0] == 1
+
+    # Nothing left to apply the second time
+    with app.app_context():
+        result = runner.invoke(args=['migrate-db'])
+    assert 'Applied' not in result.output
+
+
+def test_apply_migrations_stops_at_target(app, tmp_path):
+    db = sqlite3.connect(tmp_path / 'target.sqlite')
+    with app.open_resource('schema.sql') as f:
+        db.executescript(f.read().decode('utf8'))
+    assert apply_migrations(db, target=2) == [1, 2]
+    assert get_version(db) == 2
+    assert apply_migrations(db)[0] == 3
+
+
+def test_init_db_again_drops_tables_with_rows_referencing_them(app, gtfs_zip):
+    with app.app_context():
+        db = get_db()
+        load_gtfs(db, gtfs_zip)
+        with db:
+            trip = db.execute("INSERT INTO trip_update (update_id, trip_id) VALUES ('e1', 't1')").lastrowid
+            db.execute("INSERT INTO stop_update (trip_update_id, arrival, departure, stop_id, direction)"
+                       " VALUES (?, 1, 1, 'A28', 'N')", (trip,))
+            alert = db.execute("INSERT INTO service_alerts (feed, alert_id, fingerprint, updated_at)"
+                               " VALUES ('feed', 'a1', 0, 0)").lastrowid
+            db.execute("INSERT INTO service_alert_entities (alert_row, route_id) VALUES (?, 'A')", (alert,))
+            db.execute("INSERT INTO service_alert_periods (alert_row, start) VALUES (?, 0)", (alert,))
+        assert db.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+        init_db()
+        assert db.execute('SELECT COUNT(*) FROM service_alerts').fetchone()[0] == 0
+        assert db.execute('SELECT COUNT(*) FROM subway_trips').fetchone()[0] == 0
+
+
+def test_app_contexts_reuse_one_pooled_connection(app):
+    with app.app_context():
+        first = get_db()
+        assert get_db() is first
+    with app.app_context():
+        assert get_db() is first
+    stats = get_pool(app.config['DATABASE']).stats()
+    assert stats['opened'] == 1
+    assert stats['idle'] == 1
+    assert stats['reused'] >= 1
+
+
+def test_read_db_is_read_only_and_pooled_apart(app):
+    with app.app_context():
+        db, read_db = get_db(), get_read_db()
+        assert read_db is not db
+        assert read_db.execute('SELECT COUNT(*) FROM routes').fetchone()[0] == 0
+        with pytest.raises(sqlite3.OperationalError, match='readonly'):
+            read_db.execute("INSERT INTO routes (start_address, end_address, arrival_time, userid)"
+                            " VALUES ('a', 'b', '09:00', 'u1')")
+    pools = {(pool['path'], pool['readonly']): pool for pool in pool_stats()}
+    assert pools[(app.config['DATABASE'], True)]['idle'] == 1
+    assert pools[(app.config['DATABASE'], False)]['idle'] == 1
+
+
+def test_release_rolls_back_what_was_left_uncommitted(app):
+    with app.app_context():
+        get_db().execute("INSERT INTO routes (start_address, end_address, arrival_time, userid)"
+                         " VALUES ('a', 'b', '09:00', 'u1')")
+    with app.app_context():
+        db = get_db()
+        assert not db.in_transaction
+        assert db.execute('SELECT COUNT(*) FROM routes').fetchone()[0] == 0
+
+
+def test_pool_keeps_at_most_size_idle_connections(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.sqlite'), size=2)
+    connections = [pool.acquire() for _ in range(3)]
+    for db in connections:
+        pool.release(db)
+    assert pool.stats() == {'idle': 2, 'opened': 3, 'reused': 0}
+    with pytest.raises(sqlite3.ProgrammingError):
+        connections[2].execute('SELECT 1')
+
+    pool.acquire()
+    assert pool.stats()['reused'] == 1
+    pool.close()
+    assert pool.stats()['idle'] == 0
+    with pytest.raises(sqlite3.ProgrammingError):
+        connections[0].execute('SELECT 1')
+
+
+def test_a_pooled_connection_moves_between_threads(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.sqlite'))
+    db = pool.acquire()
+    db.execute('CREATE TABLE t (x)')
+    pool.release(db)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(pool.acquire().execute('SELECT COUNT(*) FROM t').fetchone()[0]))
+    thread.start()
+    thread.join()
+    assert result == [0]
+    assert pool.stats()['reused'] == 1
+
+
+def test_close_pools_forgets_every_pool(app):
+    with app.app_context():
+        db = get_db()
+    close_pools()
+    assert pool_stats() == []
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute('SELECT 1')
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM routes').fetchone()[0] == 0
@@ -0,0 +1,123 @@
+from google.transit import gtfs_realtime_pb2
+from DailyCommuterBackend.apiRouting import api, feeds
+from DailyCommuterBackend.apiRouting.feeds import (
+    FeedPoller, FeedSource, peek_header_timestamp, UPDATED, NOT_MODIFIED, UNCHANGED, FAILED
+)
+from DailyCommuterBackend.scheduler import Scheduler, get_feed_status, refresh_subway
+
+
+def feed_bytes(timestamp, trips=1):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+    for n in range(trips):
+        entity = feed.entity.add()
+        entity.id = f'trip{n}'
+        entity.trip_update.trip.trip_id = f'T{n}'
+    return feed.SerializeToString()
+
+
+# Serves body with an ETag and answers 304 when the client already has it
+def etag_route(body, etag='"v1"'):
+    def handler(request):
+        if request.headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag}, body
+    return handler
+
+
+def test_peek_header_timestamp():
+    assert peek_header_timestamp(feed_bytes(1700000000, trips=3)) == 1700000000
+    assert peek_header_timestamp(b'') is None
+    assert peek_header_timestamp(b'\x12\x00') is None
+
+
+def test_poll_fetches_every_feed_and_sends_validators(server):
+    for name in ('a', 'b', 'c'):
+        server.routes[f'/{name}'] = etag_route(feed_bytes(100))
+    poller = FeedPoller([f'{server.url}/{name}' for name in ('a', 'b', 'c')])
+
+    results = poller.poll()
+    assert [result.status for result in results] == [UPDATED] * 3
+    assert all(len(result.feed.entity) == 1 for result in results)
+
+    results = poller.poll()
+    assert [result.status for result in results] == [NOT_MODIFIED] * 3
+    assert all(request[2].get('If-None-Match') == '"v1"' for request in server.requests[3:])
+    # The copy we already have is still handed back
+    assert all(result.feed is not None for result in results)
+
+
+def test_same_version_is_not_parsed_again(server):
+    server.routes['/feed'] = lambda request: (200, {}, feed_bytes(100))
+    source = FeedSource(f'{server.url}/feed')
+    first = source.fetch()
+    second = source.fetch()
+    assert first.status == UPDATED
+    assert second.status == UNCHANGED
+    assert second.feed is first.feed
+
+
+def test_one_failing_feed_does_not_stop_the_others(server):
+    server.routes['/ok'] = lambda request: (200, {}, feed_bytes(100))
+    server.routes['/down'] = lambda request: (500, {}, b'')
+    server.routes['/garbage'] = lambda request: (200, {}, b'\xff\xff\xff')
+    poller = FeedPoller([f'{server.url}/ok', f'{server.url}/down', f'{server.url}/garbage'])
+    assert [result.status for result in poller.poll()] == [UPDATED, FAILED, FAILED]
+
+
+def test_body_over_the_limit_fails(server):
+    server.routes['/big'] = lambda request: (200, {}, feed_bytes(100, trips=50))
+    source = FeedSource(f'{server.url}/big', max_bytes=100)
+    assert source.fetch().status == FAILED
+
+
+def test_a_version_is_kept_only_once_the_subscribers_took_it(server):
+    server.routes['/feed'] = etag_route(feed_bytes(100))
+    poller = FeedPoller([f'{server.url}/feed'])
+    ingested = []
+
+    def consumer(snapshot):
+        if not ingested:
+            ingested.append(None)
+            raise RuntimeError('database is locked')
+        ingested.append(snapshot.version)
+    poller.subscribe(consumer)
+
+    result, = poller.poll()
+    assert result.status == FAILED and 'database is locked' in result.error
+    assert poller.sources[0].state.etag is None and poller.sources[0].state.snapshot is None
+
+    # Downloaded again without validators and ingested this time
+    result, = poller.poll()
+    assert result.status == UPDATED and result.error is None
+    assert server.requests[1][2].get('If-None-Match') is None
+    assert ingested == [None, 100]
+    assert poller.sources[0].state.etag == '"v1"' and poller.sources[0].state.timestamp == 100
+    assert poller.poll()[0].status == NOT_MODIFIED
+
+
+def test_ingest_errors_reach_feed_status(app, server, monkeypatch):
+    server.routes['/feed'] = lambda request: (200, {}, feed_bytes(100))
+    poller = FeedPoller([f'{server.url}/feed'])
+
+    def consumer(snapshot):
+        raise RuntimeError('disk full')
+    poller.subscribe(consumer)
+    monkeypatch.setattr(api, 'subway_poller', poller)
+
+    scheduler = Scheduler()
+    scheduler.add_job('subway', refresh_subway, 30)
+    with app.app_context():
+        assert not scheduler.run_job(scheduler.jobs['subway'])
+        status = {row['name']: row for row in get_feed_status()}
+    assert status['subway']['failures'] == 1 and 'disk full' in status['subway']['last_error']
+
+
+def test_fetch_data_adds_the_key_to_the_query(server, monkeypatch):
+    monkeypatch.setattr(feeds, '_sources', {})
+    server.routes['/feed'] = lambda request: (200, {}, feed_bytes(100))
+    assert api.fetch_data(f'{server.url}/feed', key='a b') is not None
+    assert api.fetch_data(f'{server.url}/feed?format=pb', key='k') is not None
+    assert [request[1] for request in server.requests] == ['/feed?key=a+b', '/feed?format=pb&key=k']
+    assert feeds.get_source(f'{server.url}/feed?key=a+b').name == f'{server.url}/feed'
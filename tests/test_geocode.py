@@ -0,0 +1,66 @@
+import threading
+import time
+from DailyCommuterBackend.apiRouting.geocode import GeocodeCache, TokenBucket, normalize_address
+
+
+class Fetcher:
+    def __init__(self, delay=0):
+        self.calls = []
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self, address):
+        with self._lock:
+            self.calls.append(address)
+        time.sleep(self.delay)
+        return 40.69, -73.98
+
+
+def test_normalize_address():
+    assert normalize_address('370 Jay St., Brooklyn') == normalize_address('370  jay st brooklyn')
+
+
+def test_only_misses_are_fetched(app):
+    fetch = Fetcher()
+    with app.app_context():
+        cache = GeocodeCache(limiter=TokenBucket(rate=1000))
+        assert cache.lookup('370 Jay St', fetch) == (40.69, -73.98)
+        assert cache.lookup('370 jay st.', fetch) == (40.69, -73.98)
+        # A new process finds it in the geocode_cache table
+        assert GeocodeCache(limiter=TokenBucket(rate=1000)).lookup('370 Jay St', fetch) == (40.69, -73.98)
+    assert fetch.calls == ['370 Jay St']
+
+
+def test_concurrent_lookups_of_one_address_share_the_call(app):
+    fetch = Fetcher(delay=0.2)
+    cache = GeocodeCache(limiter=TokenBucket(rate=1000))
+    results = []
+
+    def lookup():
+        with app.app_context():
+            results.append(cache.lookup('1 Main St', fetch))
+
+    threads = [threading.Thread(target=lookup) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [(40.69, -73.98)] * 5
+    assert len(fetch.calls) == 1
+
+
+def test_the_lru_is_bounded(app):
+    with app.app_context():
+        cache = GeocodeCache(max_size=2, limiter=TokenBucket(rate=1000))
+        for address in ('a st', 'b st', 'c st'):
+            cache.lookup(address, Fetcher())
+    assert list(cache._entries) == ['b st', 'c st']
+
+
+def test_token_bucket_spaces_out_calls():
+    bucket = TokenBucket(rate=20, capacity=1)
+    started = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    # The first token is there already, the next three take 1/20 s each
+    assert time.monotonic() - started >= 0.14
@@ -0,0 +1,37 @@
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.geometry import decode_polyline, encode_polyline, load_route_stops, save_route_stops
+
+
+def test_encode_polyline_matches_the_reference():
+    # The example from Google's polyline algorithm documentation
+    coords = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    assert encode_polyline(coords) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    assert decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@') == coords
+
+
+def test_round_trip_keeps_five_decimals():
+    coords = [(40.752726, -73.993391), (40.740893, -74.001690), (40.740893, -74.001690), (0.0, 0.0)]
+    decoded = decode_polyline(encode_polyline(coords))
+    assert len(decoded) == len(coords)
+    for (lat, lon), (back_lat, back_lon) in zip(coords, decoded):
+        assert abs(lat - back_lat) <= 0.5e-5 and abs(lon - back_lon) <= 0.5e-5
+    assert encode_polyline([]) == '' and decode_polyline('') == []
+
+
+def test_route_stops_are_one_row(app):
+    stops = [
+        {'lat': 40.69312, 'lon': -73.98741, 'name': 'Start', 'type': 0},
+        {'lat': 40.75273, 'lon': -73.99339, 'name': '34 St-Penn Station', 'type': 1},
+        {'lat': 40.74089, 'lon': -74.00169, 'name': '', 'type': 2},
+    ]
+    with app.app_context():
+        db = get_db()
+        routeid = db.execute(
+            "INSERT INTO routes (start_address, end_address, arrival_time, userid) VALUES ('a', 'b', '09:00', 'u1')"
+        ).lastrowid
+        assert load_route_stops(db, routeid) == []
+        save_route_stops(db, routeid, stops)
+        save_route_stops(db, routeid, stops[1:])    # replanning replaces the row
+        db.commit()
+        assert db.execute('SELECT COUNT(*) FROM route_geometry').fetchone()[0] == 1
+        assert load_route_stops(db, routeid) == stops[1:]
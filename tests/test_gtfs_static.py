@@ -0,0 +1,43 @@
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.gtfs_static import Timetable, load_gtfs, parse_gtfs_time
+
+
+def test_parse_gtfs_time_runs_past_midnight():
+    assert parse_gtfs_time('09:00:30') == 32430
+    assert parse_gtfs_time('25:10:00') == 90600
+
+
+def test_load_gtfs_replaces_the_schedule(app, gtfs_zip):
+    with app.app_context():
+        db = get_db()
+        counts = load_gtfs(db, gtfs_zip)
+        assert counts == {'stops': 9, 'services': 1, 'routes': 2, 'trips': 3, 'stop_times': 7}
+        # Loading again replaces the rows instead of adding to them
+        assert load_gtfs(db, gtfs_zip) == counts
+        assert db.execute('SELECT COUNT(*) FROM subway_stop_times').fetchone()[0] == 7
+        assert db.execute(
+            "SELECT parent_station_global_stop_id FROM subway_stops WHERE global_stop_id = 'A28N'"
+        ).fetchone()[0] == 'A28'
+        assert db.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'subway_stop_times_stop_id'"
+        ).fetchone()
+
+
+def test_timetable_lookups(app, gtfs_zip):
+    with app.app_context():
+        db = get_db()
+        load_gtfs(db, gtfs_zip)
+        timetable = Timetable.from_db(db)
+
+    assert len(timetable) == 7
+    assert timetable.trip_stops('A_0900_N') == [
+        ('A28N', 32400, 32430), ('A27N', 32520, 32550), ('A25N', 32700, 32730),
+    ]
+    assert timetable.trip_stops('C_2350_N')[-1] == ('A25N', 86460, 86490)
+    # Ordered by departure, from the given time on
+    assert timetable.departures('A28N', 9 * 3600) == [
+        ('A_0900_N', 'A', 32430), ('A_0910_N', 'A', 33030), ('C_2350_N', 'C', 85830),
+    ]
+    assert timetable.departures('A28N', 9 * 3600 + 60, limit=1) == [('A_0910_N', 'A', 33030)]
+    assert timetable.departures('A27N', 24 * 3600) == []
+    assert timetable.departures('nowhere', 0) == []
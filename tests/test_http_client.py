@@ -0,0 +1,135 @@
+import socket
+import threading
+import time
+import pytest
+import requests
+from email.utils import formatdate
+from DailyCommuterBackend.apiRouting import http_client as http_module
+from DailyCommuterBackend.apiRouting.http_client import HttpClient, LatencyHistogram, retry_after
+from DailyCommuterBackend.notifications import HttpSink
+
+
+def ok(request):
+    return 200, {'Content-Type': 'text/plain'}, b'ok'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = HttpClient()
+    # No waiting between retries
+    monkeypatch.setattr(client, 'backoff', lambda attempt, response=None: 0)
+    return client
+
+
+def test_calls_to_one_host_reuse_one_connection(server, client):
+    server.routes['/feed'] = ok
+    for _ in range(50):
+        assert client.get(f'{server.url}/feed').text == 'ok'
+    assert len(server.requests) == 50
+    assert len(server.connections) == 1
+    stats = client.stats()[f'127.0.0.1:{server.url.rsplit(":", 1)[1]}/feed']
+    assert stats['calls'] == 50
+    assert stats['errors'] == 0
+
+
+def test_latency_is_recorded_without_the_query(server, client):
+    server.routes['/feed'] = ok
+    client.get(f'{server.url}/feed?key=secret')
+    assert [endpoint.endswith('/feed') for endpoint in client.stats()] == [True]
+
+
+def test_503_is_retried(server, client):
+    answers = iter([503, 503, 200])
+    server.routes['/feed'] = lambda request: (next(answers), {}, b'ok')
+    response = client.get(f'{server.url}/feed')
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+    stats = next(iter(client.stats().values()))
+    assert stats['calls'] == 3
+    assert stats['errors'] == 2
+    assert stats['retries'] == 2
+
+
+def test_the_last_503_is_returned(server, client):
+    server.routes['/feed'] = lambda request: (503, {}, b'')
+    assert client.get(f'{server.url}/feed').status_code == 503
+    assert len(server.requests) == client.retries + 1
+
+
+def test_post_is_only_retried_when_asked(server, client):
+    server.routes['/sink'] = lambda request: (503, {}, b'')
+    assert client.post(f'{server.url}/sink', json={}).status_code == 503
+    assert len(server.requests) == 1
+    client.post(f'{server.url}/sink', json={}, retries=1)
+    assert len(server.requests) == 3
+
+
+def test_refused_connection_is_retried(client):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get(f'http://127.0.0.1:{port}/feed')
+    stats = client.stats()[f'127.0.0.1:{port}/feed']
+    assert stats['calls'] == client.retries + 1
+    assert stats['errors'] == client.retries + 1
+    assert stats['retries'] == client.retries
+
+
+def test_calls_in_flight_per_host_are_capped(server, client):
+    client.set_host_limit(f'127.0.0.1:{server.url.rsplit(":", 1)[1]}', 2)
+    in_flight, most = [0], [0]
+    lock = threading.Lock()
+
+    def slow(request):
+        with lock:
+            in_flight[0] += 1
+            most[0] = max(most[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return ok(request)
+
+    server.routes['/slow'] = slow
+    threads = [threading.Thread(target=client.get, args=(f'{server.url}/slow',)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(server.requests) == 6
+    assert most[0] == 2
+
+
+def test_http_sink_host_gets_a_slot_per_worker(monkeypatch):
+    client = HttpClient()
+    monkeypatch.setattr('DailyCommuterBackend.notifications.http_client', client)
+    HttpSink('https://push.example.com/notify', workers=12)
+    assert client.host_limits['push.example.com'] == 12
+    assert client._slot('push.example.com')._value == 12
+    # The module's table isn't touched
+    assert 'push.example.com' not in http_module.HOST_LIMITS
+
+
+def test_retry_after():
+    class Response:
+        def __init__(self, headers):
+            self.headers = headers
+
+    assert retry_after(None) is None
+    assert retry_after(Response({})) is None
+    assert retry_after(Response({'Retry-After': '3'})) == 3
+    assert retry_after(Response({'Retry-After': 'soon'})) is None
+    assert 0 < retry_after(Response({'Retry-After': formatdate(time.time() + 60, usegmt=True)})) <= 60
+    assert HttpClient().backoff(0, Response({'Retry-After': '600'})) == http_module.BACKOFF_MAX
+
+
+def test_latency_histogram_quantiles():
+    histogram = LatencyHistogram(buckets=[10, 100])
+    assert histogram.quantile(0.5) is None
+    for ms in [1, 2, 3, 50, 500]:
+        histogram.record(ms, error=ms > 100)
+    stats = histogram.as_dict()
+    assert stats['p50_ms'] == 10
+    assert stats['p95_ms'] is None
+    assert stats['errors'] == 1
+    assert stats['buckets'] == {'<=10': 3, '<=100': 1, '>100': 1}
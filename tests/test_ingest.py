@@ -0,0 +1,148 @@
+import sqlite3
+import pytest
+from google.transit import gtfs_realtime_pb2
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.apiRouting.ingest import FeedDiff, fingerprint, ingest_feed
+
+
+# trips: {entity id: [(stop_id with direction, arrival), ...]}
+def train_feed(trips, vehicles=()):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = 1700000000
+    for entity_id, stops in trips.items():
+        entity = feed.entity.add()
+        entity.id = entity_id
+        update = entity.trip_update
+        update.trip.trip_id = f'{entity_id}_trip'
+        update.trip.route_id = 'A'
+        update.trip.start_date = '20250516'
+        for stop_id, arrival in stops:
+            stop = update.stop_time_update.add()
+            stop.stop_id = stop_id
+            stop.arrival.time = arrival
+            stop.departure.time = arrival + 30
+    for entity_id, stop_id in vehicles:
+        entity = feed.entity.add()
+        entity.id = f'{entity_id}_vehicle'
+        entity.vehicle.trip.trip_id = f'{entity_id}_trip'
+        entity.vehicle.timestamp = 1700000000
+        entity.vehicle.stop_id = stop_id
+    return feed
+
+
+def count(db, table):
+    return db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+def test_ingest_writes_trips_stops_and_vehicles(app):
+    feed = train_feed(
+        {'t1': [('A28N', 100), ('A27N', 200)], 't2': [('A28S', 300)]},
+        vehicles=[('t1', 'A28N')],
+    )
+    with app.app_context():
+        db = get_db()
+        stats = ingest_feed(db, feed)
+        assert stats['entities'] == 3
+        assert count(db, 'trip_update') == 2
+        assert count(db, 'vehicle_update') == 1
+        rows = db.execute(
+            'SELECT t.update_id, s.stop_id, s.direction, s.arrival, s.departure FROM stop_update s'
+            ' JOIN trip_update t ON t.id = s.trip_update_id ORDER BY s.arrival'
+        ).fetchall()
+        assert [tuple(row) for row in rows] == [
+            ('t1', 'A28', 'N', 100, 130), ('t1', 'A27', 'N', 200, 230), ('t2', 'A28', 'S', 300, 330),
+        ]
+
+
+def test_duplicate_entities_and_stops_are_written_once(app):
+    feed = train_feed({'t1': [('A28N', 100), ('A28N', 150)]})
+    duplicate = feed.entity.add()
+    duplicate.CopyFrom(feed.entity[0])
+    with app.app_context():
+        db = get_db()
+        ingest_feed(db, feed)
+        assert count(db, 'trip_update') == 1
+        # A stop listed twice keeps its last prediction
+        assert db.execute('SELECT arrival FROM stop_update').fetchall()[0][0] == 150
+
+
+def test_a_failed_write_leaves_nothing_behind(app):
+    feed = train_feed({'t1': [('A28N', 100)]}, vehicles=[('t1', 'A28N')])
+    with app.app_context():
+        db = get_db()
+        db.execute("CREATE TRIGGER fail BEFORE INSERT ON vehicle_update BEGIN SELECT RAISE(ABORT, 'no'); END")
+        with pytest.raises(sqlite3.IntegrityError):
+            ingest_feed(db, feed)
+        assert count(db, 'trip_update') == 0
+        assert count(db, 'stop_update') == 0
+
+
+def test_fingerprint_follows_the_stop_vector():
+    stops = [(100, 130, 'A28', 'N'), (200, 230, 'A27', 'N')]
+    assert fingerprint(stops) == fingerprint(list(stops))
+    assert fingerprint(stops) != fingerprint(stops[::-1])
+    assert fingerprint(stops) != fingerprint([(100, 130, 'A28', 'N'), (260, 290, 'A27', 'N')])
+
+
+def test_only_changed_trips_are_written(app):
+    diff = FeedDiff()
+    with app.app_context():
+        db = get_db()
+        first = ingest_feed(db, train_feed({'t1': [('A28N', 100)], 't2': [('A28S', 300)]}), diff)
+        assert (first['new'], first['changed'], first['stops']) == (2, 0, 2)
+
+        # t1 is late, t2 is gone and t3 is new
+        second = ingest_feed(db, train_feed({'t1': [('A28N', 160)], 't3': [('A27S', 400)]}), diff)
+        assert (second['new'], second['changed'], second['unchanged'], second['removed']) == (1, 1, 0, 1)
+        assert second['stops'] == 2
+        assert db.execute("SELECT arrival FROM stop_update WHERE stop_id = 'A28' AND direction = 'N'").fetchone()[0] == 160
+        assert db.execute("SELECT retired_at IS NOT NULL FROM trip_update WHERE update_id = 't2'").fetchone()[0]
+
+        third = ingest_feed(db, train_feed({'t1': [('A28N', 160)], 't3': [('A27S', 400)]}), diff)
+        assert (third['unchanged'], third['stops']) == (2, 0)
+
+
+def test_a_restart_compares_with_the_stored_fingerprints(app):
+    feed = train_feed({'t1': [('A28N', 100)], 't2': [('A28S', 300)]})
+    with app.app_context():
+        db = get_db()
+        ingest_feed(db, feed, FeedDiff())
+        stats = ingest_feed(db, feed, FeedDiff())
+        assert (stats['new'], stats['changed'], stats['unchanged']) == (0, 0, 2)
+
+
+def test_a_diff_is_only_kept_once_committed(app):
+    diff = FeedDiff()
+    with app.app_context():
+        db = get_db()
+        ingest_feed(db, train_feed({'t1': [('A28N', 100)]}), diff)
+        db.execute("CREATE TRIGGER fail BEFORE UPDATE ON trip_update BEGIN SELECT RAISE(ABORT, 'no'); END")
+        with pytest.raises(sqlite3.IntegrityError):
+            ingest_feed(db, train_feed({'t1': [('A28N', 160)]}), diff)
+        db.execute('DROP TRIGGER fail')
+        # The rolled back version is written again on the retry
+        stats = ingest_feed(db, train_feed({'t1': [('A28N', 160)]}), diff)
+        assert stats['changed'] == 1
+        assert db.execute('SELECT arrival FROM stop_update').fetchone()[0] == 160
+
+
+def test_a_vehicle_whose_trip_is_not_in_the_feed(app):
+    diff = FeedDiff()
+    with app.app_context():
+        db = get_db()
+        ingest_feed(db, train_feed({'t1': [('A28N', 100)]}), diff)
+        # t1's trip update is gone but its vehicle is still reported, it goes on t1's row
+        stats = ingest_feed(db, train_feed({}, vehicles=[('t1', 'A27N')]), diff)
+        assert stats['vehicles'] == 1
+        assert db.execute(
+            "SELECT t.update_id FROM vehicle_update v JOIN trip_update t ON t.id = v.trip_update_id"
+        ).fetchall()[0][0] == 't1'
+
+        # No row for t9 yet, so it isn't remembered and is written once its trip shows up
+        stats = ingest_feed(db, train_feed({}, vehicles=[('t9', 'A28S')]), diff)
+        assert stats['vehicles'] == 0
+        assert 't9_trip' not in diff.vehicles
+        stats = ingest_feed(db, train_feed({'t9': [('A28S', 300)]}, vehicles=[('t9', 'A28S')]), diff)
+        assert stats['vehicles'] == 1
+        assert count(db, 'vehicle_update') == 2
@@ -0,0 +1,52 @@
+import time
+from DailyCommuterBackend import create_app
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.apiRouting import api
+from DailyCommuterBackend.jobs import DONE, FAILED, QUEUED, RUNNING, fail_stale_jobs
+
+
+def add_job(db, job_id, status, updated_at):
+    with db:
+        db.execute(
+            "INSERT INTO route_jobs (job_id, status, userid, created_at, updated_at) VALUES (?, ?, 'u1', ?, ?)",
+            (job_id, status, updated_at, updated_at)
+        )
+
+
+def job_status(db, job_id):
+    return db.execute('SELECT status FROM route_jobs WHERE job_id = ?', (job_id,)).fetchone()[0]
+
+
+def test_only_old_unfinished_jobs_are_failed(app):
+    now = 1_700_000_000
+    with app.app_context():
+        db = get_db()
+        add_job(db, 'old-queued', QUEUED, now - 600)
+        add_job(db, 'old-running', RUNNING, now - 600)
+        add_job(db, 'old-done', DONE, now - 600)
+        add_job(db, 'new-running', RUNNING, now - 10)
+        assert fail_stale_jobs(db, 300, now) == 2
+        assert [job_status(db, job) for job in ('old-queued', 'old-running', 'old-done', 'new-running')] \
+            == [FAILED, FAILED, DONE, RUNNING]
+
+
+def test_startup_fails_jobs_left_behind(app, client):
+    with app.app_context():
+        add_job(get_db(), 'orphan', RUNNING, int(time.time()) - 3600)
+    create_app({**app.config, 'TESTING': True})
+
+    job = client.get('/addRoute/jobs/orphan').json
+    assert job['status'] == FAILED and 'restarted' in job['error']
+
+
+def test_a_route_job_runs_to_done(app, client, transit, monkeypatch):
+    monkeypatch.setattr(api, 'geocoder', lambda address: (40.69312, -73.98741))
+    response = client.post('/addRoute', json={'start_address': 'a', 'end_address': 'b', 'arriveby': '09:00'})
+    assert response.status_code == 202
+
+    deadline = time.time() + 5
+    while (job := client.get(response.json['status_url']).json)['status'] not in (DONE, FAILED):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    assert job['status'] == DONE and job['redirect_url'] == f"/displayroute/{job['routeid']}"
+    assert len(transit.calls) == 1
@@ -0,0 +1,88 @@
+import json
+from DailyCommuterBackend import create_app
+from DailyCommuterBackend.db import get_db, init_db
+from DailyCommuterBackend.notifications import (
+    MAX_ATTEMPTS, Dispatcher, FileSink, claim, dispatch_due, enqueue, get_dispatcher
+)
+
+
+class Transport:
+    # Fails every notification for the users in failing
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.batches = []
+
+    def send(self, notifications):
+        self.batches.append([n.userid for n in notifications])
+        return ['push service said no' if n.userid in self.failing else None for n in notifications]
+
+
+def test_a_users_changes_are_one_notification(app):
+    with app.app_context():
+        db = get_db()
+        assert enqueue(db, [('u1', 1, 'old'), ('u2', 3, 'c')], delay=0) == 2
+        enqueue(db, [('u1', 1, 'new'), ('u1', 2, 'b')], delay=0)
+        notifications = {n.userid: n for n in claim(db)}
+        assert claim(db) == []
+    assert notifications['u1'].messages == {'1': 'new', '2': 'b'}
+    assert notifications['u1'].title == '2 of your commutes changed'
+    assert notifications['u2'].payload() == {'userid': 'u2', 'title': 'Your commute changed', 'body': 'c', 'routes': [3]}
+
+
+def test_nothing_is_sent_before_the_coalescing_window_ends(app):
+    with app.app_context():
+        db = get_db()
+        enqueue(db, [('u1', 1, 'a')])
+        assert claim(db) == []
+
+
+def test_failed_notifications_are_retried_then_dropped(app):
+    transport = Transport(failing={'u2'})
+    dispatcher = Dispatcher(transport, workers=2, batch_size=2)
+    with app.app_context():
+        db = get_db()
+        enqueue(db, [('u1', 1, 'a'), ('u2', 2, 'b'), ('u3', 3, 'c')], delay=0)
+        assert dispatcher.dispatch(db) == {'sent': 2, 'retrying': 1, 'dropped': 0}
+        assert sorted(len(batch) for batch in transport.batches) == [1, 2]
+        attempts, error = db.execute("SELECT attempts, last_error FROM notification_queue WHERE userid = 'u2'").fetchone()
+        assert (attempts, error) == (1, 'push service said no')
+
+        for _ in range(MAX_ATTEMPTS - 1):
+            with db:
+                db.execute('UPDATE notification_queue SET due_at = 0')
+            counts = dispatcher.dispatch(db)
+        assert counts == {'sent': 0, 'retrying': 0, 'dropped': 1}
+        assert db.execute('SELECT COUNT(*) FROM notification_queue').fetchone()[0] == 0
+    dispatcher.close()
+
+
+def test_file_sink_writes_json_lines(app, tmp_path):
+    sink = FileSink(str(tmp_path / 'out.jsonl'))
+    dispatcher = Dispatcher(sink)
+    with app.app_context():
+        db = get_db()
+        enqueue(db, [('u1', 1, 'a'), ('u2', 2, 'b')], delay=0)
+        assert dispatcher.dispatch(db)['sent'] == 2
+    dispatcher.close()
+    lines = [json.loads(line) for line in (tmp_path / 'out.jsonl').read_text().splitlines()]
+    assert sorted(line['userid'] for line in lines) == ['u1', 'u2']
+
+
+def test_each_app_sends_to_its_own_sink(app, tmp_path):
+    other = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'other.sqlite'),
+        'BUS_DATABASE': str(tmp_path / 'other-bus.sqlite'),
+        'NOTIFY_SINK': str(tmp_path / 'other.jsonl'),
+    })
+    with other.app_context():
+        init_db()
+    for current in (app, other):
+        with current.app_context():
+            enqueue(get_db(), [('u1', 1, current.config['NOTIFY_SINK'])], delay=0)
+            assert dispatch_due()['sent'] == 1
+            assert get_dispatcher() is current.extensions['notifications']
+    assert app.extensions['notifications'] is not other.extensions['notifications']
+    for current in (app, other):
+        with open(current.config['NOTIFY_SINK']) as f:
+            assert [json.loads(line)['body'] for line in f] == [current.config['NOTIFY_SINK']]
@@ -0,0 +1,121 @@
+import json
+import time
+from datetime import datetime
+import pytest
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.gtfs_static import TIMEZONE
+from DailyCommuterBackend.outages import (
+    CURRENT, UPCOMING, OutageIndex, StopResolver, ingest_equipment, ingest_outages, iter_json_array, parse_time
+)
+
+DOCUMENT = json.dumps([
+    {'station': '34 St-Penn Station', 'equipment': 'EL101', 'serving': 'Street to mezzanine – é',
+     'ADA': 'Y', 'count': 1234, 'ratio': -1.5e3, 'flags': [True, False, None]},
+    12345,
+    'plain text',
+    {'nested': {'deeper': [1, 2, {'x': 'y'}]}},
+]).encode()
+
+
+def split(data, *cuts):
+    bounds = [0, *cuts, len(data)]
+    return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def test_items_come_out_whatever_the_chunk_boundaries():
+    expected = json.loads(DOCUMENT)
+    for cut in range(1, len(DOCUMENT)):
+        assert list(iter_json_array(split(DOCUMENT, cut))) == expected
+    assert list(iter_json_array([bytes([byte]) for byte in DOCUMENT])) == expected
+
+
+def test_a_number_cut_by_a_chunk_boundary_is_read_whole():
+    assert list(iter_json_array([b'[12', b'34, 5]'])) == [1234, 5]
+    assert list(iter_json_array([b'[1.5', b'e3]'])) == [1500.0]
+    assert list(iter_json_array([b'[1.5e', b'3]'])) == [1500.0]
+    assert list(iter_json_array([b'[', b'7', b']'])) == [7]
+
+
+def test_a_malformed_item_stops_the_parse_right_away():
+    read = []
+
+    def chunks():
+        yield b'[{"a": 1}, {"a": tru e}, '
+        for n in range(1000):
+            read.append(n)
+            yield b'{"b": 2}, ' * 100
+        yield b']'
+
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunks()))
+    assert len(read) <= 1
+
+
+@pytest.mark.parametrize('chunks', [
+    [b'{"a": 1}'],
+    [b'[1, 2'],
+    [b'[{"a": 1}'],
+    [b'[1 x]'],
+    [b'[{"a": 1}}]'],
+])
+def test_broken_documents_raise(chunks):
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunks))
+
+
+def test_parse_time_is_new_york_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    try:
+        expected = int(datetime(2025, 5, 16, 9, tzinfo=TIMEZONE).timestamp())
+        assert parse_time('05/16/2025 09:00:00 AM') == expected
+        assert parse_time('05/16/2025 09:00 AM') == expected
+        assert parse_time('2025-05-16T09:00:00') == expected
+        assert parse_time('soon') is None and parse_time(None) is None
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+NOW = int(datetime(2025, 5, 16, 12, tzinfo=TIMEZONE).timestamp())
+
+
+def outage(equipment_id, feed, start, end, stop_id='A28'):
+    return {'equipment_id': equipment_id, 'stop_id': stop_id, 'station': '34 St-Penn Station', 'type': 'EL',
+            'serving': None, 'ada': True, 'start': start, 'end': end, 'reason': None,
+            'upcoming': feed == UPCOMING, 'current': feed == CURRENT}
+
+
+def test_current_outages_are_out_until_the_feed_drops_them():
+    index = OutageIndex([
+        outage('EL1', CURRENT, NOW - 7200, NOW - 3600),     # overdue
+        outage('EL2', UPCOMING, NOW + 3600, NOW + 7200),
+        outage('EL3', UPCOMING, NOW - 60, NOW + 60),        # planned, under way
+    ], {'A28'})
+    assert [o['equipment_id'] for o in index.at_station('A28N', NOW)] == ['EL1', 'EL3']
+    assert [o['equipment_id'] for o in index.at_station('A28', NOW, upcoming=True)] == ['EL1', 'EL2', 'EL3']
+    assert [o['equipment_id'] for o in index.at_station('A28', NOW + 3600)] == ['EL1', 'EL2']
+    assert index.step_free(['A28S'], NOW)['step_free'] is False
+
+
+def test_outages_from_the_feeds(app):
+    resolver = StopResolver([('A28', '34 St-Penn Station'), ('A27', '42 St-Port Authority')])
+    with app.app_context():
+        db = get_db()
+        assert ingest_equipment(db, [
+            {'equipmentno': 'EL101', 'station': '34 St-Penn Station', 'equipmenttype': 'EL', 'ADA': 'Y',
+             'elevatorsgtfsstopid': 'A28/128'},
+            {'equipmentno': 'EL102', 'station': '42 St-Port Authority', 'equipmenttype': 'EL', 'ADA': 'Y'},
+        ], resolver) == 2
+        assert ingest_outages(db, CURRENT, [
+            # Estimated back an hour ago, still listed
+            {'equipment': 'EL101', 'station': '34 St-Penn Station', 'equipmenttype': 'EL', 'ADA': 'Y',
+             'outagedate': '05/16/2025 08:00:00 AM', 'estimatedreturntoservice': '05/16/2025 11:00:00 AM'},
+            {'equipment': 'EL999', 'station': 'Nowhere'},
+        ], resolver) == (2, 1)
+        index = OutageIndex.from_db(db)
+    assert index.accessible == {'A28', 'A27'}
+    assert [o['equipment_id'] for o in index.at_station('A28', NOW)] == ['EL101']
+    result = index.step_free(['A28N', 'A27S'], NOW)
+    assert result['step_free'] is False
+    assert [station['step_free'] for station in result['stations']] == [False, True]
@@ -0,0 +1,77 @@
+import time
+import pytest
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.models import Route
+from DailyCommuterBackend.apiRouting import api
+from DailyCommuterBackend.apiRouting.plan_cache import PlanCache, bucket_time, snap_coord
+
+
+def test_snap_coord_and_bucket_time():
+    assert snap_coord(40.69312, -73.98741) == (40.693, -73.987)
+    assert bucket_time('9:07am') == '09:05'
+    assert bucket_time('09:04') == '09:00'
+    assert bucket_time('17:59:59') == '17:55'
+    assert bucket_time('whenever') == 'whenever'
+
+
+def test_entries_expire_and_the_oldest_is_evicted():
+    cache = PlanCache(max_size=2, ttl=900)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)   # 'b' is the least recently used
+    assert cache.get('b') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    # Plans stored before `since` are a miss
+    since = time.monotonic()
+    assert cache.get('a', since=since) is None
+    cache.put('a', 4)
+    assert cache.get('a', since=since) == 4
+
+    expiring = PlanCache(ttl=0.01)
+    expiring.put('a', 1)
+    time.sleep(0.02)
+    assert expiring.get('a') is None
+
+
+def add_route(db, lat, lon, arrival_time='09:07'):
+    routeid = db.execute(
+        'INSERT INTO routes (start_address, end_address, start_lat, start_lon, end_lat, end_lon, arrival_time, userid)'
+        " VALUES ('a', 'b', ?, ?, 40.74, -74.0, ?, 'u1')",
+        (lat, lon, arrival_time)
+    ).lastrowid
+    db.commit()
+    return api.getRoute(routeid)
+
+
+def test_nearby_routes_share_one_transit_call(app, transit):
+    with app.app_context():
+        db = get_db()
+        first = add_route(db, 40.69312, -73.98741)
+        second = add_route(db, 40.69288, -73.98709, arrival_time='09:09')
+        api.Router(first)
+        api.Router(second)
+        assert second.estimateTime == 1200
+        assert db.execute('SELECT COUNT(*) FROM route_geometry').fetchone()[0] == 2
+    assert len(transit.calls) == 1
+    params = transit.calls[0][1]
+    assert params['fromPlace'] == '40.693,-73.987' and params['time'] == '09:05'
+
+
+
+@pytest.fixture
+def host_in_utc(monkeypatch):
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_transit_is_asked_for_the_new_york_service_day(app, transit, host_in_utc, monkeypatch):
+    # 02:00 UTC on May 17th is still 10pm on May 16th in New York
+    monkeypatch.setattr(time, 'time', lambda: 1747447200)
+    with app.app_context():
+        api.Router(add_route(get_db(), 40.69312, -73.98741))
+    assert transit.calls[0][1]['date'] == '2025-05-16'
@@ -0,0 +1,71 @@
+import time
+from datetime import date, datetime
+import pytest
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.gtfs_static import TIMEZONE, Timetable, load_gtfs
+from DailyCommuterBackend.planner import Planner, midnight_epoch, realtime_trip_id
+
+PENN = (40.752287, -73.993391)      # A28
+FIFTIETH = (40.762456, -73.985984)  # A25
+FRIDAY = date(2025, 5, 16)
+
+
+# The host's timezone must not matter
+@pytest.fixture(autouse=True)
+def host_in_utc(monkeypatch):
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def planner(app, gtfs_zip):
+    with app.app_context():
+        db = get_db()
+        load_gtfs(db, gtfs_zip)
+        return Planner.from_db(db, Timetable.from_db(db))
+
+
+def test_realtime_trip_id():
+    assert realtime_trip_id('AFA23GEN-1038-Weekday-00_000600_1..S03R') == '000600_1..S03R'
+    assert realtime_trip_id('A_0900_N') == '0900_N'
+
+
+def test_midnight_is_new_york_midnight():
+    assert midnight_epoch(FRIDAY) == int(datetime(2025, 5, 16, tzinfo=TIMEZONE).timestamp())
+    # On the day the clocks go forward, schedule times count from noon minus 12 hours
+    assert midnight_epoch(date(2025, 3, 9)) == int(datetime(2025, 3, 9, 12, tzinfo=TIMEZONE).timestamp()) - 43200
+
+
+def test_plan_takes_the_latest_train(app, planner):
+    now = midnight_epoch(FRIDAY) + 8 * 3600
+    with app.app_context():
+        plan = planner.plan(get_db(), *PENN, *FIFTIETH, 9 * 3600 + 10 * 60, now=now)
+    legs = plan['plan']['itineraries'][0]['legs']
+    assert [leg['mode'] for leg in legs] == ['WALK', 'SUBWAY', 'WALK']
+    ride = legs[1]
+    assert ride['tripId'] == 'A_0900_N' and not ride['realTime']
+    assert (ride['from']['stopId'], ride['to']['stopId']) == ('A28', 'A25')
+    assert [stop['stopId'] for stop in ride['intermediateStops']] == ['A27']
+    assert ride['startTime'] == (midnight_epoch(FRIDAY) + 9 * 3600 + 30) * 1000
+
+
+def test_realtime_delays_shift_the_trip(app, planner):
+    midnight = midnight_epoch(FRIDAY)
+    with app.app_context():
+        db = get_db()
+        trip = db.execute(
+            "INSERT INTO trip_update (update_id, trip_id, route_id) VALUES ('e1', '0900_N', 'A')"
+        ).lastrowid
+        # Two minutes late at 42 St
+        db.execute(
+            "INSERT INTO stop_update (trip_update_id, arrival, departure, stop_id, direction) VALUES (?, ?, ?, 'A27', 'N')",
+            (trip, midnight + 9 * 3600 + 240, midnight + 9 * 3600 + 270)
+        )
+        db.commit()
+        plan = planner.plan(db, *PENN, *FIFTIETH, 9 * 3600 + 10 * 60, now=midnight + 8 * 3600 + 50 * 60)
+    ride = plan['plan']['itineraries'][0]['legs'][1]
+    assert ride['realTime'] and ride['departureDelay'] == 120
+    assert ride['endTime'] == (midnight + 9 * 3600 + 5 * 60 + 120) * 1000
@@ -0,0 +1,143 @@
+import json
+import requests
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.apiRouting import api
+
+
+def add_route(db, lat=40.69312, lon=-73.98741, userid='u1'):
+    routeid = db.execute(
+        'INSERT INTO routes (start_address, end_address, start_lat, start_lon, end_lat, end_lon, arrival_time, userid)'
+        " VALUES ('Home', 'Work', ?, ?, 40.74, -74.0, '09:00', ?)",
+        (lat, lon, userid)
+    ).lastrowid
+    db.commit()
+    return routeid
+
+
+def queue(db, *routeids):
+    with db:
+        db.executemany(
+            "INSERT INTO route_recalc_queue (routeid, reason, queued_at) VALUES (?, 'alert', 0)",
+            ((routeid,) for routeid in routeids)
+        )
+
+
+def test_a_queued_route_gets_a_new_plan(app, transit):
+    with app.app_context():
+        db = get_db()
+        first = add_route(db)
+        second = add_route(db, 40.69288, -73.98709, userid='u2')
+        api.Router(api.getRoute(first))
+        assert len(transit.calls) == 1
+
+        # An alert moved everyone to the C, the cached plan still says A
+        transit.duration, transit.line = 1500, 'C'
+        queue(db, first, second)
+        assert api.recalc_queued_routes() == 2
+
+        # One new Transit call, shared by both routes of the batch
+        assert len(transit.calls) == 2
+        rows = db.execute('SELECT routeid, estimateTime FROM routes ORDER BY routeid').fetchall()
+        assert [tuple(row) for row in rows] == [(first, 1500), (second, 1500)]
+        assert json.loads(db.execute('SELECT routes FROM route_index WHERE routeid = ?', (first,)).fetchone()[0]) == ['C']
+        # The new plan is what other requests get now
+        api.Router(api.getRoute(first))
+        assert len(transit.calls) == 2
+
+
+def test_recalc_skips_the_local_planner(app, transit, monkeypatch):
+    monkeypatch.setattr(api, 'local_plan', lambda start, end, arrival_time: transit.plan())
+    with app.app_context():
+        db = get_db()
+        routeid = add_route(db)
+        api.Router(api.getRoute(routeid))
+        assert transit.calls == []
+
+        queue(db, routeid)
+        api.recalc_queued_routes()
+        assert len(transit.calls) == 1
+
+
+def queued_messages(db):
+    return {row[0]: json.loads(row[1]) for row in db.execute('SELECT userid, messages FROM notification_queue')}
+
+
+def test_a_longer_replan_queues_a_notification(app, transit):
+    with app.app_context():
+        db = get_db()
+        routeid = add_route(db)
+        api.Router(api.getRoute(routeid))
+
+        transit.duration = 1200 + 120      # not enough to bother anyone
+        queue(db, routeid)
+        api.recalc_queued_routes()
+        assert queued_messages(db) == {}
+
+        transit.duration = 1200 + api.NOTIFY_LONGER_BY
+        queue(db, routeid)
+        api.recalc_queued_routes()
+        message = queued_messages(db)['u1'][str(routeid)]
+        assert message == 'Home to Work now takes 25 min, 5 min longer than planned'
+
+
+def test_small_slowdowns_add_up_to_a_notification(app, transit):
+    with app.app_context():
+        db = get_db()
+        routeid = add_route(db)
+        api.Router(api.getRoute(routeid))
+
+        # Each replan is under NOTIFY_LONGER_BY longer than the one before
+        step = api.NOTIFY_LONGER_BY // 3 + 1
+        for n in (1, 2):
+            transit.duration = 1200 + n * step
+            queue(db, routeid)
+            api.recalc_queued_routes()
+        assert queued_messages(db) == {}
+        transit.duration = 1200 + 3 * step
+        queue(db, routeid)
+        api.recalc_queued_routes()
+        assert str(routeid) in queued_messages(db)['u1']
+
+        # The owner was told, the next small step doesn't notify again
+        with db:
+            db.execute('DELETE FROM notification_queue')
+        transit.duration += step
+        queue(db, routeid)
+        api.recalc_queued_routes()
+        assert queued_messages(db) == {}
+
+
+def test_the_first_replan_of_an_old_route_is_its_baseline(app, transit):
+    with app.app_context():
+        db = get_db()
+        routeid = add_route(db)     # planned before estimateTime was stored
+        transit.duration = 3000
+        queue(db, routeid)
+        api.recalc_queued_routes()
+        assert queued_messages(db) == {}
+        assert db.execute('SELECT estimateTime FROM routes WHERE routeid = ?', (routeid,)).fetchone()[0] == 3000
+
+        transit.duration = 3000 + api.NOTIFY_LONGER_BY
+        queue(db, routeid)
+        api.recalc_queued_routes()
+        assert str(routeid) in queued_messages(db)['u1']
+
+
+def test_a_failed_replan_stays_queued(app, transit, monkeypatch):
+    def down(url, **kwargs):
+        transit.calls.append((url, kwargs.get('params')))
+        raise requests.exceptions.ConnectionError('Transit is down')
+
+    with app.app_context():
+        db = get_db()
+        routeid = add_route(db)
+        queue(db, routeid)
+        monkeypatch.setattr(transit, 'get', down)
+        assert api.recalc_queued_routes() == 0
+        assert [tuple(row) for row in db.execute('SELECT routeid, reason FROM route_recalc_queue')] == [(routeid, 'retry')]
+
+        # Transit is back
+        monkeypatch.delattr(transit, 'get')
+        assert api.recalc_queued_routes() == 1
+        assert db.execute('SELECT COUNT(*) FROM route_recalc_queue').fetchone()[0] == 0
+        assert db.execute('SELECT estimateTime FROM routes WHERE routeid = ?', (routeid,)).fetchone()[0] == 1200
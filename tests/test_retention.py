@@ -0,0 +1,80 @@
+import pytest
+from DailyCommuterBackend import retention
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.retention import compact, read_segments
+
+
+def add_trip(db, update_id, trip_id, route_id, stops):
+    row_id = db.execute(
+        'INSERT INTO trip_update (update_id, trip_id, route_id) VALUES (?, ?, ?)',
+        (update_id, trip_id, route_id)
+    ).lastrowid
+    db.executemany(
+        'INSERT INTO stop_update (trip_update_id, arrival, departure, stop_id, direction) VALUES (?, ?, ?, ?, ?)',
+        [(row_id, arrival, arrival + 30, stop_id, direction) for stop_id, direction, arrival in stops]
+    )
+    db.commit()
+    return row_id
+
+
+def test_old_rows_are_archived_without_cutting_long_ids(app, tmp_path):
+    trip_id = '111150_FS.S01R_with_a_much_longer_trip_id_than_32_bytes'
+    with app.app_context():
+        db = get_db()
+        add_trip(db, 'old', trip_id, 'SHUTTLE-LONG', [('A28-LONGER-STOP', 'S', 1000), ('A27', 'S', 2000)])
+        add_trip(db, 'new', 'T2', 'A', [('A28', 'N', 9000)])
+        stats = compact(db, str(tmp_path / 'archive'), window=3600, now=9000)
+
+        assert stats['archived'] == 2
+        assert stats['trips'] == 1
+        assert [row[0] for row in db.execute('SELECT update_id FROM trip_update')] == ['new']
+        assert db.execute('SELECT COUNT(*) FROM stop_update').fetchone()[0] == 1
+
+    segments = list(read_segments(str(tmp_path / 'archive')))
+    assert len(segments) == 1
+    segment = segments[0]
+    assert segment['trip_id'].tolist() == [trip_id.encode()] * 2
+    assert segment['route_id'].tolist() == [b'SHUTTLE-LONG'] * 2
+    assert segment['stop_id'].tolist() == [b'A28-LONGER-STOP', b'A27']
+    assert segment['arrival'].tolist() == [1000, 2000]
+
+
+def test_scheduled_compaction_never_runs_a_full_vacuum(app, tmp_path, runner):
+    with app.app_context():
+        db = get_db()
+        db.execute('PRAGMA auto_vacuum = NONE')
+        db.execute('VACUUM')
+        compact(db, str(tmp_path / 'archive'), window=3600)
+        assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 0
+
+        result = runner.invoke(args=['compact-db'])
+        assert 'Turned on incremental vacuum' in result.output
+        assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def test_compaction_recovers_from_a_crash_before_the_delete(app, tmp_path, monkeypatch):
+    folder = str(tmp_path / 'archive')
+    with app.app_context():
+        db = get_db()
+        add_trip(db, 'old', 'T1', 'A', [('A28', 'S', 1000), ('A27', 'S', 2000)])
+
+        # The segment is written, then the process dies before the DELETE
+        real_write = retention.write_segment
+
+        def write_then_crash(folder, rows):
+            real_write(folder, rows)
+            raise KeyboardInterrupt
+        monkeypatch.setattr(retention, 'write_segment', write_then_crash)
+        with pytest.raises(KeyboardInterrupt):
+            compact(db, folder, window=3600, now=9000)
+        assert len(list(read_segments(folder))) == 1
+        assert db.execute('SELECT COUNT(*) FROM stop_update').fetchone()[0] == 2
+
+        monkeypatch.setattr(retention, 'write_segment', real_write)
+        stats = compact(db, folder, window=3600, now=9000)
+        assert stats['archived'] == 2
+        assert db.execute('SELECT COUNT(*) FROM stop_update').fetchone()[0] == 0
+
+    segments = list(read_segments(folder))
+    assert len(segments) == 1
+    assert segments[0]['arrival'].tolist() == [1000, 2000]
@@ -0,0 +1,63 @@
+import pytest
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.apiRouting import saved_routes
+from DailyCommuterBackend.apiRouting.saved_routes import ListingCache, list_saved_routes, touch_user_routes
+
+
+@pytest.fixture(autouse=True)
+def listing_cache(monkeypatch):
+    cache = ListingCache()
+    monkeypatch.setattr(saved_routes, 'listing_cache', cache)
+    return cache
+
+
+def add_routes(db, userid, count):
+    with db:
+        for number in range(count):
+            db.execute(
+                'INSERT INTO routes (route_name, start_address, end_address, arrival_time, userid)'
+                " VALUES (?, 'a', 'b', '09:00', ?)",
+                (f'route {number}', userid)
+            )
+        touch_user_routes(db, userid)
+
+
+def test_keyset_pages_cover_every_route_once(app):
+    with app.app_context():
+        db = get_db()
+        add_routes(db, 'u1', 5)
+        add_routes(db, 'u2', 3)
+        seen, after = [], 0
+        while after is not None:
+            page = list_saved_routes(db, 'u1', limit=2, after=after)
+            assert len(page['routes']) <= 2
+            seen += [route['routeid'] for route in page['routes']]
+            after = page['next_after']
+        assert seen == sorted(seen) and len(seen) == len(set(seen)) == 5
+        assert list_saved_routes(db, 'nobody') == {'routes': [], 'next_after': None}
+
+
+def test_a_write_invalidates_the_cached_pages(app):
+    with app.app_context():
+        db = get_db()
+        add_routes(db, 'u1', 2)
+        assert len(list_saved_routes(db, 'u1')['routes']) == 2
+        add_routes(db, 'u1', 1)
+        assert len(list_saved_routes(db, 'u1')['routes']) == 3
+
+
+def test_unchanged_listing_is_a_304(app, client):
+    with app.app_context():
+        add_routes(get_db(), 'u1', 3)
+    response = client.get('/savedRoutes/u1?limit=2')
+    assert response.status_code == 200
+    assert [route['route_name'] for route in response.json['routes']] == ['route 0', 'route 1']
+    etag = response.headers['ETag']
+
+    assert client.get('/savedRoutes/u1?limit=2', headers={'If-None-Match': etag}).status_code == 304
+    # Another page, or the same page after a write, has another ETag
+    assert client.get('/savedRoutes/u1?limit=2&after=2', headers={'If-None-Match': etag}).status_code == 200
+    with app.app_context():
+        add_routes(get_db(), 'u1', 1)
+    response = client.get('/savedRoutes/u1?limit=2', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
@@ -0,0 +1,65 @@
+import threading
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.migrations import apply_migrations
+from DailyCommuterBackend.scheduler import Job, Scheduler, get_feed_status
+
+
+def test_next_delay_backs_off_and_is_capped():
+    job = Job('test', None, 10, jitter=0, max_backoff=60)
+    assert job.next_delay() == 10
+    job.failures = 2
+    assert job.next_delay() == 40
+    job.failures = 5
+    assert job.next_delay() == 60
+
+
+def test_run_job_records_success_and_failure(app):
+    scheduler = Scheduler()
+    scheduler.add_job('ok', lambda: {'feed-a': 1700000000}, 30)
+
+    def broken():
+        raise RuntimeError('feed down')
+    scheduler.add_job('broken', broken, 30)
+
+    with app.app_context():
+        assert scheduler.run_job(scheduler.jobs['ok'])
+        assert not scheduler.run_job(scheduler.jobs['broken'])
+        assert not scheduler.run_job(scheduler.jobs['broken'])
+        status = {row['name']: row for row in get_feed_status()}
+
+    assert status['ok']['failures'] == 0 and status['ok']['last_success']
+    assert status['feed-a']['data_timestamp'] == 1700000000
+    assert status['broken']['failures'] == 2
+    assert status['broken']['last_error'] == 'feed down'
+    assert scheduler.jobs['broken'].failures == 2
+
+
+def test_feed_status_is_created_by_the_migrations(app):
+    with app.app_context():
+        db = get_db()
+        db.execute('DROP TABLE feed_status')
+        db.execute('PRAGMA user_version = 13')
+        assert apply_migrations(db, target=14) == [14]
+        assert db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'feed_status'").fetchone()[0] == 1
+
+
+def test_a_db_error_does_not_end_the_job_thread(app):
+    with app.app_context():
+        get_db().execute('DROP TABLE feed_status')
+    runs = []
+    ran_twice = threading.Event()
+
+    def job():
+        runs.append(1)
+        if len(runs) >= 2:
+            ran_twice.set()
+
+    scheduler = Scheduler()
+    scheduler.add_job('job', job, 0.01, jitter=0, max_backoff=0.01)
+    scheduler.start(app)
+    try:
+        # Recording the first run fails, the thread still runs the job again
+        assert ran_twice.wait(5)
+    finally:
+        scheduler.stop()
+    assert scheduler.jobs['job'].failures >= 1
@@ -0,0 +1,75 @@
+import math
+import numpy as np
+import pytest
+from DailyCommuterBackend import stations
+from DailyCommuterBackend.db import get_db
+from DailyCommuterBackend.gtfs_static import load_gtfs
+from DailyCommuterBackend.stations import StationIndex, SubwayStations
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(7)
+    lats = rng.uniform(40.55, 40.90, 400)
+    lons = rng.uniform(-74.05, -73.75, 400)
+    lats[[3, 50]] = np.nan      # stops without coordinates
+    return lats, lons
+
+
+def brute_force(index, lat, lon):
+    x, y = index.project(lat, lon)
+    meters = np.hypot(index.x - x, index.y - y)
+    meters[np.isnan(meters)] = np.inf
+    return meters
+
+
+def test_nearest_and_within_match_a_full_scan(points):
+    index = StationIndex(*points)
+    assert len(index) == 398
+    for lat, lon in [(40.7527, -73.9934), (40.60, -74.00), (41.2, -73.0)]:
+        meters = brute_force(index, lat, lon)
+        expected = np.argsort(meters)[:5].tolist()
+        found = index.nearest(lat, lon, 5)
+        assert [i for _, i in found] == expected
+        assert [m for m, _ in found] == pytest.approx(meters[expected].tolist())
+
+        radius = 2500
+        assert [i for _, i in index.within(lat, lon, radius)] \
+            == [i for i in np.argsort(meters).tolist() if meters[i] <= radius]
+
+    assert all(m <= 300 for m, _ in index.nearest(40.7527, -73.9934, 5, max_distance=300))
+    assert 3 not in [i for _, i in index.nearest(40.7, -73.9, 400)]
+
+
+def test_batches_match_single_lookups(points):
+    index = StationIndex(*points)
+    rng = np.random.default_rng(11)
+    lats = rng.uniform(40.5, 40.95, 50)
+    lons = rng.uniform(-74.1, -73.7, 50)
+    positions, meters = index.nearest_batch(lats, lons, 3)
+    for lat, lon, row_positions, row_meters in zip(lats, lons, positions, meters):
+        single = index.nearest(lat, lon, 3)
+        assert row_positions.tolist() == [i for _, i in single]
+        assert row_meters.tolist() == pytest.approx([m for m, _ in single])
+
+    for lat, lon, (hits, hit_meters) in zip(lats, lons, index.within_batch(lats, lons, 1000)):
+        assert hits.tolist() == [i for _, i in index.within(lat, lon, 1000)]
+
+
+def test_empty_index():
+    index = StationIndex([], [])
+    assert index.nearest(40.7, -73.9) == [] and index.within(40.7, -73.9, 500) == []
+    positions, meters = index.nearest_batch([40.7], [-73.9], 3)
+    assert positions.shape == (1, 0)
+
+
+def test_subway_stations_are_parent_stations(app, gtfs_zip):
+    with app.app_context():
+        load_gtfs(get_db(), gtfs_zip)
+        stations.invalidate()
+        subway = SubwayStations.from_db(get_db())
+    assert [stop[0] for stop in subway.stops] == ['A25', 'A27', 'A28']
+    nearest = subway.nearest(40.7523, -73.9934, 2)
+    assert [stop['stop_id'] for stop in nearest] == ['A28', 'A27']
+    assert nearest[0]['distance'] < 20
+    assert math.isclose(nearest[1]['distance'], 640, rel_tol=0.05)
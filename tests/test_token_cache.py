@@ -0,0 +1,133 @@
+import pytest
+import firebase_admin
+from DailyCommuterBackend.apiRouting import token_cache
+from DailyCommuterBackend.apiRouting.token_cache import MAX_TOKEN_LIFETIME, TokenCache
+
+
+class Clock:
+    def __init__(self, now=1_000_000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def claims(uid='alice', iat=1_000_000, lifetime=MAX_TOKEN_LIFETIME):
+    return {'uid': uid, 'iat': iat, 'exp': iat + lifetime}
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_hit_until_the_token_expires(clock):
+    cache = TokenCache(clock=clock)
+    assert cache.get('token') is None
+    assert cache.put('token', claims())
+    assert cache.get('token')['uid'] == 'alice'
+
+    clock.now += MAX_TOKEN_LIFETIME
+    assert cache.get('token') is None
+    assert len(cache) == 0
+    assert cache.stats()['expired'] == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+
+def test_tokens_are_stored_hashed(clock):
+    cache = TokenCache(clock=clock)
+    cache.put('secret-token', claims())
+    assert 'secret-token' not in cache._entries
+    assert token_cache.token_key('secret-token') in cache._entries
+
+
+def test_expired_or_uidless_claims_are_not_kept(clock):
+    cache = TokenCache(clock=clock)
+    assert cache.put('old', claims(iat=clock.now - MAX_TOKEN_LIFETIME))
+    assert cache.put('anonymous', {'iat': clock.now, 'exp': clock.now + 60})
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted(clock):
+    cache = TokenCache(max_size=2, clock=clock)
+    cache.put('a', claims('a'))
+    cache.put('b', claims('b'))
+    cache.get('a')
+    cache.put('c', claims('c'))
+
+    assert cache.get('b') is None
+    assert cache.get('a')['uid'] == 'a'
+    assert cache.get('c')['uid'] == 'c'
+    assert cache.stats()['evicted'] == 1
+
+
+def test_revoke_drops_and_refuses_older_tokens(clock):
+    cache = TokenCache(clock=clock)
+    cache.put('first', claims())
+    cache.put('other', claims('bob'))
+
+    clock.now += 10
+    cache.revoke('alice')
+    assert cache.get('first') is None
+    assert cache.get('other')['uid'] == 'bob'
+    # Still verifies with Firebase, but was issued before the revocation
+    assert not cache.put('first', claims())
+    assert cache.put('second', claims(iat=clock.now))
+    assert cache.get('second')['uid'] == 'alice'
+
+
+def test_revocations_are_forgotten_after_the_token_lifetime(clock):
+    cache = TokenCache(clock=clock)
+    cache.revoke('alice')
+    assert cache.stats()['revoked_users'] == 1
+
+    clock.now += MAX_TOKEN_LIFETIME
+    assert cache.stats()['revoked_users'] == 1
+    clock.now += 1
+    cache.revoke('bob')
+    assert cache.stats()['revoked_users'] == 1
+    assert 'alice' not in cache._revoked
+
+
+def test_warm_certs_without_firebase(monkeypatch):
+    def no_app():
+        raise ValueError('no app')
+    monkeypatch.setattr(firebase_admin, 'get_app', no_app)
+    assert token_cache.warm_certs() is False
+
+
+class Response:
+    def __init__(self, status):
+        self.status = status
+
+
+def test_warm_certs_uses_the_sdk_fetcher(monkeypatch):
+    fetched = []
+
+    def request(url, method):
+        fetched.append((url, method))
+        return Response(200)
+
+    monkeypatch.setattr(firebase_admin, 'get_app', lambda: object())
+    monkeypatch.setattr(token_cache, 'sdk_cert_request', lambda app: request)
+    assert token_cache.warm_certs() is True
+    assert fetched == [(token_cache.CERT_URL, 'GET')]
+
+
+def test_warm_certs_falls_back_to_the_public_transport(monkeypatch, capsys):
+    fetched = []
+
+    class Request:
+        def __call__(self, url, method):
+            fetched.append(url)
+            return Response(503)
+
+    monkeypatch.setattr(firebase_admin, 'get_app', lambda: object())
+    monkeypatch.setattr(token_cache, 'sdk_cert_request', lambda app: None)
+    monkeypatch.setattr(token_cache, '_warned', False)
+    monkeypatch.setattr(token_cache.google.auth.transport.requests, 'Request', Request)
+    with pytest.raises(RuntimeError, match='503'):
+        token_cache.warm_certs()
+    assert fetched == [token_cache.CERT_URL]
+    assert "cert fetcher wasn't found" in capsys.readouterr().out